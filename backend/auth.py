@@ -0,0 +1,244 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Optional
+
+from fastapi import Header, HTTPException
+
+from concurrency import run_io
+from database import (create_auth_token, get_auth_token, delete_auth_token, delete_expired_auth_tokens,
+                      count_user_sessions)
+
+# Authentication and per-user quotas
+# ----------------------------------
+# Passwords are hashed with scrypt (salted, memory-hard; cost set by
+# AUTH_SCRYPT_N/R/P). Hashing runs on its own small pool, see
+# concurrency.run_password_hash. Old unsalted sha256 hashes still verify
+# and are upgraded to scrypt on the next successful login.
+#
+# /login hands out a signed bearer token: base64 JSON claims (user id, token
+# id, expiry) plus an HMAC-SHA256 over them. Every user-facing endpoint takes
+# the caller's user id from it via the current_user dependency
+# ("Authorization: Bearer <token>"). A verified token is kept in an
+# in-memory LRU for AUTH_CACHE_SECONDS, so a busy client costs a dict lookup
+# per request instead of an HMAC plus a DB round trip. The DB only records
+# token ids (auth_tokens) so /logout can revoke them; a revoked token stops
+# working at once in this process and within AUTH_CACHE_SECONDS in others.
+#
+# Quotas are per user: a cap on stored sessions, and a sliding one-hour
+# window on chat requests (kept in memory, so it is per server process).
+#
+# Chats from before sessions had owners are kept: with a single account they
+# were assigned to it on upgrade, otherwise the user named in
+# LEGACY_SESSIONS_OWNER takes them over on their next login.
+
+TOKEN_TTL_SECONDS = float(os.getenv("AUTH_TOKEN_TTL_HOURS", str(24 * 7))) * 3600
+SCRYPT_N = int(os.getenv("AUTH_SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = int(os.getenv("AUTH_SCRYPT_R", "8"))
+SCRYPT_P = int(os.getenv("AUTH_SCRYPT_P", "1"))
+CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+CACHE_SECONDS = float(os.getenv("AUTH_CACHE_SECONDS", "60"))
+# Signing key: AUTH_SECRET, or a random one generated once and kept in this file
+SECRET_FILE = "auth_secret.key"
+MAX_SESSIONS_PER_USER = int(os.getenv("USER_MAX_SESSIONS", "1000"))
+CHAT_REQUESTS_PER_HOUR = int(os.getenv("USER_CHAT_REQUESTS_PER_HOUR", "300"))
+LEGACY_SESSIONS_OWNER = os.getenv("LEGACY_SESSIONS_OWNER")
+
+class QuotaExceededError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Passwords
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _scrypt(password, salt, n, r, p):
+    # maxmem must cover 128 * n * r * p bytes plus some headroom
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r * p, dklen=32)
+
+def hash_password(password):
+    """'scrypt$n$r$p$salt$hash', with the cost parameters stored alongside."""
+    salt = secrets.token_bytes(16)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64encode(salt)}${_b64encode(digest)}"
+
+def verify_password(password, stored):
+    if stored.startswith("scrypt$"):
+        _, n, r, p, salt, digest = stored.split("$")
+        candidate = _scrypt(password, _b64decode(salt), int(n), int(r), int(p))
+        return hmac.compare_digest(candidate, _b64decode(digest))
+    # Legacy unsalted sha256 from before scrypt
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+
+def needs_rehash(stored):
+    return not stored.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+# Used to spend the same time on unknown usernames as on wrong passwords
+_DUMMY_HASH = None
+
+def dummy_verify(password):
+    global _DUMMY_HASH
+    if _DUMMY_HASH is None:
+        _DUMMY_HASH = hash_password(secrets.token_hex(8))
+    verify_password(password, _DUMMY_HASH)
+    return False
+
+# Tokens
+
+_secret = None
+_secret_lock = threading.Lock()
+
+def _signing_key():
+    global _secret
+    with _secret_lock:
+        if _secret is None:
+            configured = os.getenv("AUTH_SECRET")
+            if configured:
+                _secret = configured.encode("utf-8")
+            elif os.path.exists(SECRET_FILE):
+                with open(SECRET_FILE, "rb") as f:
+                    _secret = f.read().strip()
+            else:
+                _secret = _create_secret_file()
+        return _secret
+
+def _create_secret_file():
+    secret = secrets.token_hex(32).encode("ascii")
+    try:
+        fd = os.open(SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Another worker starting at the same time won; use its key
+        for _ in range(50):
+            with open(SECRET_FILE, "rb") as f:
+                existing = f.read().strip()
+            if existing:
+                return existing
+            time.sleep(0.1)  # created but not written yet
+        raise RuntimeError(f"{SECRET_FILE} exists but is empty")
+    with os.fdopen(fd, "wb") as f:
+        f.write(secret)
+    return secret
+
+def _sign(payload):
+    return _b64encode(hmac.new(_signing_key(), payload.encode("ascii"), hashlib.sha256).digest())
+
+def _valid_signature(payload, signature):
+    # Compared as bytes: compare_digest rejects non-ASCII str, and tokens come from client headers
+    return hmac.compare_digest(signature.encode("utf-8"), _sign(payload).encode("ascii"))
+
+def _hash_token_id(token_id):
+    return hashlib.sha256(token_id.encode("utf-8")).hexdigest()
+
+def issue_token(user_id):
+    """Creates a signed token for the user and records its id for revocation."""
+    now = time.time()
+    claims = {"uid": user_id, "tid": uuid.uuid4().hex, "exp": int(now + TOKEN_TTL_SECONDS)}
+    delete_expired_auth_tokens(now)
+    create_auth_token(_hash_token_id(claims["tid"]), user_id, claims["exp"])
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+def _decode_token(token):
+    """Claims of a correctly signed, unexpired token, else None. No DB access."""
+    payload, _, signature = token.partition(".")
+    try:
+        if not payload or not _valid_signature(payload, signature):
+            return None
+        claims = json.loads(_b64decode(payload))
+        if not isinstance(claims, dict) or claims.get("exp", 0) < time.time():
+            return None
+    except (UnicodeError, TypeError, ValueError):
+        # Non-ASCII or otherwise malformed token: just not authenticated
+        return None
+    return claims
+
+_verified = OrderedDict()  # token -> (user_id, expires_at, cache_until)
+_verified_lock = threading.Lock()
+
+def _cached_user(token):
+    now = time.time()
+    with _verified_lock:
+        entry = _verified.get(token)
+        if entry is None:
+            return None
+        user_id, expires_at, cache_until = entry
+        if now >= expires_at or now >= cache_until:
+            del _verified[token]
+            return None
+        _verified.move_to_end(token)
+        return user_id
+
+def verify_token(token):
+    """User id for a valid, unexpired, unrevoked token, else None."""
+    user_id = _cached_user(token)
+    if user_id:
+        return user_id
+    claims = _decode_token(token)
+    if not claims:
+        return None
+    row = get_auth_token(_hash_token_id(claims["tid"]))
+    if not row or row["user_id"] != claims["uid"]:
+        return None  # revoked
+    with _verified_lock:
+        _verified[token] = (claims["uid"], claims["exp"], time.time() + CACHE_SECONDS)
+        _verified.move_to_end(token)
+        while len(_verified) > CACHE_SIZE:
+            _verified.popitem(last=False)
+    return claims["uid"]
+
+def revoke_token(token):
+    with _verified_lock:
+        _verified.pop(token, None)
+    claims = _decode_token(token)
+    if claims:
+        delete_auth_token(_hash_token_id(claims["tid"]))
+
+def bearer_token(authorization):
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
+
+async def current_user(authorization: Optional[str] = Header(None)) -> str:
+    """FastAPI dependency: the authenticated user's id, or 401."""
+    token = bearer_token(authorization)
+    # Cache hits are answered inline; only misses go to the IO pool
+    user_id = _cached_user(token) if token else None
+    if token and not user_id:
+        user_id = await run_io(verify_token, token)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Not authenticated",
+                            headers={"WWW-Authenticate": "Bearer"})
+    return user_id
+
+_chat_requests = {}  # user_id -> deque of timestamps
+_chat_lock = threading.Lock()
+
+def check_chat_quota(user_id):
+    """Counts one chat request; raises QuotaExceededError over the hourly limit."""
+    now = time.time()
+    with _chat_lock:
+        timestamps = _chat_requests.setdefault(user_id, deque())
+        while timestamps and timestamps[0] <= now - 3600:
+            timestamps.popleft()
+        if len(timestamps) >= CHAT_REQUESTS_PER_HOUR:
+            raise QuotaExceededError(f"Chat limit of {CHAT_REQUESTS_PER_HOUR} requests per hour reached",
+                                     retry_after=int(timestamps[0] + 3600 - now) + 1)
+        timestamps.append(now)
+
+def check_session_quota(user_id):
+    if count_user_sessions(user_id) >= MAX_SESSIONS_PER_USER:
+        raise QuotaExceededError(f"Session limit of {MAX_SESSIONS_PER_USER} reached, delete old chats first")
@@ -0,0 +1,92 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import uuid
+
+import database
+
+# Messages/sec benchmark for the chat-history layer.
+#   python bench_db.py [turns]
+#
+# "before" replays the original access pattern: a fresh connection, default
+# rollback journal and one commit per message (two per chat turn).
+# "after" uses the pooled connection layer in database.py: WAL, persistent
+# per-thread connection and one transaction per chat turn.
+# Each run uses its own temporary database so chat_history.db is untouched.
+
+TURNS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+def legacy_add_message(db_name, session_id, role, content, msg_type="text"):
+    conn = sqlite3.connect(db_name)
+    c = conn.cursor()
+    c.execute("INSERT INTO messages (session_id, role, content, type) VALUES (?, ?, ?, ?)",
+              (session_id, role, content, msg_type))
+    msg_id = c.lastrowid
+    if role == "user":
+        c.execute("UPDATE sessions SET title = ? WHERE id = ? AND title = 'New Chat'",
+                  (content[:30] + "..." if len(content) > 30 else content, session_id))
+    conn.commit()
+    conn.close()
+    return msg_id
+
+def fresh_db(tmp_dir, name):
+    database.close_connections()
+    database.DB_NAME = os.path.join(tmp_dir, name)
+    database.init_db()
+    session_id = str(uuid.uuid4())
+    database.create_session(session_id)
+    return session_id
+
+def bench_before(tmp_dir):
+    session_id = fresh_db(tmp_dir, "before.db")
+    db_name = database.DB_NAME
+    # The legacy code never set journal_mode, so put the file back to the default
+    database.close_connections()
+    conn = sqlite3.connect(db_name)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.close()
+
+    start = time.perf_counter()
+    for i in range(TURNS):
+        legacy_add_message(db_name, session_id, "user", f"Question number {i}")
+        legacy_add_message(db_name, session_id, "model", f"Answer number {i}")
+    return time.perf_counter() - start
+
+def bench_after(tmp_dir):
+    session_id = fresh_db(tmp_dir, "after.db")
+    start = time.perf_counter()
+    for i in range(TURNS):
+        database.add_chat_turn(session_id, f"Question number {i}", f"Answer number {i}")
+    return time.perf_counter() - start
+
+def bench_batched(tmp_dir):
+    session_id = fresh_db(tmp_dir, "batched.db")
+    rows = []
+    for i in range(TURNS):
+        rows.append((session_id, "user", f"Question number {i}", "text"))
+        rows.append((session_id, "model", f"Answer number {i}", "text"))
+    start = time.perf_counter()
+    database.add_messages(rows)
+    return time.perf_counter() - start
+
+def run():
+    original_db = database.DB_NAME
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = [
+            ("before (connect per message)", bench_before(tmp_dir)),
+            ("after (pooled, 1 txn per turn)", bench_after(tmp_dir)),
+            ("after (batched add_messages)", bench_batched(tmp_dir)),
+        ]
+        database.close_connections()
+    database.DB_NAME = original_db
+
+    messages = TURNS * 2
+    baseline = results[0][1]
+    print(f"{TURNS} chat turns ({messages} messages)")
+    for name, elapsed in results:
+        print(f"{name:32s} {messages / elapsed:10.0f} msg/s  ({baseline / elapsed:.1f}x)")
+
+if __name__ == "__main__":
+    run()
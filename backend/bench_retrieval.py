@@ -0,0 +1,78 @@
+import argparse
+import os
+import tempfile
+import time
+
+import retrieval
+from extraction_cache import get_extracted_text
+from ollama_pool import pool
+
+# Prompt size / latency: whole-file context vs retrieved chunks.
+#   python bench_retrieval.py uploads/report.pdf --question "What are the key findings?"
+#   python bench_retrieval.py uploads/report.pdf --model mistral:latest   # also time generation
+#
+# Without a file argument a synthetic ~200 KB document is used.
+# Token counts are estimated at ~4 characters per token.
+
+def synthetic_document(path):
+    with open(path, "w", encoding="utf-8") as f:
+        for section in range(400):
+            f.write(f"Section {section}. This part of the report discusses topic number {section}, "
+                    f"including measurements, context and caveats for item {section}. " * 4 + "\n\n")
+
+def estimate_tokens(text):
+    return len(text) // 4
+
+def whole_file_prompt(question, file_paths):
+    context_text = ""
+    for file_path in file_paths:
+        context_text += f"\n--- Content of {os.path.basename(file_path)} ---\n{get_extracted_text(file_path)}\n"
+    return f"{question}\n\nContext from uploaded files:\n{context_text}"
+
+def retrieval_prompt(question, file_paths):
+    return f"{question}\n\nContext from uploaded files:\n{retrieval.build_context(question, file_paths)}"
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def time_generation(model, prompt):
+    start = time.perf_counter()
+    response = pool.chat(model=model, messages=[{"role": "user", "content": prompt}])
+    elapsed = time.perf_counter() - start
+    return elapsed, response.get("prompt_eval_count"), response.get("prompt_eval_duration")
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--question", default="What does the document say about topic number 123?")
+    parser.add_argument("--model", help="Also time a real generation with this Ollama model")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = args.files
+        if not files:
+            files = [os.path.join(tmp_dir, "synthetic.txt")]
+            synthetic_document(files[0])
+
+        # Warm extraction + index, as /upload would have done
+        _, index_time = timed(lambda: [retrieval.index_document(path) for path in files])
+
+        whole, whole_time = timed(whole_file_prompt, args.question, files)
+        rag, rag_time = timed(retrieval_prompt, args.question, files)
+
+        print(f"indexing (upload time): {index_time * 1000:.1f}ms")
+        print(f"{'':18s}{'chars':>10s}{'~tokens':>10s}{'assembly':>12s}")
+        print(f"{'whole file':18s}{len(whole):10d}{estimate_tokens(whole):10d}{whole_time * 1000:10.1f}ms")
+        print(f"{'retrieval top-k':18s}{len(rag):10d}{estimate_tokens(rag):10d}{rag_time * 1000:10.1f}ms")
+        print(f"prompt size reduction: {len(whole) / max(len(rag), 1):.1f}x")
+
+        if args.model:
+            for name, prompt in (("whole file", whole), ("retrieval top-k", rag)):
+                elapsed, prompt_tokens, prefill_ns = time_generation(args.model, prompt)
+                prefill = f"{prefill_ns / 1e9:.2f}s" if prefill_ns else "n/a"
+                print(f"{name:18s} generation {elapsed:.2f}s, prompt tokens {prompt_tokens}, prefill {prefill}")
+
+if __name__ == "__main__":
+    run()
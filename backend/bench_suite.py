@@ -0,0 +1,365 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Reproducible benchmark suite
+#   python bench_suite.py                                  # all workloads, defaults
+#   python bench_suite.py --workloads chat,stream --concurrency 16 --requests 200
+#   python bench_suite.py --tokens-per-sec 30 --image-latency 2 --compare none
+#   python bench_suite.py --ollama-hosts 3                 # routed over a pool of fake hosts
+#
+# Starts everything in-process against throwaway state: fake_ollama.py on
+# free ports (one per --ollama-hosts; deterministic replies, configurable tokens/sec and model load
+# time), the fake image backend, and the FastAPI app under uvicorn in a
+# background thread, all inside a temporary working directory so
+# chat_history.db, uploads/ and generated_images/ are untouched.
+#
+# Each workload runs --requests requests from --concurrency client threads
+# and reports throughput, p50/p95/p99 latency, errors and the process RSS.
+# Results are written to bench_results/<time>-<commit>.json, and the run is
+# compared with the previous result file (or --compare PATH); p95 or
+# throughput moving by more than --threshold is flagged.
+
+WORKLOADS = ("chat", "stream", "history", "search", "upload", "image")
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BACKEND_DIR, "bench_results")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def rss_mb():
+    """Current resident set size of this process (app + fakes + client), in MB."""
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6, 1)
+    except (OSError, ValueError, AttributeError):
+        try:
+            import resource
+            # Peak, not current: ru_maxrss is KB on Linux, bytes on macOS
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return round(peak / (1e6 if sys.platform == "darwin" else 1e3), 1)
+        except ImportError:
+            return None
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+class BenchClient:
+    """One registered user; a requests.Session per client thread."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self._local = threading.local()
+        username, password = f"bench-{uuid.uuid4().hex[:8]}", uuid.uuid4().hex
+        requests.post(f"{base_url}/register", json={"username": username, "password": password}, timeout=30)
+        self.token = requests.post(f"{base_url}/login", json={"username": username, "password": password},
+                                   timeout=30).json()["token"]
+
+    @property
+    def http(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers["Authorization"] = f"Bearer {self.token}"
+        return session
+
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    def new_session(self):
+        return self.http.post(self.url("/sessions"), json={"title": "Bench"}, timeout=30).json()["id"]
+
+def make_documents(directory):
+    """A ~100 KB text file and a docx, written once per run."""
+    import docx
+    paths = []
+    txt_path = os.path.join(directory, "bench_notes.txt")
+    with open(txt_path, "w", encoding="utf-8") as f:
+        for i in range(1500):
+            f.write(f"Line {i}: measurements for sample {i % 37} were within tolerance on day {i % 11}.\n")
+    paths.append(txt_path)
+    document = docx.Document()
+    for i in range(300):
+        document.add_paragraph(f"Paragraph {i} describes finding {i % 23} and its follow-up actions.")
+    docx_path = os.path.join(directory, "bench_report.docx")
+    document.save(docx_path)
+    paths.append(docx_path)
+    return paths
+
+# Workloads: each function performs one request (or one logical operation)
+# and raises on failure. setup(client) runs once and returns shared state.
+
+def setup_sessions(client, concurrency):
+    return [client.new_session() for _ in range(concurrency)]
+
+def chat_op(client, state, i):
+    session_id = state[i % len(state)]
+    response = client.http.post(client.url("/chat"), json={
+        "message": f"Benchmark question {i}: summarise item {i % 17}",
+        "session_id": session_id,
+    }, timeout=600)
+    response.raise_for_status()
+
+def stream_op(client, state, i):
+    """Returns time to first token as an extra measurement."""
+    session_id = state[i % len(state)]
+    start = time.perf_counter()
+    first_token = None
+    with client.http.post(client.url("/chat/stream"), json={
+        "message": f"Write code for task {i}",
+        "session_id": session_id,
+    }, stream=True, timeout=600) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if first_token is None and line.startswith(b'data: {"token"'):
+                first_token = time.perf_counter() - start
+    return {"ttft": first_token}
+
+def setup_history(client, concurrency):
+    # Sessions with a realistic amount of history to page through
+    import database
+    sessions = setup_sessions(client, concurrency)
+    for session_id in sessions:
+        database.add_messages([(session_id, "user" if n % 2 == 0 else "model", f"history message {n} about topic {n % 9}", "text")
+                               for n in range(400)])
+    return sessions
+
+def history_op(client, state, i):
+    session_id = state[i % len(state)]
+    if i % 2:
+        response = client.http.get(client.url("/sessions"), params={"limit": 50}, timeout=60)
+    else:
+        response = client.http.get(client.url(f"/sessions/{session_id}/messages"), params={"limit": 200}, timeout=60)
+    response.raise_for_status()
+
+def search_op(client, state, i):
+    response = client.http.get(client.url("/search"), params={"q": f"topic {i % 9}", "limit": 20}, timeout=60)
+    response.raise_for_status()
+
+def upload_op(client, state, i):
+    path = state[i % len(state)]
+    with open(path, "rb") as f:
+        # A distinct name per request so every upload is stored and processed
+        name = f"{i}-{os.path.basename(path)}"
+        response = client.http.post(client.url("/upload"), files={"file": (name, f)}, timeout=600)
+    response.raise_for_status()
+
+def image_op(client, state, i):
+    response = client.http.post(client.url("/image-jobs"), json={"prompt": f"benchmark image {i}"}, timeout=60)
+    response.raise_for_status()
+    job = response.json()
+    while job["status"] not in ("done", "error"):
+        time.sleep(0.05)
+        job = client.http.get(client.url(job["status_url"]), timeout=60).json()
+    if job["status"] != "done":
+        raise RuntimeError(job.get("response"))
+
+def run_workload(client, op, state, concurrency, total):
+    latencies = []
+    extras = []
+    errors = []
+    lock = threading.Lock()
+
+    def one(i):
+        start = time.perf_counter()
+        try:
+            extra = op(client, state, i)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if extra:
+                extras.append(extra)
+
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    wall = time.perf_counter() - start
+
+    result = {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "wall_seconds": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else None,
+        "rss_mb_before": rss_before,
+        "rss_mb_after": rss_mb(),
+    }
+    if latencies:
+        for pct in (50, 95, 99):
+            result[f"p{pct}_ms"] = round(percentile(latencies, pct) * 1000, 2)
+        result["max_ms"] = round(max(latencies) * 1000, 2)
+    ttfts = [extra["ttft"] for extra in extras if extra.get("ttft") is not None]
+    if ttfts:
+        result["ttft_p50_ms"] = round(percentile(ttfts, 50) * 1000, 2)
+        result["ttft_p95_ms"] = round(percentile(ttfts, 95) * 1000, 2)
+    if errors:
+        result["first_error"] = errors[0][:300]
+    return result
+
+def start_app(port):
+    import uvicorn
+    import main
+    # Keep the per-request JSON logs out of the report
+    logging.getLogger("chatbot").setLevel(logging.WARNING)
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning",
+                                           access_log=False))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.time() + 30
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError("App did not start")
+        time.sleep(0.05)
+    return server, thread
+
+def previous_result(out_dir, exclude):
+    files = [path for path in sorted(glob.glob(os.path.join(out_dir, "*.json"))) if path != exclude]
+    return files[-1] if files else None
+
+def compare(current, previous_path, threshold):
+    with open(previous_path, encoding="utf-8") as f:
+        previous = json.load(f)
+    print(f"\nCompared with {os.path.basename(previous_path)} (commit {previous.get('commit')}):")
+    regressions = 0
+    for name, now in current["workloads"].items():
+        before = previous.get("workloads", {}).get(name)
+        if not before or "p95_ms" not in now or "p95_ms" not in before:
+            continue
+        p95_change = (now["p95_ms"] - before["p95_ms"]) / before["p95_ms"] if before["p95_ms"] else 0
+        rps_change = ((now["throughput_rps"] - before["throughput_rps"]) / before["throughput_rps"]
+                      if before.get("throughput_rps") else 0)
+        flag = ""
+        if p95_change > threshold or rps_change < -threshold:
+            flag = "  <-- regression"
+            regressions += 1
+        print(f"  {name:<8} p95 {before['p95_ms']:>9.1f} -> {now['p95_ms']:>9.1f} ms ({p95_change:+.0%})  "
+              f"throughput {before['throughput_rps']:>7.1f} -> {now['throughput_rps']:>7.1f} rps ({rps_change:+.0%}){flag}")
+    return regressions
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="In-process benchmark with fake Ollama/HF backends")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help=f"comma separated, from {', '.join(WORKLOADS)}")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=40, help="requests per workload")
+    parser.add_argument("--tokens-per-sec", type=float, default=200.0, help="fake Ollama decode speed")
+    parser.add_argument("--reply-tokens", type=int, default=20)
+    parser.add_argument("--load-seconds", type=float, default=0.0, help="fake Ollama model load time")
+    parser.add_argument("--ollama-hosts", type=int, default=1, help="fake Ollama servers in the pool")
+    parser.add_argument("--image-latency", type=float, default=0.2, help="fake image backend seconds per image")
+    parser.add_argument("--out", default=RESULTS_DIR)
+    parser.add_argument("--compare", default="auto", help="auto (previous result), a result file, or none")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change flagged as a regression")
+    args = parser.parse_args()
+
+    workloads = [name.strip() for name in args.workloads.split(",") if name.strip()]
+    unknown = set(workloads) - set(WORKLOADS)
+    if unknown:
+        sys.exit(f"Unknown workloads: {', '.join(sorted(unknown))}")
+
+    out_dir = os.path.abspath(args.out)
+    workdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    ollama_ports = [free_port() for _ in range(max(1, args.ollama_hosts))]
+    app_port = free_port()
+
+    # Configure the app before importing it: fake backends, no quotas getting in the way
+    os.environ.update({
+        "OLLAMA_HOSTS": ",".join(f"http://127.0.0.1:{port}" for port in ollama_ports),
+        "IMAGE_BACKEND": "fake",
+        "FAKE_IMAGE_LATENCY": str(args.image_latency),
+        "PRELOAD_MODELS": "0",
+        "USER_CHAT_REQUESTS_PER_HOUR": "1000000",
+        "USER_MAX_SESSIONS": "1000000",
+        "AUTH_SECRET": uuid.uuid4().hex,
+        # Every chat in a run is distinct, but keep the cache out of the numbers anyway
+        "RESPONSE_CACHE": "0",
+    })
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+
+    import fake_ollama
+    for port in ollama_ports:
+        fake_ollama.serve(port=port, tokens_per_sec=args.tokens_per_sec, reply_tokens=args.reply_tokens,
+                          load_seconds=args.load_seconds, max_loaded=4, parallel=args.concurrency)
+    server, thread = start_app(app_port)
+    client = BenchClient(f"http://127.0.0.1:{app_port}")
+
+    documents = make_documents(workdir)
+    setups = {
+        "chat": lambda: setup_sessions(client, args.concurrency),
+        "stream": lambda: setup_sessions(client, args.concurrency),
+        "history": lambda: setup_history(client, args.concurrency),
+        "search": lambda: None,
+        "upload": lambda: documents,
+        "image": lambda: None,
+    }
+    ops = {"chat": chat_op, "stream": stream_op, "history": history_op, "search": search_op,
+           "upload": upload_op, "image": image_op}
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("out", "compare")},
+        "workloads": {},
+    }
+    try:
+        for name in workloads:
+            state = setups[name]()
+            result = run_workload(client, ops[name], state, args.concurrency, args.requests)
+            results["workloads"][name] = result
+            print(f"{name:<8} {result['throughput_rps'] or 0:>8.1f} rps  "
+                  f"p50 {result.get('p50_ms', 0):>8.1f}  p95 {result.get('p95_ms', 0):>8.1f}  "
+                  f"p99 {result.get('p99_ms', 0):>8.1f} ms  errors {result['errors']}  rss {result['rss_mb_after']} MB"
+                  + (f"  ttft p50 {result['ttft_p50_ms']:.1f} ms" if "ttft_p50_ms" in result else ""))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{results['commit']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved {path}")
+
+    baseline = None
+    if args.compare == "auto":
+        baseline = previous_result(out_dir, path)
+    elif args.compare != "none":
+        baseline = args.compare
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{regressions} workload(s) regressed by more than {args.threshold:.0%}")
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,301 @@
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from interaction_log import LOG_FILE, rotated_files
+
+# SFT dataset builder for the self-learning log
+#   python build_dataset.py --out dataset [--format jsonl|parquet] [--workers 4]
+#
+# Streams training_data.jsonl and its rotated/compressed siblings (or the
+# files given with --input) one line at a time, so memory stays flat however
+# big the logs get:
+# - drops error replies ("Error generating response: ...") and empty ones
+# - drops exact duplicates (hash of the normalised prompt + reply) and near
+#   duplicates (MinHash over word shingles, banded LSH)
+# - joins in the earlier turns of the chat from chat_history.db by matching
+#   the logged reply to the stored bot message, within the logged session
+#   (older records have none: then only replies stored exactly once match,
+#   since a common reply like "Sure!" can't say which chat it came from)
+# - writes shards of --shard-size examples in chat "messages" format, in
+#   parallel worker processes, plus stats.json with per-model counts
+# Parquet output needs pyarrow.
+
+ERROR_PREFIXES = ("Error generating response", "Error analyzing image", "Error generating image",
+                  "Error communicating with")
+NUM_PERM = 64
+LSH_BANDS = 8          # 8 bands x 8 rows: pairs above ~0.77 Jaccard collide
+CHUNK_SIZE = 2000      # records read before signatures are computed in the pool
+MERSENNE_PRIME = (1 << 31) - 1
+
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, MERSENNE_PRIME, size=NUM_PERM).astype(np.uint64)
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".zst"):
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")), encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+def default_inputs():
+    paths = rotated_files(LOG_FILE)
+    if os.path.exists(LOG_FILE):
+        paths.append(LOG_FILE)
+    return paths
+
+def iter_records(paths, stats):
+    for path in paths:
+        with open_log(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    stats["malformed"] += 1
+                    continue
+                if isinstance(record, dict) and "prompt" in record and "response" in record:
+                    yield record
+                else:
+                    stats["malformed"] += 1
+
+def normalize(text):
+    return re.sub(r"\s+", " ", str(text or "")).strip().lower()
+
+def dedup_text(record):
+    # Punctuation-insensitive, so "ready to help!" and "ready to help." collide
+    text = normalize(record["prompt"]) + " || " + normalize(record["response"])
+    return re.sub(r"[^\w\s|]", "", text)
+
+def is_error_reply(response):
+    text = str(response or "").strip()
+    return not text or text.startswith(ERROR_PREFIXES)
+
+def minhash(text, shingle_words=3):
+    """MinHash signature (NUM_PERM uint32 values) of the text's word shingles."""
+    words = text.split()
+    shingles = {" ".join(words[i:i + shingle_words]) for i in range(max(1, len(words) - shingle_words + 1))}
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingles),
+        dtype=np.uint64, count=len(shingles))
+    return ((_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+def minhash_batch(texts):
+    return [minhash(text) for text in texts]
+
+def lsh_keys(signature):
+    rows = NUM_PERM // LSH_BANDS
+    return [hashlib.blake2b(signature[band * rows:(band + 1) * rows].tobytes(), digest_size=8,
+                            person=bytes([band]) * 16).digest() for band in range(LSH_BANDS)]
+
+class HistoryIndex:
+    """Maps logged replies to bot messages in chat_history.db and fetches the turns before them."""
+
+    def __init__(self, db_path, max_messages):
+        self.max_messages = max_messages
+        self.conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        self.by_reply = {}  # reply key -> [(session_id, message id)]
+        for msg_id, session_id, content in self.conn.execute(
+                "SELECT id, session_id, content FROM messages WHERE role = 'model' AND session_id IS NOT NULL"):
+            self.by_reply.setdefault(self._key(content), []).append((session_id, msg_id))
+
+    @staticmethod
+    def _key(text):
+        return hashlib.blake2b(normalize(text).encode("utf-8"), digest_size=12).digest()
+
+    def history_for(self, response, session_id=None):
+        """(session_id, earlier messages) for a reply, or (None, []) unless exactly one message matches."""
+        matches = self.by_reply.get(self._key(response), [])
+        if session_id:
+            matches = [match for match in matches if match[0] == session_id]
+        if len(matches) != 1:
+            return None, []
+        session_id, bot_id = matches[0]
+        rows = self.conn.execute(
+            "SELECT role, content FROM messages WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (session_id, bot_id, self.max_messages + 1)).fetchall()
+        # rows[0] is the user message of this turn; the logged prompt replaces it
+        earlier = [{"role": "assistant" if role == "model" else "user", "content": content}
+                   for role, content in reversed(rows[1:])]
+        return session_id, earlier
+
+def to_example(record, session_id, history):
+    return {
+        "messages": history + [
+            {"role": "user", "content": record["prompt"]},
+            {"role": "assistant", "content": str(record["response"]).strip()},
+        ],
+        "model": record.get("model"),
+        "timestamp": record.get("timestamp"),
+        "has_image": bool(record.get("has_image")),
+        "session_id": session_id,
+    }
+
+def write_shard(path, examples, fmt):
+    tmp_path = path + ".tmp"
+    if fmt == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.Table.from_pylist(examples), tmp_path, compression="zstd")
+    else:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for example in examples:
+                f.write(json.dumps(example, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+    return path, len(examples)
+
+class ShardWriter:
+    """Writes full shards in worker processes, with a bounded number in flight."""
+
+    def __init__(self, out_dir, fmt, shard_size, pool, max_in_flight):
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.shard_size = shard_size
+        self.pool = pool
+        self.max_in_flight = max_in_flight
+        self.buffer = []
+        self.pending = []
+        self.written = []
+
+    def add(self, example):
+        self.buffer.append(example)
+        if len(self.buffer) >= self.shard_size:
+            self._submit()
+
+    def _submit(self):
+        path = os.path.join(self.out_dir, f"train-{len(self.written) + len(self.pending):05d}.{self.fmt}")
+        examples, self.buffer = self.buffer, []
+        if self.pool is None:
+            self.written.append(write_shard(path, examples, self.fmt))
+            return
+        self.pending.append(self.pool.submit(write_shard, path, examples, self.fmt))
+        while len(self.pending) > self.max_in_flight:
+            self.written.append(self.pending.pop(0).result())
+
+    def close(self):
+        if self.buffer:
+            self._submit()
+        for future in self.pending:
+            self.written.append(future.result())
+        self.pending = []
+        return self.written
+
+def new_model_stats():
+    return {"read": 0, "kept": 0, "errors": 0, "exact_duplicates": 0, "near_duplicates": 0,
+            "with_history": 0, "prompt_chars": 0, "response_chars": 0}
+
+def build(paths, out_dir, fmt="jsonl", shard_size=5000, workers=1, db_path=None,
+          history_messages=6, near_dedup=True):
+    os.makedirs(out_dir, exist_ok=True)
+    stats = {"malformed": 0, "models": {}}
+    history = HistoryIndex(db_path, history_messages) if db_path and os.path.exists(db_path) else None
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    writer = ShardWriter(out_dir, fmt, shard_size, pool, max_in_flight=workers * 2)
+    seen = set()
+    lsh_buckets = set()
+
+    def process_chunk(chunk):
+        texts = [dedup_text(record) for record in chunk]
+        if near_dedup:
+            if pool is not None:
+                step = max(1, len(texts) // workers)
+                signatures = [sig for part in pool.map(minhash_batch, [texts[i:i + step] for i in range(0, len(texts), step)])
+                              for sig in part]
+            else:
+                signatures = minhash_batch(texts)
+        for i, record in enumerate(chunk):
+            model_stats = stats["models"].setdefault(record.get("model") or "unknown", new_model_stats())
+            digest = hashlib.blake2b(texts[i].encode("utf-8"), digest_size=12).digest()
+            if digest in seen:
+                model_stats["exact_duplicates"] += 1
+                continue
+            seen.add(digest)
+            if near_dedup:
+                keys = lsh_keys(signatures[i])
+                if any(key in lsh_buckets for key in keys):
+                    model_stats["near_duplicates"] += 1
+                    continue
+                lsh_buckets.update(keys)
+            session_id, earlier = history.history_for(record["response"], record.get("session_id")) if history else (None, [])
+            if earlier:
+                model_stats["with_history"] += 1
+            model_stats["kept"] += 1
+            model_stats["prompt_chars"] += len(str(record["prompt"]))
+            model_stats["response_chars"] += len(str(record["response"]))
+            writer.add(to_example(record, session_id, earlier))
+
+    try:
+        chunk = []
+        for record in iter_records(paths, stats):
+            model_stats = stats["models"].setdefault(record.get("model") or "unknown", new_model_stats())
+            model_stats["read"] += 1
+            if is_error_reply(record["response"]):
+                model_stats["errors"] += 1
+                continue
+            chunk.append(record)
+            if len(chunk) >= CHUNK_SIZE:
+                process_chunk(chunk)
+                chunk = []
+        if chunk:
+            process_chunk(chunk)
+        shards = writer.close()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    for model_stats in stats["models"].values():
+        kept = model_stats["kept"] or 1
+        model_stats["avg_prompt_chars"] = round(model_stats.pop("prompt_chars") / kept, 1)
+        model_stats["avg_response_chars"] = round(model_stats.pop("response_chars") / kept, 1)
+    stats["inputs"] = paths
+    stats["shards"] = [{"path": os.path.basename(path), "examples": count} for path, count in shards]
+    stats["examples"] = sum(count for _, count in shards)
+    with open(os.path.join(out_dir, "stats.json"), "w", encoding="utf-8") as f:
+        json.dump(stats, f, indent=2)
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build an SFT dataset from the interaction log")
+    parser.add_argument("--input", nargs="*", help="log files (default: training_data.jsonl and its rotations)")
+    parser.add_argument("--out", default="dataset")
+    parser.add_argument("--format", choices=("jsonl", "parquet"), default="jsonl")
+    parser.add_argument("--shard-size", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--db", default="chat_history.db", help="chat history to join (skipped if missing)")
+    parser.add_argument("--history-messages", type=int, default=6, help="earlier messages to include per example")
+    parser.add_argument("--no-near-dedup", action="store_true")
+    args = parser.parse_args()
+
+    if args.format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            sys.exit("Parquet output needs pyarrow: pip install pyarrow")
+
+    paths = args.input or default_inputs()
+    if not paths:
+        sys.exit(f"No logs found (looked for {LOG_FILE} and its rotations)")
+
+    start = time.perf_counter()
+    stats = build(paths, args.out, args.format, args.shard_size, args.workers, args.db,
+                  args.history_messages, not args.no_near_dedup)
+    print(f"{stats['examples']} examples in {len(stats['shards'])} shards -> {args.out} "
+          f"({time.perf_counter() - start:.1f}s, {stats['malformed']} malformed lines)")
+    print(f"{'model':<20} {'read':>7} {'kept':>7} {'errors':>7} {'exact':>7} {'near':>7} {'history':>8}")
+    for model, s in sorted(stats["models"].items()):
+        print(f"{model:<20} {s['read']:>7} {s['kept']:>7} {s['errors']:>7} "
+              f"{s['exact_duplicates']:>7} {s['near_duplicates']:>7} {s['with_history']:>8}")
@@ -0,0 +1,46 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# FastAPI handlers are async, but Ollama, Hugging Face, sqlite3 and the document
+# parsers are all blocking libraries. Running them directly inside a handler
+# freezes the event loop for every other request on the worker, so they are
+# pushed onto bounded thread pools instead.
+#
+# Two pools so that a burst of slow generations can't starve quick DB/file work:
+# - model pool: long-running inference calls (seconds to minutes each)
+# - io pool: SQLite queries, document extraction, upload writes (milliseconds)
+# A third, small pool runs password hashing: scrypt is deliberately slow and
+# memory hungry, so a login burst is capped at HASH_WORKERS hashes at a time.
+MODEL_WORKERS = int(os.getenv("MODEL_WORKERS", "8"))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "16"))
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+
+model_executor = ThreadPoolExecutor(max_workers=MODEL_WORKERS, thread_name_prefix="model")
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash")
+
+async def _run_in(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Carry context variables (e.g. the request id used in logs) into the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, func, *args, **kwargs))
+
+async def run_model_call(func, *args, **kwargs):
+    """Runs a blocking inference call (ollama / InferenceClient) off the event loop."""
+    return await _run_in(model_executor, func, *args, **kwargs)
+
+async def run_io(func, *args, **kwargs):
+    """Runs blocking DB or file work off the event loop."""
+    return await _run_in(io_executor, func, *args, **kwargs)
+
+async def run_password_hash(func, *args, **kwargs):
+    """Runs password hashing/verification off the event loop."""
+    return await _run_in(hash_executor, func, *args, **kwargs)
+
+def shutdown_executors():
+    model_executor.shutdown(wait=False, cancel_futures=True)
+    io_executor.shutdown(wait=False, cancel_futures=True)
+    hash_executor.shutdown(wait=False, cancel_futures=True)
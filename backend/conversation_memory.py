@@ -0,0 +1,154 @@
+import threading
+
+from database import get_messages, get_messages_between, get_session_summary, save_session_summary
+from local_client import DEFAULT_MODEL, context_limit
+from scheduler import scheduler
+from ollama_pool import pool
+import model_manager
+
+# Conversation memory
+# -------------------
+# Sits between database.get_messages and the model call. Each request gets:
+#   [summary of older turns (system message)] + [recent turns] + [new prompt]
+# sized to the selected model's context window.
+#
+# Recent turns are taken newest-first until the history budget runs out.
+# Turns that have aged out of the recent window are folded into a rolling
+# per-session summary (session_summaries table). The summary is refreshed in
+# the background after a reply, incrementally: only messages newer than the
+# last summarized id are sent, together with the previous summary. Each
+# refresh folds in at most SUMMARY_MAX_BATCH_MESSAGES (and what fits the
+# summarizer's context); a long backlog, e.g. the first refresh of an old
+# session, is worked off over the following turns. A refresh yields to
+# users: it only runs when the summary model has a free slot and nothing is
+# queued (scheduler.background_slot), otherwise it waits for a later turn.
+
+# Rough token estimate; good enough for budgeting without loading a tokenizer
+CHARS_PER_TOKEN = 4
+# Per-message overhead of the chat template (role markers etc.)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Tokens kept free for the model's reply
+REPLY_RESERVE_TOKENS = 1024
+# At most this many recent messages are loaded from the DB per request
+MAX_HISTORY_MESSAGES = 40
+# The summary may use at most this share of the history budget
+SUMMARY_BUDGET_SHARE = 0.25
+
+# Messages that always stay verbatim (never summarized)
+KEEP_RECENT_MESSAGES = 12
+# Don't call the summarizer for fewer newly aged-out messages than this
+SUMMARY_MIN_NEW_MESSAGES = 6
+SUMMARY_MODEL = DEFAULT_MODEL
+SUMMARY_MAX_MESSAGE_CHARS = 2000
+SUMMARY_MAX_BATCH_MESSAGES = 40
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def _as_chat_message(msg):
+    role = "assistant" if msg["role"] == "model" else "user"
+    return {"role": role, "content": msg["content"]}
+
+def build_history(session_id: str, model: str, prompt: str):
+    """
+    Returns the earlier turns of a session as Ollama chat messages, fitted to
+    the model's context window after reserving room for the prompt and reply.
+    """
+    budget = context_limit(model) - REPLY_RESERVE_TOKENS - estimate_tokens(prompt)
+    if budget <= 0:
+        return []
+
+    history = []
+    covered_until_id = 0
+    summary = get_session_summary(session_id)
+    if summary:
+        summary_text = f"Summary of the earlier conversation:\n{summary['summary']}"
+        cost = estimate_tokens(summary_text) + MESSAGE_OVERHEAD_TOKENS
+        if cost <= budget * SUMMARY_BUDGET_SHARE:
+            history.append({"role": "system", "content": summary_text})
+            budget -= cost
+            covered_until_id = summary["covered_until_id"]
+
+    recent = []
+    for msg in reversed(get_messages(session_id, limit=MAX_HISTORY_MESSAGES)):
+        if msg["id"] <= covered_until_id:
+            break  # already part of the summary
+        cost = estimate_tokens(msg["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if cost > budget:
+            break
+        recent.append(_as_chat_message(msg))
+        budget -= cost
+    recent.reverse()
+    return history + recent
+
+def _format_transcript(messages):
+    lines = []
+    for msg in messages:
+        speaker = "Assistant" if msg["role"] == "model" else "User"
+        lines.append(f"{speaker}: {msg['content'][:SUMMARY_MAX_MESSAGE_CHARS]}")
+    return "\n".join(lines)
+
+def _fit_batch(messages, budget):
+    """The oldest messages whose transcript fits the token budget (always at least one)."""
+    used = 0
+    for count, msg in enumerate(messages):
+        used += estimate_tokens(msg["content"][:SUMMARY_MAX_MESSAGE_CHARS]) + MESSAGE_OVERHEAD_TOKENS
+        if used > budget and count:
+            return messages[:count]
+    return messages
+
+def refresh_summary(session_id: str):
+    """
+    Folds messages that have left the recent window into the session's rolling
+    summary. Cheap no-op unless enough new messages have aged out.
+    Meant to run off the request path (after the reply has been sent).
+    """
+    with _refreshing_lock:
+        if session_id in _refreshing:
+            return
+        _refreshing.add(session_id)
+
+    try:
+        recent = get_messages(session_id, limit=KEEP_RECENT_MESSAGES)
+        if len(recent) < KEEP_RECENT_MESSAGES:
+            return
+        summary = get_session_summary(session_id)
+        covered_until_id = summary["covered_until_id"] if summary else 0
+        aged_out = get_messages_between(session_id, covered_until_id, recent[0]["id"],
+                                        limit=SUMMARY_MAX_BATCH_MESSAGES)
+        if len(aged_out) < SUMMARY_MIN_NEW_MESSAGES:
+            return
+
+        instructions = ("Summarize this conversation between a user and an assistant in a few short "
+                        "paragraphs. Keep names, facts, decisions and open questions; drop small talk.")
+        content = ""
+        if summary:
+            content += f"Summary so far:\n{summary['summary']}\n\nNew messages:\n"
+        aged_out = _fit_batch(aged_out, context_limit(SUMMARY_MODEL) - REPLY_RESERVE_TOKENS
+                              - estimate_tokens(instructions + content))
+        content += _format_transcript(aged_out)
+
+        with scheduler.background_slot(SUMMARY_MODEL) as acquired:
+            if not acquired:
+                # Users are waiting for the model; a later turn's refresh catches up
+                return
+            print(f"--- Summarizing {len(aged_out)} older messages with {SUMMARY_MODEL} ---")
+            with model_manager.in_use(SUMMARY_MODEL) as keep_alive:
+                response = pool.chat(
+                    model=SUMMARY_MODEL,
+                    messages=[
+                        {"role": "system", "content": instructions},
+                        {"role": "user", "content": content},
+                    ],
+                    options={"num_ctx": context_limit(SUMMARY_MODEL)},
+                    keep_alive=keep_alive
+                )
+        save_session_summary(session_id, response["message"]["content"].strip(), aged_out[-1]["id"])
+    except Exception as e:
+        print(f"Error refreshing summary for {session_id}: {str(e)}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(session_id)
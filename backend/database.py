@@ -1,11 +1,71 @@
 import sqlite3
 import json
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
 DB_NAME = "chat_history.db"
 
+# Connection layer
+# ----------------
+# Handlers run their DB work on a fixed set of worker threads (see
+# concurrency.py), so each thread keeps one long-lived connection instead of
+# paying connect/close on every call. Connections stay open for the life of
+# the process, which also means sqlite3's per-connection statement cache keeps
+# our queries prepared between requests.
+STATEMENT_CACHE_SIZE = 256
+
+# WAL lets readers (history/session lists) proceed while a chat turn is being
+# written. synchronous=NORMAL is durable across app crashes in WAL mode and
+# only risks the last transaction on power loss, which is fine for chat logs.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",  # ~16 MB page cache per connection
+    "PRAGMA mmap_size=134217728",  # 128 MB
+)
+
+_local = threading.local()
+_all_connections = []
+_connections_lock = threading.Lock()
+
+def _open_connection():
+    conn = sqlite3.connect(DB_NAME, cached_statements=STATEMENT_CACHE_SIZE,
+                           check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def get_connection():
+    """Returns this thread's persistent connection, opening it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "db_name", None) != DB_NAME:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.db_name = DB_NAME
+        with _connections_lock:
+            _all_connections.append(conn)
+    return conn
+
+@contextmanager
+def transaction():
+    """Yields a cursor inside a single transaction (commit on success, rollback on error)."""
+    conn = get_connection()
+    with conn:
+        yield conn.cursor()
+
+def close_connections():
+    """Closes every pooled connection. Called on app shutdown."""
+    with _connections_lock:
+        while _all_connections:
+            _all_connections.pop().close()
+    _local.__dict__.clear()
+
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     c = conn.cursor()
     
     # Create sessions table
@@ -53,57 +113,253 @@ def init_db():
     ''')
 
     conn.commit()
-    conn.close()
+
+    run_migrations(conn)
+
+# Schema migrations
+# -----------------
+# Applied in order on startup; PRAGMA user_version records how many have run,
+# so each one executes exactly once per database file. Append new migrations
+# to the end of MIGRATIONS, never reorder or edit shipped ones.
+
+def _migration_history_indexes(c):
+    # History loads and "last message" lookups filter on session_id and walk
+    # by id, which is also the keyset pagination cursor.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages(session_id, id)")
+    # Session list is newest-first, paginated on (created_at, id)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions(created_at, id)")
+
+def _migration_session_summaries(c):
+    # Rolling summary of the turns that no longer fit the model's context,
+    # covering every message up to and including covered_until_id.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS session_summaries (
+            session_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covered_until_id INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def _migration_message_search(c):
+    # Full-text index over message content. External-content FTS5 table, so
+    # the text isn't stored twice; triggers keep it in sync with messages and
+    # 'rebuild' backfills everything written before this migration.
+    c.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='id', tokenize='porter unicode61'
+        )
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    c.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+def _migration_session_owners(c):
+    # Sessions belong to a user. Sessions created before this have no owner
+    # and aren't listed for anyone.
+    columns = [row[1] for row in c.execute("PRAGMA table_info(sessions)")]
+    if "user_id" not in columns:
+        c.execute("ALTER TABLE sessions ADD COLUMN user_id TEXT REFERENCES users(id)")
+    # A user's session list is a range scan on this index, whatever the total
+    # number of users/sessions
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user_created ON sessions(user_id, created_at, id)")
+    # Bearer tokens handed out by /login, stored as sha256 so a leaked DB
+    # doesn't leak usable tokens
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS auth_tokens (
+            token_hash TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL REFERENCES users(id),
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_auth_tokens_user ON auth_tokens(user_id)")
+
+def _migration_upload_store(c):
+    # Uploaded files are stored once per distinct content (blobs, named by
+    # sha256 + extension) and referenced by per-user uploads with stable ids.
+    # released_at is set when a blob's refcount drops to zero, so garbage
+    # collection can leave a grace period before deleting the file.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            name TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            released_at REAL
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_blobs_released ON blobs(released_at) WHERE refcount = 0")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL REFERENCES users(id),
+            filename TEXT NOT NULL,
+            blob TEXT NOT NULL REFERENCES blobs(name),
+            size INTEGER NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_uploads_user ON uploads(user_id, blob)")
+    # Chunked uploads in progress; the bytes so far live in uploads/partial/
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL REFERENCES users(id),
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions(updated_at)")
+
+def _migration_legacy_session_owner(c):
+    # Sessions from before migration 4 have no owner. With a single account
+    # there's no doubt whose they are; otherwise they wait to be claimed by
+    # LEGACY_SESSIONS_OWNER (see claim_unowned_sessions).
+    users = c.execute("SELECT id FROM users LIMIT 2").fetchall()
+    if len(users) == 1:
+        c.execute("UPDATE sessions SET user_id = ? WHERE user_id IS NULL", (users[0][0],))
+
+MIGRATIONS = [
+    _migration_history_indexes,
+    _migration_session_summaries,
+    _migration_message_search,
+    _migration_session_owners,
+    _migration_upload_store,
+    _migration_legacy_session_owner,
+]
+
+def get_schema_version(conn=None):
+    conn = conn or get_connection()
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def run_migrations(conn):
+    version = get_schema_version(conn)
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(f"Applying schema migration {number}: {migration.__name__}")
+        # DDL doesn't open an implicit transaction in sqlite3, so do it explicitly
+        # to keep each migration and its version bump atomic.
+        conn.execute("BEGIN")
+        try:
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+# Page sizes for the history endpoints
+DEFAULT_PAGE_SIZE = 50
+DEFAULT_MESSAGE_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 500
+
+def clamp_page_size(limit, default=DEFAULT_PAGE_SIZE):
+    if limit is None:
+        return default
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
 
 def create_user(user_id, username, password_hash):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
     try:
-        c.execute("INSERT INTO users (id, username, password_hash) VALUES (?, ?, ?)", 
-                  (user_id, username, password_hash))
-        conn.commit()
+        with transaction() as c:
+            c.execute("INSERT INTO users (id, username, password_hash) VALUES (?, ?, ?)", 
+                      (user_id, username, password_hash))
         return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
 
 def get_user_by_username(username):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE username = ?", (username,))
+    c = get_connection().execute("SELECT * FROM users WHERE username = ?", (username,))
     user = c.fetchone()
-    conn.close()
     return dict(user) if user else None
 
-def create_session(session_id, title="New Chat"):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("INSERT INTO sessions (id, title) VALUES (?, ?)", (session_id, title))
-    conn.commit()
-    conn.close()
+def update_password_hash(user_id, password_hash):
+    with transaction() as c:
+        c.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
 
-def get_sessions():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM sessions ORDER BY created_at DESC")
-    rows = c.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+def get_user_by_id(user_id):
+    c = get_connection().execute("SELECT * FROM users WHERE id = ?", (user_id,))
+    user = c.fetchone()
+    return dict(user) if user else None
+
+def create_auth_token(token_hash, user_id, expires_at):
+    with transaction() as c:
+        c.execute("INSERT INTO auth_tokens (token_hash, user_id, expires_at) VALUES (?, ?, ?)",
+                  (token_hash, user_id, expires_at))
+
+def get_auth_token(token_hash):
+    c = get_connection().execute("SELECT * FROM auth_tokens WHERE token_hash = ?", (token_hash,))
+    row = c.fetchone()
+    return dict(row) if row else None
+
+def delete_auth_token(token_hash):
+    with transaction() as c:
+        c.execute("DELETE FROM auth_tokens WHERE token_hash = ?", (token_hash,))
+
+def delete_expired_auth_tokens(now):
+    with transaction() as c:
+        c.execute("DELETE FROM auth_tokens WHERE expires_at < ?", (now,))
+
+def create_session(session_id, title="New Chat", user_id=None):
+    with transaction() as c:
+        c.execute("INSERT INTO sessions (id, title, user_id) VALUES (?, ?, ?)", (session_id, title, user_id))
+
+def get_session(session_id):
+    c = get_connection().execute("SELECT * FROM sessions WHERE id = ?", (session_id,))
+    row = c.fetchone()
+    return dict(row) if row else None
+
+def count_user_sessions(user_id):
+    c = get_connection().execute("SELECT COUNT(*) FROM sessions WHERE user_id = ?", (user_id,))
+    return c.fetchone()[0]
+
+def count_unowned_sessions():
+    c = get_connection().execute("SELECT COUNT(*) FROM sessions WHERE user_id IS NULL")
+    return c.fetchone()[0]
+
+def claim_unowned_sessions(user_id):
+    """Gives every session without an owner (created before accounts had sessions) to the user."""
+    with transaction() as c:
+        return c.execute("UPDATE sessions SET user_id = ? WHERE user_id IS NULL", (user_id,)).rowcount
+
+def get_sessions(user_id, before_id=None, limit=None):
+    """
+    A user's sessions, newest first. With limit set, returns one keyset page:
+    pass the id of the last session of a page as before_id to get the next.
+    """
+    sql = "SELECT * FROM sessions WHERE user_id = ?"
+    params = [user_id]
+    if before_id:
+        sql += " AND (created_at, id) < (SELECT created_at, id FROM sessions WHERE id = ?)"
+        params.append(before_id)
+    sql += " ORDER BY created_at DESC, id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    c = get_connection().execute(sql, params)
+    return [dict(row) for row in c.fetchall()]
 
 def delete_session(session_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
-    c.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        c.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+        c.execute("DELETE FROM session_summaries WHERE session_id = ?", (session_id,))
+        c.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
 
-def add_message(session_id, role, content, msg_type="text"):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+def _insert_message(c, session_id, role, content, msg_type="text"):
     c.execute("INSERT INTO messages (session_id, role, content, type) VALUES (?, ?, ?, ?)", 
               (session_id, role, content, msg_type))
     msg_id = c.lastrowid
@@ -113,32 +369,222 @@ def add_message(session_id, role, content, msg_type="text"):
         # Check if it's the first message or query simply
         c.execute("UPDATE sessions SET title = ? WHERE id = ? AND title = 'New Chat'", 
                   (content[:30] + "..." if len(content) > 30 else content, session_id))
-                  
-    conn.commit()
-    conn.close()
     return msg_id
 
-def get_messages(session_id):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM messages WHERE session_id = ? ORDER BY timestamp ASC", (session_id,))
-    rows = c.fetchall()
-    conn.close()
-    return [dict(row) for row in rows]
+def add_message(session_id, role, content, msg_type="text"):
+    with transaction() as c:
+        return _insert_message(c, session_id, role, content, msg_type)
+
+def add_chat_turn(session_id, user_content, bot_content, msg_type="text"):
+    """
+    Stores a whole chat turn (user message, bot reply and the session title
+    update) in one transaction. Returns (user_msg_id, bot_msg_id).
+    """
+    with transaction() as c:
+        user_msg_id = _insert_message(c, session_id, "user", user_content, msg_type)
+        bot_msg_id = _insert_message(c, session_id, "model", bot_content, msg_type)
+    return user_msg_id, bot_msg_id
+
+def add_messages(rows):
+    """
+    Batched insert for (session_id, role, content, type) rows, e.g. imports or
+    replays. One transaction and one executemany for the whole batch.
+    """
+    rows = list(rows)
+    with transaction() as c:
+        c.executemany("INSERT INTO messages (session_id, role, content, type) VALUES (?, ?, ?, ?)", rows)
+        for session_id, role, content, _ in rows:
+            if role == "user":
+                c.execute("UPDATE sessions SET title = ? WHERE id = ? AND title = 'New Chat'", 
+                          (content[:30] + "..." if len(content) > 30 else content, session_id))
+    return len(rows)
+
+def get_messages(session_id, before_id=None, limit=None):
+    """
+    Messages of a session in chronological order. With limit set, returns the
+    latest `limit` messages older than before_id (keyset on the message id);
+    pass the id of the first message of a page as before_id to load older ones.
+    """
+    if limit is None and before_id is None:
+        c = get_connection().execute("SELECT * FROM messages WHERE session_id = ? ORDER BY id ASC", (session_id,))
+        return [dict(row) for row in c.fetchall()]
+
+    sql = "SELECT * FROM messages WHERE session_id = ?"
+    params = [session_id]
+    if before_id is not None:
+        sql += " AND id < ?"
+        params.append(before_id)
+    sql += " ORDER BY id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    c = get_connection().execute(sql, params)
+    rows = [dict(row) for row in c.fetchall()]
+    rows.reverse()
+    return rows
+
+def get_messages_between(session_id, after_id, before_id, limit=None):
+    """Messages with after_id < id < before_id, oldest first (the first limit of them, if set)."""
+    sql = "SELECT * FROM messages WHERE session_id = ? AND id > ? AND id < ? ORDER BY id ASC"
+    params = [session_id, after_id, before_id]
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    c = get_connection().execute(sql, params)
+    return [dict(row) for row in c.fetchall()]
+
+def get_session_summary(session_id):
+    c = get_connection().execute("SELECT * FROM session_summaries WHERE session_id = ?", (session_id,))
+    row = c.fetchone()
+    return dict(row) if row else None
+
+def save_session_summary(session_id, summary, covered_until_id):
+    with transaction() as c:
+        c.execute('''
+            INSERT INTO session_summaries (session_id, summary, covered_until_id, updated_at)
+            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(session_id) DO UPDATE SET
+                summary = excluded.summary,
+                covered_until_id = excluded.covered_until_id,
+                updated_at = excluded.updated_at
+        ''', (session_id, summary, covered_until_id))
+
+def update_message_content(msg_id, content):
+    with transaction() as c:
+        c.execute("UPDATE messages SET content = ? WHERE id = ?", (content, msg_id))
 
 def delete_message(msg_id):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        c.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
+
+def _fts_query(text):
+    """
+    Turns free text into an FTS5 query: every word must match, the last one as
+    a prefix (search-as-you-type). Words are quoted so FTS syntax in user
+    input (AND, NEAR, quotes, colons) is treated as plain text.
+    """
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+def search_messages(text, user_id, session_id=None, limit=DEFAULT_PAGE_SIZE, offset=0):
+    """
+    Ranked full-text search over a user's messages (best match first, bm25).
+    Each hit has the message id, session id/title, role, timestamp and a
+    snippet with the matches wrapped in <mark></mark>. Optionally scoped to
+    one session.
+    """
+    query = _fts_query(text)
+    if query is None:
+        return []
+    sql = '''
+        SELECT m.id, m.session_id, s.title AS session_title, m.role, m.type, m.timestamp,
+               snippet(messages_fts, 0, '<mark>', '</mark>', '…', 16) AS snippet,
+               bm25(messages_fts) AS rank
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN sessions s ON s.id = m.session_id
+        WHERE messages_fts MATCH ? AND s.user_id = ?
+    '''
+    params = [query, user_id]
+    if session_id:
+        sql += " AND m.session_id = ?"
+        params.append(session_id)
+    sql += " ORDER BY rank LIMIT ? OFFSET ?"
+    params += [limit, offset]
+    c = get_connection().execute(sql, params)
+    return [dict(row) for row in c.fetchall()]
+
+def is_image_referenced(filename):
+    """Whether any stored message still links to /images/<filename>."""
+    # The FTS phrase narrows it down to messages with the name's tokens; instr confirms the exact link
+    c = get_connection().execute('''
+        SELECT 1 FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+        WHERE messages_fts MATCH ? AND instr(m.content, ?) > 0 LIMIT 1
+    ''', ('"' + filename.replace('"', '""') + '"', f"/images/{filename}"))
+    return c.fetchone() is not None
 
 def get_last_message_id(session_id, role="user"):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT id FROM messages WHERE session_id = ? AND role = ? ORDER BY id DESC LIMIT 1", (session_id, role))
+    c = get_connection().execute("SELECT id FROM messages WHERE session_id = ? AND role = ? ORDER BY id DESC LIMIT 1", (session_id, role))
     result = c.fetchone()
-    conn.close()
     return result[0] if result else None
 
+# Uploads
+
+def add_upload(upload_id, user_id, filename, blob_name, size):
+    """Records an upload and takes a reference on its blob, creating the blob row if needed."""
+    with transaction() as c:
+        c.execute('''
+            INSERT INTO blobs (name, size, refcount) VALUES (?, ?, 1)
+            ON CONFLICT(name) DO UPDATE SET refcount = refcount + 1, released_at = NULL
+        ''', (blob_name, size))
+        c.execute("INSERT INTO uploads (id, user_id, filename, blob, size) VALUES (?, ?, ?, ?, ?)",
+                  (upload_id, user_id, filename, blob_name, size))
+
+def get_upload(upload_id):
+    c = get_connection().execute("SELECT * FROM uploads WHERE id = ?", (upload_id,))
+    row = c.fetchone()
+    return dict(row) if row else None
+
+def get_user_uploads(user_id):
+    c = get_connection().execute("SELECT * FROM uploads WHERE user_id = ? ORDER BY created_at DESC, id", (user_id,))
+    return [dict(row) for row in c.fetchall()]
+
+def find_user_upload(user_id, blob_name):
+    c = get_connection().execute("SELECT * FROM uploads WHERE user_id = ? AND blob = ? LIMIT 1",
+                                 (user_id, blob_name))
+    row = c.fetchone()
+    return dict(row) if row else None
+
+def get_user_upload_bytes(user_id):
+    c = get_connection().execute("SELECT COALESCE(SUM(size), 0) FROM uploads WHERE user_id = ?", (user_id,))
+    return c.fetchone()[0]
+
+def delete_upload(upload_id, now):
+    """Removes an upload and drops its blob reference. Returns the blob name, or None."""
+    with transaction() as c:
+        row = c.execute("SELECT blob FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+        if not row:
+            return None
+        c.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+        c.execute('''
+            UPDATE blobs SET refcount = refcount - 1,
+                released_at = CASE WHEN refcount - 1 <= 0 THEN ? ELSE NULL END
+            WHERE name = ?
+        ''', (now, row["blob"]))
+        return row["blob"]
+
+def get_released_blobs(before):
+    c = get_connection().execute("SELECT name FROM blobs WHERE refcount = 0 AND released_at < ?", (before,))
+    return [row["name"] for row in c.fetchall()]
+
+def delete_blob_if_unreferenced(blob_name):
+    """Deletes the blob row if nothing references it any more. Returns True if it was deleted."""
+    with transaction() as c:
+        c.execute("DELETE FROM blobs WHERE name = ? AND refcount <= 0", (blob_name,))
+        return c.rowcount > 0
+
+def create_upload_session(session_id, user_id, filename, size, now):
+    with transaction() as c:
+        c.execute("INSERT INTO upload_sessions (id, user_id, filename, size, updated_at) VALUES (?, ?, ?, ?, ?)",
+                  (session_id, user_id, filename, size, now))
+
+def get_upload_session(session_id):
+    c = get_connection().execute("SELECT * FROM upload_sessions WHERE id = ?", (session_id,))
+    row = c.fetchone()
+    return dict(row) if row else None
+
+def update_upload_session(session_id, received, now):
+    with transaction() as c:
+        c.execute("UPDATE upload_sessions SET received = ?, updated_at = ? WHERE id = ?", (received, now, session_id))
+
+def delete_upload_session(session_id):
+    with transaction() as c:
+        c.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+
+def get_stale_upload_sessions(before):
+    c = get_connection().execute("SELECT id FROM upload_sessions WHERE updated_at < ?", (before,))
+    return [row["id"] for row in c.fetchall()]
@@ -1,43 +1,161 @@
 import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import pypdf
 import docx
 from pptx import Presentation
 
-def extract_text_from_file(file_path: str) -> str:
+# Bump whenever extraction output changes, so cached extractions are redone
+EXTRACTOR_VERSION = 1
+
+SUPPORTED_EXTENSIONS = (".pdf", ".docx", ".pptx", ".txt")
+
+# Per-file limits, so one huge upload can't pin a worker's memory
+MAX_FILE_BYTES = int(os.getenv("MAX_DOCUMENT_BYTES", str(50 * 1024 * 1024)))
+MAX_PAGES = int(os.getenv("MAX_DOCUMENT_PAGES", "1000"))  # PDF pages / PPTX slides
+MAX_TEXT_CHARS = int(os.getenv("MAX_DOCUMENT_CHARS", str(5 * 1024 * 1024)))
+
+# Large PDFs are split into page ranges and extracted in a process pool
+# (pypdf is pure Python, so threads wouldn't run pages in parallel).
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PARALLEL_PDF_MIN_PAGES = 40
+PDF_PAGES_PER_TASK = 16
+TXT_READ_CHARS = 1024 * 1024
+
+class UnsupportedFormatError(ValueError):
+    pass
+
+class DocumentTooLargeError(ValueError):
+    pass
+
+def is_supported(file_path: str) -> bool:
+    return os.path.splitext(file_path)[1].lower() in SUPPORTED_EXTENSIONS
+
+def iter_document(file_path: str):
+    """
+    Yields a document's text piece by piece (pages, slides, paragraphs), so
+    callers can stop early or process it without holding the whole parse.
+    Enforces MAX_FILE_BYTES up front and MAX_TEXT_CHARS while streaming.
+    Raises on unsupported or unreadable files.
+    """
     ext = os.path.splitext(file_path)[1].lower()
-    
+    if ext not in SUPPORTED_EXTENSIONS:
+        raise UnsupportedFormatError(ext)
+
+    size = os.path.getsize(file_path)
+    if size > MAX_FILE_BYTES:
+        raise DocumentTooLargeError(f"{os.path.basename(file_path)} is {size} bytes, limit is {MAX_FILE_BYTES}")
+
+    if ext == ".pdf":
+        pieces = iter_pdf_pages(file_path)
+    elif ext == ".docx":
+        pieces = iter_docx_paragraphs(file_path)
+    elif ext == ".pptx":
+        pieces = iter_pptx_slides(file_path)
+    else:
+        pieces = iter_txt(file_path)
+
+    remaining = MAX_TEXT_CHARS
+    for piece in pieces:
+        if len(piece) > remaining:
+            yield piece[:remaining]
+            yield f"\n[Truncated: text limit of {MAX_TEXT_CHARS} characters reached]\n"
+            pieces.close()
+            return
+        remaining -= len(piece)
+        yield piece
+
+def extract_text(file_path: str) -> str:
+    """Extracts the text of a document. Raises on unsupported or unreadable files."""
+    return "".join(iter_document(file_path))
+
+def extract_text_from_file(file_path: str) -> str:
     try:
-        if ext == ".pdf":
-            return extract_pdf(file_path)
-        elif ext == ".docx":
-            return extract_docx(file_path)
-        elif ext == ".pptx":
-            return extract_pptx(file_path)
-        elif ext == ".txt":
-            with open(file_path, "r", encoding="utf-8") as f:
-                return f.read()
-        else:
-            return "Unsupported file format."
+        return extract_text(file_path)
+    except UnsupportedFormatError:
+        return "Unsupported file format."
     except Exception as e:
         return f"Error reading file: {str(e)}"
 
-def extract_pdf(file_path):
-    text = ""
+_pdf_pool = None
+
+def _get_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is None:
+        # spawn: forking a process that already runs thread pools isn't safe
+        _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+    return _pdf_pool
+
+def shutdown_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+
+def _extract_pdf_range(file_path, start, stop):
+    """Worker-side: extracts pages [start, stop) of a PDF."""
     with open(file_path, "rb") as f:
         reader = pypdf.PdfReader(f)
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-    return text
+        return [reader.pages[i].extract_text() + "\n" for i in range(start, stop)]
 
-def extract_docx(file_path):
+def iter_pdf_pages(file_path):
+    with open(file_path, "rb") as f:
+        reader = pypdf.PdfReader(f)
+        page_count = len(reader.pages)
+        limit = min(page_count, MAX_PAGES)
+
+        if limit < PARALLEL_PDF_MIN_PAGES or PDF_WORKERS < 2:
+            for i in range(limit):
+                yield reader.pages[i].extract_text() + "\n"
+        else:
+            yield from _iter_pdf_pages_parallel(file_path, limit)
+
+    if page_count > MAX_PAGES:
+        yield f"[Truncated: {page_count} pages, only the first {MAX_PAGES} were read]\n"
+
+def _iter_pdf_pages_parallel(file_path, page_count):
+    pool = _get_pdf_pool()
+    ranges = deque((start, min(start + PDF_PAGES_PER_TASK, page_count))
+                   for start in range(0, page_count, PDF_PAGES_PER_TASK))
+    # Only a couple of ranges per worker in flight, so finished pages don't
+    # pile up in memory faster than the caller consumes them
+    in_flight = deque()
+    try:
+        while ranges or in_flight:
+            while ranges and len(in_flight) < PDF_WORKERS * 2:
+                start, stop = ranges.popleft()
+                in_flight.append(pool.submit(_extract_pdf_range, file_path, start, stop))
+            yield from in_flight.popleft().result()
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+def iter_docx_paragraphs(file_path):
     doc = docx.Document(file_path)
-    return "\n".join([para.text for para in doc.paragraphs])
+    for i, para in enumerate(doc.paragraphs):
+        yield para.text if i == 0 else "\n" + para.text
 
-def extract_pptx(file_path):
+def iter_pptx_slides(file_path):
     prs = Presentation(file_path)
-    text = ""
-    for slide in prs.slides:
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                text += shape.text + "\n"
-    return text
+    for number, slide in enumerate(prs.slides):
+        if number >= MAX_PAGES:
+            yield f"[Truncated: only the first {MAX_PAGES} slides were read]\n"
+            return
+        yield "".join(shape.text + "\n" for shape in slide.shapes if hasattr(shape, "text"))
+
+def iter_txt(file_path):
+    with open(file_path, "r", encoding="utf-8") as f:
+        for chunk in iter(lambda: f.read(TXT_READ_CHARS), ""):
+            yield chunk
+
+# Whole-document helpers, kept for callers that want one string
+def extract_pdf(file_path):
+    return "".join(iter_pdf_pages(file_path))
+
+def extract_docx(file_path):
+    return "".join(iter_docx_paragraphs(file_path))
+
+def extract_pptx(file_path):
+    return "".join(iter_pptx_slides(file_path))
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from document_processor import EXTRACTOR_VERSION, UnsupportedFormatError, extract_text
+import metrics
+
+# Two-tier cache for extracted document text, so a PDF attached to twenty
+# follow-up questions is parsed once instead of on every /chat call.
+#
+# Keys are (sha256 of the file content, EXTRACTOR_VERSION): renaming or
+# re-uploading the same bytes hits the cache, and changing the extractor
+# invalidates old entries automatically.
+#
+# - memory tier: small LRU of recently used texts, bounded by characters
+# - disk tier: SQLite file, bounded by total bytes, evicted least-recently-used
+
+CACHE_DB = os.getenv("EXTRACTION_CACHE_DB", "extraction_cache.db")
+DISK_MAX_BYTES = int(os.getenv("EXTRACTION_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+MEMORY_MAX_CHARS = int(os.getenv("EXTRACTION_CACHE_MEMORY_CHARS", str(16 * 1024 * 1024)))
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_MEMO_SIZE = 4096
+
+_lock = threading.Lock()
+_conn = None
+_memory = OrderedDict()
+_memory_chars = 0
+# (path, size, mtime) -> content hash, so unchanged files aren't re-hashed every turn
+_hash_memo = {}
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(CACHE_DB, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.execute('''
+            CREATE TABLE IF NOT EXISTS extractions (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_extractions_last_used ON extractions(last_used)")
+        _conn.commit()
+    return _conn
+
+def file_hash(file_path: str) -> str:
+    stat = os.stat(file_path)
+    memo_key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    cached = _hash_memo.get(memo_key)
+    if cached:
+        return cached
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    content_hash = digest.hexdigest()
+    if len(_hash_memo) >= HASH_MEMO_SIZE:
+        _hash_memo.clear()
+    _hash_memo[memo_key] = content_hash
+    return content_hash
+
+def cache_key(file_path: str) -> str:
+    return f"{file_hash(file_path)}:v{EXTRACTOR_VERSION}"
+
+def _memory_get(key):
+    text = _memory.get(key)
+    if text is not None:
+        _memory.move_to_end(key)
+    return text
+
+def _memory_put(key, text):
+    global _memory_chars
+    if len(text) > MEMORY_MAX_CHARS:
+        return
+    if key in _memory:
+        _memory_chars -= len(_memory.pop(key))
+    _memory[key] = text
+    _memory_chars += len(text)
+    while _memory_chars > MEMORY_MAX_CHARS:
+        _, evicted = _memory.popitem(last=False)
+        _memory_chars -= len(evicted)
+
+def _disk_get(key):
+    conn = _get_conn()
+    row = conn.execute("SELECT text FROM extractions WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    conn.execute("UPDATE extractions SET last_used = ? WHERE key = ?", (time.time(), key))
+    conn.commit()
+    return row[0]
+
+def _disk_put(key, text):
+    conn = _get_conn()
+    size = len(text.encode("utf-8"))
+    if size > DISK_MAX_BYTES:
+        return
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO extractions (key, text, size, last_used) VALUES (?, ?, ?, ?)",
+                     (key, text, size, time.time()))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM extractions").fetchone()[0]
+        # Evict least recently used entries until we're back under budget
+        while total > DISK_MAX_BYTES:
+            oldest = conn.execute("SELECT key, size FROM extractions ORDER BY last_used ASC LIMIT 1").fetchone()
+            if oldest is None or oldest[0] == key:
+                break
+            conn.execute("DELETE FROM extractions WHERE key = ?", (oldest[0],))
+            total -= oldest[1]
+
+def get_extracted_text(file_path: str) -> str:
+    """
+    Cached replacement for document_processor.extract_text_from_file.
+    Failed extractions return the same error strings and are not cached.
+    """
+    try:
+        return load_extracted_text(file_path)
+    except UnsupportedFormatError:
+        return "Unsupported file format."
+    except Exception as e:
+        return f"Error reading file: {str(e)}"
+
+def load_extracted_text(file_path: str) -> str:
+    """Like get_extracted_text, but raises on unsupported or unreadable files instead of returning the error."""
+    key = cache_key(file_path)
+    with _lock:
+        text = _memory_get(key)
+        if text is None:
+            text = _disk_get(key)
+            if text is not None:
+                _memory_put(key, text)
+    if text is not None:
+        return text
+
+    start = time.perf_counter()
+    text = extract_text(file_path)
+    metrics.document_extraction.observe(time.perf_counter() - start,
+                                        format=os.path.splitext(file_path)[1].lower() or "none")
+
+    with _lock:
+        _memory_put(key, text)
+        _disk_put(key, text)
+    return text
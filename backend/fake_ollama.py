@@ -0,0 +1,234 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Deterministic stand-in for an Ollama server, for load tests and local runs
+# without models:
+#   python fake_ollama.py --port 11435 --tokens-per-sec 20 --load-seconds 3
+#   OLLAMA_HOST=http://127.0.0.1:11435 uvicorn main:app
+#
+# Behaves like a single CPU box: generations share one "CPU" lock, and
+# switching to a model that isn't resident costs --load-seconds (evicting the
+# least recently used model once --max-loaded models are resident).
+# GET /fake/stats reports requests, model loads and swaps so load tests can
+# check how often the router forced a model switch. Setting state.down makes
+# the server drop every request without answering, like a crashed host (for
+# failover tests; shutdown() alone keeps serving open keep-alive connections).
+#
+# Implements the parts of the API the backend uses: /api/chat (streaming and
+# not), /api/generate (empty prompt = preload), /api/embed, /api/tags, /api/ps.
+
+class FakeOllamaState:
+    def __init__(self, tokens_per_sec=50.0, reply_tokens=20, load_seconds=2.0,
+                 max_loaded=1, parallel=1, fail=False, down=False):
+        self.tokens_per_sec = tokens_per_sec
+        self.reply_tokens = reply_tokens
+        self.load_seconds = load_seconds
+        self.max_loaded = max_loaded
+        self.fail = fail
+        self.down = down
+        self.lock = threading.Lock()
+        self.compute = threading.Semaphore(parallel)
+        self.loaded = {}  # model -> {"last_used", "expires_at"}
+        self.stats = {"requests": 0, "loads": 0, "evictions": 0, "active": 0}
+
+    def ensure_loaded(self, model, keep_alive=None):
+        """Simulates model load/eviction. Returns seconds spent loading."""
+        with self.lock:
+            now = time.time()
+            for name, info in list(self.loaded.items()):
+                if info["expires_at"] is not None and info["expires_at"] <= now:
+                    del self.loaded[name]
+                    self.stats["evictions"] += 1
+            if model in self.loaded:
+                self._touch(model, keep_alive)
+                return 0.0
+            while len(self.loaded) >= self.max_loaded:
+                oldest = min(self.loaded, key=lambda name: self.loaded[name]["last_used"])
+                del self.loaded[oldest]
+                self.stats["evictions"] += 1
+            self.loaded[model] = {"last_used": now, "expires_at": None}
+            self._touch(model, keep_alive)
+            self.stats["loads"] += 1
+        time.sleep(self.load_seconds)
+        return self.load_seconds
+
+    def _touch(self, model, keep_alive):
+        info = self.loaded[model]
+        info["last_used"] = time.time()
+        seconds = parse_keep_alive(keep_alive)
+        if seconds == 0:
+            info["expires_at"] = time.time()
+        elif seconds is not None and seconds > 0:
+            info["expires_at"] = time.time() + seconds
+        elif seconds is not None:
+            info["expires_at"] = None  # negative keep_alive = forever
+        elif info["expires_at"] is None:
+            info["expires_at"] = time.time() + 300
+
+    def unload(self, model):
+        with self.lock:
+            if self.loaded.pop(model, None) is not None:
+                self.stats["evictions"] += 1
+
+def parse_keep_alive(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).strip()
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    for suffix in ("ms", "s", "m", "h"):
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * units[suffix]
+    return float(value)
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _json(self, payload, status=200):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def _dropped(self):
+            if state.down:
+                self.close_connection = True
+            return state.down
+
+        def do_GET(self):
+            if self._dropped():
+                return
+            if self.path == "/api/tags":
+                return self._json({"models": [{"name": name, "model": name} for name in state.loaded]})
+            if self.path == "/api/ps":
+                with state.lock:
+                    models = [{"name": name, "model": name, "size": 4_000_000_000,
+                               "expires_at": info["expires_at"]} for name, info in state.loaded.items()]
+                return self._json({"models": models})
+            if self.path == "/fake/stats":
+                with state.lock:
+                    return self._json({**state.stats, "loaded": list(state.loaded)})
+            if self.path in ("/", "/api/version"):
+                return self._json({"version": "fake"})
+            self._json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            payload = self._read_json()
+            if self._dropped():
+                return
+            if self.path == "/api/embed":
+                inputs = payload.get("input") or []
+                if isinstance(inputs, str):
+                    inputs = [inputs]
+                return self._json({"model": payload.get("model"), "embeddings": [fake_embedding(text) for text in inputs]})
+            if self.path == "/api/generate":
+                model = payload.get("model")
+                if parse_keep_alive(payload.get("keep_alive")) == 0 and not payload.get("prompt"):
+                    state.unload(model)
+                    return self._json({"model": model, "done": True, "done_reason": "unload"})
+                state.ensure_loaded(model, payload.get("keep_alive"))
+                return self._json({"model": model, "response": "", "done": True, "done_reason": "load"})
+            if self.path == "/api/chat":
+                return self._chat(payload)
+            self._json({"error": "not found"}, 404)
+
+        def _chat(self, payload):
+            model = payload.get("model")
+            with state.lock:
+                state.stats["requests"] += 1
+            if state.fail:
+                return self._json({"error": f"model '{model}' failed"}, 500)
+
+            with state.compute:
+                with state.lock:
+                    state.stats["active"] += 1
+                try:
+                    load_seconds = state.ensure_loaded(model, payload.get("keep_alive"))
+                    words = [f"tok{i} " for i in range(state.reply_tokens)]
+                    delay = 1.0 / state.tokens_per_sec if state.tokens_per_sec else 0
+                    prompt_tokens = sum(len(str(m.get("content", ""))) // 4 for m in payload.get("messages", []))
+                    final = {"model": model, "done": True, "done_reason": "stop",
+                             "load_duration": int(load_seconds * 1e9),
+                             "prompt_eval_count": prompt_tokens,
+                             "eval_count": len(words),
+                             "eval_duration": int(delay * len(words) * 1e9)}
+
+                    if payload.get("stream", True):
+                        self.send_response(200)
+                        self.send_header("Content-Type", "application/x-ndjson")
+                        self.send_header("Transfer-Encoding", "chunked")
+                        self.end_headers()
+                        for word in words:
+                            time.sleep(delay)
+                            self._chunk({"model": model, "message": {"role": "assistant", "content": word}, "done": False})
+                        self._chunk({**final, "message": {"role": "assistant", "content": ""}})
+                        self.wfile.write(b"0\r\n\r\n")
+                    else:
+                        time.sleep(delay * len(words))
+                        self._json({**final, "message": {"role": "assistant", "content": "".join(words).strip()}})
+                finally:
+                    with state.lock:
+                        state.stats["active"] -= 1
+
+        def _chunk(self, payload):
+            data = (json.dumps(payload) + "\n").encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+def fake_embedding(text, dim=16):
+    # Deterministic bag-of-words hash embedding: similar texts -> similar vectors
+    vector = [0.0] * dim
+    for word in text.lower().split():
+        vector[hash_word(word) % dim] += 1.0
+    return vector
+
+def hash_word(word):
+    value = 0
+    for ch in word:
+        value = (value * 31 + ord(ch)) & 0xFFFFFFFF
+    return value
+
+def serve(host="127.0.0.1", port=11435, **options):
+    """Starts a fake server in a background thread. Returns (server, state)."""
+    state = FakeOllamaState(**options)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=20)
+    parser.add_argument("--load-seconds", type=float, default=2.0)
+    parser.add_argument("--max-loaded", type=int, default=1)
+    parser.add_argument("--parallel", type=int, default=1)
+    args = parser.parse_args()
+
+    state = FakeOllamaState(tokens_per_sec=args.tokens_per_sec, reply_tokens=args.reply_tokens,
+                            load_seconds=args.load_seconds, max_loaded=args.max_loaded,
+                            parallel=args.parallel)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    print(f"Fake Ollama listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,170 @@
+import contextvars
+import hashlib
+import io
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import media_store
+import metrics
+
+# Image generation jobs
+# ---------------------
+# A diffusion run takes tens of seconds, so /chat no longer waits for it:
+# the request enqueues a job and returns its id right away, a small worker
+# pool does the generation, and clients poll /image-jobs/{id} (or follow its
+# SSE stream) for the result.
+#
+# Outputs are content-addressed (gen_<sha256 prefix>.png), so concurrent
+# jobs can't overwrite each other and identical images are stored once.
+# WebP variants, thumbnails and retention are handled by media_store.
+#
+# The generator is pluggable: IMAGE_BACKEND=hf (Hugging Face Inference API,
+# default) or IMAGE_BACKEND=fake (local Pillow placeholder, for tests and
+# load runs without a token).
+
+IMAGE_BACKEND = os.getenv("IMAGE_BACKEND", "hf")
+IMAGE_MODEL = os.getenv("IMAGE_MODEL", "stabilityai/stable-diffusion-xl-base-1.0")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+# Finished jobs kept for polling; older ones are forgotten first
+MAX_FINISHED_JOBS = 500
+OUTPUT_DIR = media_store.MEDIA_DIR
+
+class HFImageBackend:
+    """Hugging Face InferenceClient, created once and reused across jobs."""
+
+    def __init__(self, model=IMAGE_MODEL):
+        self.model = model
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    def _get_client(self):
+        from huggingface_hub import InferenceClient
+        with self._client_lock:
+            if self._client is None:
+                hf_token = os.getenv("HF_TOKEN")
+                if not hf_token:
+                    raise RuntimeError("HF_TOKEN not found in environment variables.")
+                self._client = InferenceClient(api_key=hf_token)
+            return self._client
+
+    def generate(self, prompt):
+        # output is a PIL.Image object
+        return self._get_client().text_to_image(prompt, model=self.model)
+
+class FakeImageBackend:
+    """Deterministic local stand-in: a solid colour derived from the prompt."""
+
+    def __init__(self, latency=float(os.getenv("FAKE_IMAGE_LATENCY", "0.5")), size=(512, 512)):
+        self.latency = latency
+        self.size = size
+
+    def generate(self, prompt):
+        from PIL import Image, ImageDraw
+        time.sleep(self.latency)
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        image = Image.new("RGB", self.size, tuple(digest[:3]))
+        ImageDraw.Draw(image).text((16, 16), prompt[:60], fill=(255, 255, 255))
+        return image
+
+def make_backend(name=IMAGE_BACKEND):
+    if name == "fake":
+        return FakeImageBackend()
+    return HFImageBackend()
+
+def save_content_addressed(image, output_dir=OUTPUT_DIR):
+    """Encodes the image as PNG and stores it under its content hash. Returns the path."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    data = buffer.getvalue()
+    os.makedirs(output_dir, exist_ok=True)
+    file_path = os.path.join(output_dir, f"gen_{hashlib.sha256(data).hexdigest()[:32]}.png")
+    if not os.path.exists(file_path):
+        # Write to a temp name first so readers never see a half-written file
+        tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
+    else:
+        # Same image again: refresh its age so retention keeps it
+        os.utime(file_path)
+    return file_path
+
+class ImageJobQueue:
+    def __init__(self, backend=None, workers=IMAGE_WORKERS):
+        self.backend = backend or make_backend()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, prompt, on_done=None, user_id=None):
+        """
+        Enqueues a generation and returns the job dict immediately.
+        on_done(job) is called from the worker once the job finished or failed.
+        """
+        job = {
+            "id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "status": "queued",
+            "prompt": prompt,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "path": None,
+            "error": None,
+        }
+        with self._lock:
+            self._jobs[job["id"]] = job
+            self._forget_old_jobs()
+        # Run in the submitter's context so logs keep its request id
+        self._executor.submit(contextvars.copy_context().run, self._run, job, on_done)
+        return dict(job)
+
+    def _run(self, job, on_done):
+        with self._lock:
+            job["status"] = "running"
+            job["started_at"] = time.time()
+        print(f"--- Generating Image for: '{job['prompt']}' ---")
+        start = time.perf_counter()
+        try:
+            path = save_content_addressed(self.backend.generate(job["prompt"]))
+            media_store.schedule_processing(path)
+            update = {"status": "done", "path": path}
+        except Exception as e:
+            update = {"status": "error", "error": f"Error generating image: {str(e)}"}
+        elapsed = time.perf_counter() - start
+        metrics.image_generation.observe(elapsed, status=update["status"])
+        metrics.log_event("image_job", job_id=job["id"], status=update["status"], seconds=round(elapsed, 3))
+        with self._lock:
+            job.update(update, finished_at=time.time())
+        if on_done:
+            try:
+                on_done(dict(job))
+            except Exception as e:
+                print(f"Error in image job callback: {str(e)}")
+
+    def _forget_old_jobs(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["status"] in ("done", "error")]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return counts
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+# Shared instance used by main
+image_jobs = ImageJobQueue()
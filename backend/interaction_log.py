@@ -0,0 +1,181 @@
+import datetime
+import glob
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single server process is assumed
+    fcntl = None
+
+# Self-learning log writer
+# ------------------------
+# Every model reply is appended to training_data.jsonl for later fine-tuning.
+# Writing it inline (open, append, close per reply) costs latency on the
+# request path and lets concurrent replies interleave, so replies are now
+# queued in memory and a single background thread appends them in batches:
+# - a batch is flushed once LOG_BATCH_SIZE records are waiting or
+#   LOG_FLUSH_SECONDS have passed
+# - each batch is one write() on an O_APPEND handle, under an exclusive file
+#   lock, so several server processes can share the file without torn lines
+# - the file is rotated to training_data.<timestamp>.jsonl once it exceeds
+#   LOG_MAX_BYTES or LOG_ROTATE_HOURS, and rotated files are compressed with
+#   LOG_COMPRESSION (gzip, zstd or none)
+# - close() flushes whatever is still queued (called on shutdown)
+# The record format is unchanged: one JSON object per line.
+
+LOG_FILE = "training_data.jsonl"
+BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "64"))
+FLUSH_SECONDS = float(os.getenv("LOG_FLUSH_SECONDS", "2"))
+MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+ROTATE_HOURS = float(os.getenv("LOG_ROTATE_HOURS", "24"))  # 0 = size-based only
+COMPRESSION = os.getenv("LOG_COMPRESSION", "gzip")  # gzip | zstd | none
+# Records waiting beyond this are dropped rather than blocking requests
+MAX_PENDING = 10000
+
+_STOP = object()
+
+def rotated_files(path=LOG_FILE):
+    """Rotated logs for path, oldest first (plain, .gz and .zst)."""
+    stem, ext = os.path.splitext(path)
+    return sorted(glob.glob(f"{glob.escape(stem)}.*{ext}*"))
+
+def _compress(path, compression):
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            print("zstandard is not installed, compressing rotated log with gzip instead")
+            compression = "gzip"
+        else:
+            with open(path, "rb") as src, open(path + ".zst", "wb") as dst:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+            os.remove(path)
+            return path + ".zst"
+    if compression == "gzip":
+        with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+        return path + ".gz"
+    return path
+
+class InteractionLogWriter:
+    def __init__(self, path=LOG_FILE, batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS,
+                 max_bytes=MAX_BYTES, rotate_hours=ROTATE_HOURS, compression=COMPRESSION):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_hours * 3600
+        self.compression = compression
+        self._queue = queue.Queue(maxsize=MAX_PENDING)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._file_started = {}  # inode -> first write seen by this process
+        self._stats = {"written": 0, "dropped": 0, "batches": 0, "rotations": 0, "errors": 0}
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="interaction-log", daemon=True)
+                self._thread.start()
+
+    def write(self, record):
+        """Queues one record. Never blocks; drops the record if the queue is full."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._stats["dropped"] += 1
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            stop = item is _STOP
+            if item is not None and not stop:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_seconds
+            if batch and (stop or len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+            if stop:
+                return
+
+    def _open_locked(self):
+        """Append handle to the current log, exclusively locked where the OS supports it."""
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+            if not fcntl:
+                return fd
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                # Another process may have rotated the file while we waited for the lock
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _flush(self, batch):
+        data = "".join(json.dumps(record) + "\n" for record in batch).encode("utf-8")
+        try:
+            rotated = None
+            fd = self._open_locked()
+            try:
+                os.write(fd, data)
+                rotate = self._needs_rotation(fd)
+                if rotate and fcntl:
+                    rotated = self._rotate()
+            finally:
+                os.close(fd)
+            if rotate and not fcntl:
+                # Windows can't rename a file that is still open
+                rotated = self._rotate()
+            self._stats["written"] += len(batch)
+            self._stats["batches"] += 1
+            if rotated:
+                _compress(rotated, self.compression)
+        except Exception as e:
+            self._stats["errors"] += 1
+            print(f"Error writing interaction log: {str(e)}")
+
+    def _needs_rotation(self, fd):
+        stat = os.fstat(fd)
+        # Age is counted from when this process first wrote to the file
+        started_at = self._file_started.setdefault(stat.st_ino, time.time())
+        too_old = self.rotate_seconds and time.time() - started_at > self.rotate_seconds
+        return stat.st_size >= self.max_bytes or too_old
+
+    def _rotate(self):
+        stem, ext = os.path.splitext(self.path)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        rotated = f"{stem}.{stamp}{ext}"
+        os.replace(self.path, rotated)
+        self._stats["rotations"] += 1
+        return rotated
+
+    def close(self, timeout=10):
+        """Flushes everything queued so far and stops the writer thread."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {**self._stats, "pending": self._queue.qsize()}
+
+# Shared instance used by local_client
+interaction_log = InteractionLogWriter()
@@ -0,0 +1,112 @@
+import os
+import requests
+import sys
+import uuid
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Load test for a single uvicorn worker:
+#   uvicorn main:app --workers 1
+#   python load_test.py [concurrent_chats] [--mixed]
+#
+# Fires a batch of concurrent /chat requests and, while they are generating,
+# keeps hitting /sessions. If model calls block the event loop, /sessions
+# latency jumps to the length of a generation; with the offloaded handlers it
+# should stay close to the idle baseline.
+#
+# --mixed spreads the chats over the general/code/logic models. Against
+# fake_ollama.py (set FAKE_OLLAMA_URL) it also reports how many model loads
+# the run caused, which is what the scheduler's batching keeps down.
+
+BASE_URL = "http://127.0.0.1:8000"
+FAKE_OLLAMA_URL = os.getenv("FAKE_OLLAMA_URL")
+CONCURRENT_CHATS = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 8
+MIXED = "--mixed" in sys.argv
+PROBE_INTERVAL = 0.05
+# Keywords the router maps to mistral / qwen3 / deepseek-r1
+MIXED_TOPICS = ["say hello", "write code for a sorting function", "think through this logic puzzle"]
+
+# One throwaway user per run; every endpoint needs its bearer token
+http = requests.Session()
+
+def log_in():
+    username, password = f"loadtest-{uuid.uuid4().hex[:8]}", uuid.uuid4().hex
+    http.post(f"{BASE_URL}/register", json={"username": username, "password": password})
+    token = http.post(f"{BASE_URL}/login", json={"username": username, "password": password}).json()["token"]
+    http.headers["Authorization"] = f"Bearer {token}"
+
+def timed_get(path):
+    start = time.perf_counter()
+    http.get(f"{BASE_URL}{path}", timeout=300)
+    return time.perf_counter() - start
+
+def send_chat(session_id, i):
+    start = time.perf_counter()
+    topic = MIXED_TOPICS[i % len(MIXED_TOPICS)] if MIXED else "say hello"
+    response = http.post(f"{BASE_URL}/chat", json={
+        "message": f"Load test message {i}: {topic}",
+        "session_id": session_id
+    }, timeout=600)
+    return response.status_code, time.perf_counter() - start
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def report(name, values):
+    if not values:
+        print(f"{name}: no samples")
+        return
+    print(f"{name}: n={len(values)} "
+          f"p50={percentile(values, 50) * 1000:.1f}ms "
+          f"p95={percentile(values, 95) * 1000:.1f}ms "
+          f"max={max(values) * 1000:.1f}ms")
+
+def run():
+    log_in()
+    # Idle baseline for the cheap endpoint
+    baseline = [timed_get("/sessions") for _ in range(20)]
+
+    sessions = [http.post(f"{BASE_URL}/sessions", json={"title": "New Chat"}).json()["id"]
+                for _ in range(CONCURRENT_CHATS)]
+
+    probe_latencies = []
+    done = threading.Event()
+
+    def probe():
+        while not done.is_set():
+            probe_latencies.append(timed_get("/sessions"))
+            time.sleep(PROBE_INTERVAL)
+
+    prober = threading.Thread(target=probe)
+    prober.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONCURRENT_CHATS) as pool:
+        results = list(pool.map(send_chat, sessions, range(CONCURRENT_CHATS)))
+    wall = time.perf_counter() - start
+
+    done.set()
+    prober.join()
+
+    for session_id in sessions:
+        http.delete(f"{BASE_URL}/sessions/{session_id}")
+
+    fake_stats = requests.get(f"{FAKE_OLLAMA_URL}/fake/stats").json() if FAKE_OLLAMA_URL else None
+
+    failures = [code for code, _ in results if code != 200]
+    print(f"{CONCURRENT_CHATS} concurrent chats finished in {wall:.2f}s ({len(failures)} failed)")
+    report("/chat latency", [elapsed for _, elapsed in results])
+    report("/sessions idle", baseline)
+    report("/sessions under chat load", probe_latencies)
+    rejected = sum(1 for code, _ in results if code == 429)
+    if rejected:
+        print(f"{rejected} chats rejected with 429 (scheduler queue full)")
+    print(f"scheduler: {http.get(f'{BASE_URL}/queue').json()}")
+    if fake_stats:
+        print(f"fake ollama: {fake_stats['loads']} model loads for {fake_stats['requests']} chat requests")
+
+if __name__ == "__main__":
+    run()
@@ -1,122 +1,179 @@
-import ollama
-import json
 import datetime
-import os
-import shutil
-from huggingface_hub import InferenceClient
-from typing import Optional
+import time
+import response_cache
+from scheduler import scheduler, QueueFullError, QueueTimeoutError
+import model_manager
+from ollama_pool import pool
+import metrics
+from metrics import log_event
+from interaction_log import interaction_log
 
-# Create a log file to store data for "Self-Learning"
-LOG_FILE = "training_data.jsonl"
+# Interactions are logged to training_data.jsonl for "Self-Learning"
+# (written in batches by a background thread, see interaction_log)
 
-def log_interaction(prompt, response, model_name, image_path=None):
+def log_interaction(prompt, response, model_name, image_path=None, session_id=None):
     """Saves the conversation for future fine-tuning/learning."""
     data = {
         "timestamp": str(datetime.datetime.now()),
+        "session_id": session_id,
         "model": model_name,
         "prompt": prompt,
         "response": response,
         "has_image": bool(image_path)
     }
-    with open(LOG_FILE, "a") as f:
-        f.write(json.dumps(data) + "\n")
+    interaction_log.write(data)
 
-def generate_image(prompt: str) -> str:
-    """
-    Generates an image using Hugging Face InferenceClient (Tongyi-MAI/Z-Image-Turbo).
-    Returns the path to the saved image.
-    """
-    hf_token = os.getenv("HF_TOKEN")
-    if not hf_token:
-        return "Error: HF_TOKEN not found in environment variables."
+# Cognitive router: which local model handles which kind of task
+VISION_MODEL = "qwen2.5vl:7b"
+DEFAULT_MODEL = "mistral:latest"
+model_map = {
+    "logic": "deepseek-r1:7b", # Assuming standard tag
+    "code": "qwen3:8b",        # Assuming standard tag
+    "general": "mistral:latest"
+}
 
-    try:
-        client = InferenceClient(
-            api_key=hf_token,
-        )
-        
-        print(f"--- Generating Image for: '{prompt}' ---")
-        
-        # output is a PIL.Image object
-        image = client.text_to_image(
-            prompt,
-            model="stabilityai/stable-diffusion-xl-base-1.0",
-        )
-        
-        # Ensure static/generated_images exists
-        # Assuming we are in backend/, let's put it in a known accessible place
-        # Ideally, main.py should mount this directory. For now, we save it locally.
-        output_dir = os.path.join(os.getcwd(), "generated_images")
-        os.makedirs(output_dir, exist_ok=True)
-        
-        filename = f"gen_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        file_path = os.path.join(output_dir, filename)
-        
-        image.save(file_path)
-        return file_path
-    
-    except Exception as e:
-        return f"Error generating image: {str(e)}"
+# Context window (tokens) we run each model with. Passed to Ollama as num_ctx
+# and used to budget how much conversation history fits into a request.
+DEFAULT_CONTEXT_LIMIT = 4096
+model_context_limits = {
+    "deepseek-r1:7b": 8192,
+    "qwen3:8b": 8192,
+    "mistral:latest": 8192,
+    "qwen2.5vl:7b": 4096,
+}
+
+def context_limit(model: str) -> int:
+    return model_context_limits.get(model, DEFAULT_CONTEXT_LIMIT)
 
-def generate_response(prompt: str, image_path: str = None, model_type: str = "general"):
+def preload_order():
+    """Models to warm at startup, most used first."""
+    return [DEFAULT_MODEL, model_map["code"], model_map["logic"], VISION_MODEL]
+
+def select_model(image_path: str = None, model_type: str = "general") -> str:
+    """Picks the Ollama model for a request (vision wins over the text task type)."""
+    if image_path:
+        return VISION_MODEL
+    # Fallback to mistral if type not found
+    return model_map.get(model_type, DEFAULT_MODEL)
+
+def build_messages(prompt: str, image_path: str = None, history=None):
+    message = {'role': 'user', 'content': prompt}
+    if image_path:
+        message['images'] = [image_path]
+    return list(history or []) + [message]
+
+def error_prefix(image_path: str = None) -> str:
+    return "Error analyzing image" if image_path else "Error generating response"
+
+def record_model_call(model, response, start, waited):
+    """Generation time, token counts and decode speed for a finished call."""
+    elapsed = time.perf_counter() - start
+    metrics.generation.observe(elapsed, model=model)
+    metrics.record_ollama_usage(model, response)
+    log_event("model_call", model=model, seconds=round(elapsed, 3), queue_seconds=round(waited, 3),
+              prompt_tokens=response.get('prompt_eval_count'), completion_tokens=response.get('eval_count'))
+
+def generate_response(prompt: str, image_path: str = None, model_type: str = "general", history=None,
+                      session_id: str = None, cache_scope: str = None):
     """
     Selects the best model based on the task:
     - Vision: 'qwen2.5-vl:7b' (if image_path provided)
     - Logic: 'deepseek-r1'
     - Code: 'qwen3'
     - General: 'mistral'
+    history: earlier turns as Ollama chat messages (see conversation_memory).
+    cache_scope: set (to the user id) when the prompt carries the user's files,
+    so the cached reply is only reused for them (see response_cache).
     """
-    
-    # 1. Image Generation Check (Simple heuristic)
-    # If the user explicitly asks to generate an image, we should probably handle it or let the caller handle it.
-    # For now, we assume the caller might intercept or we treat it as text unless we implement a router.
-    # But since the user instructions separated them, we'll focus on Text/Vision here.
-    
-    if image_path:
-        selected_model = "qwen2.5vl:7b"
-        print(f"--- Analyzing Image with {selected_model} ---")
-        try:
-            # Prepare message for Vision model
-            message = {
-                'role': 'user',
-                'content': prompt,
-                'images': [image_path]
-            }
-            
-            response = ollama.chat(
+    selected_model = select_model(image_path, model_type)
+
+    cached = response_cache.get(selected_model, prompt, image_path, history, cache_scope)
+    if cached is not None:
+        print(f"--- Cache hit for {selected_model} ---")
+        return cached
+
+    start = time.perf_counter()
+    try:
+        if image_path:
+            print(f"--- Analyzing Image with {selected_model} ---")
+        else:
+            print(f"--- Thinking with {selected_model} ---")
+        with scheduler.slot(selected_model) as waited, model_manager.in_use(selected_model) as keep_alive:
+            metrics.queue_wait.observe(waited, model=selected_model)
+            response = pool.chat(
                 model=selected_model,
-                messages=[message]
+                messages=build_messages(prompt, image_path, history),
+                options={'num_ctx': context_limit(selected_model)},
+                keep_alive=keep_alive
             )
-            reply = response['message']['content']
-            log_interaction(prompt, reply, selected_model, image_path)
-            return reply
-            
-        except Exception as e:
-            return f"Error analyzing image: {str(e)}"
-
-    # 2. Text Logic
-    model_map = {
-        "logic": "deepseek-r1:7b", # Assuming standard tag
-        "code": "qwen3:8b",        # Assuming standard tag
-        "general": "mistral:latest"
-    }
-    
-    # Fallback to mistral if type not found
-    selected_model = model_map.get(model_type, "mistral:latest")
-    
-    try:
-        print(f"--- Thinking with {selected_model} ---")
-        response = ollama.chat(
-            model=selected_model,
-            messages=[{'role': 'user', 'content': prompt}]
-        )
         
         reply = response['message']['content']
-        log_interaction(prompt, reply, selected_model)
+        record_model_call(selected_model, response, start, waited)
+        log_interaction(prompt, reply, selected_model, image_path, session_id)
+        response_cache.put(selected_model, prompt, reply, image_path, history, cache_scope)
         return reply
-        
+
+    except (QueueFullError, QueueTimeoutError):
+        # Admission control decisions are surfaced to the caller (HTTP 429/503)
+        raise
     except Exception as e:
-        return f"Error generating response: {str(e)}"
+        metrics.model_errors.inc(model=selected_model)
+        log_event("model_error", model=selected_model, error=str(e))
+        return f"{error_prefix(image_path)}: {str(e)}"
+
+def stream_response(prompt: str, image_path: str = None, model_type: str = "general", history=None,
+                    session_id: str = None, cache_scope: str = None):
+    """
+    Same routing as generate_response, but yields the reply piece by piece
+    as Ollama produces it. The complete reply is logged once at the end.
+    If the model fails mid-stream, the error text is yielded as the last chunk;
+    QueueFullError/QueueTimeoutError are raised, as in generate_response.
+    """
+    selected_model = select_model(image_path, model_type)
+
+    cached = response_cache.get(selected_model, prompt, image_path, history, cache_scope)
+    if cached is not None:
+        print(f"--- Cache hit for {selected_model} ---")
+        yield cached
+        return
+
+    print(f"--- Streaming with {selected_model} ---")
+
+    parts = []
+    start = time.perf_counter()
+    final = {}
+    try:
+        # The slot is held until the last token, since the model is busy until then
+        with scheduler.slot(selected_model) as waited, model_manager.in_use(selected_model) as keep_alive:
+            metrics.queue_wait.observe(waited, model=selected_model)
+            stream = pool.chat(
+                model=selected_model,
+                messages=build_messages(prompt, image_path, history),
+                options={'num_ctx': context_limit(selected_model)},
+                keep_alive=keep_alive,
+                stream=True
+            )
+            for chunk in stream:
+                token = chunk['message']['content']
+                if token:
+                    if not parts:
+                        metrics.ttft.observe(time.perf_counter() - start, model=selected_model)
+                    parts.append(token)
+                    yield token
+                if chunk.get('done'):
+                    final = chunk
+    except (QueueFullError, QueueTimeoutError):
+        raise
+    except Exception as e:
+        metrics.model_errors.inc(model=selected_model)
+        log_event("model_error", model=selected_model, error=str(e))
+        yield f"{error_prefix(image_path)}: {str(e)}"
+        return
+
+    reply = "".join(parts)
+    record_model_call(selected_model, final, start, waited)
+    log_interaction(prompt, reply, selected_model, image_path, session_id)
+    response_cache.put(selected_model, prompt, reply, image_path, history, cache_scope)
 
 if __name__ == "__main__":
     # Test
@@ -1,17 +1,56 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Body
+from fastapi import FastAPI, HTTPException, Body, BackgroundTasks, Request, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse, Response, PlainTextResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from typing import List, Optional
 import os
-import shutil
+import json
+import asyncio
+import time
+import functools
 import uuid
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI()
+from concurrency import run_model_call, run_io, run_password_hash, shutdown_executors
+import model_manager
+import metrics
+from metrics import log_event, request_id_var
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm the models in the background; /health/ready reports when it's done
+    preload_task = None
+    if model_manager.PRELOAD_ENABLED:
+        preload_task = asyncio.create_task(run_model_call(model_manager.preload, preload_order()))
+    gc_task = asyncio.create_task(collect_upload_garbage())
+    yield
+    if preload_task:
+        preload_task.cancel()
+    gc_task.cancel()
+    image_jobs.shutdown()
+    media_store.shutdown()
+    interaction_log.close()
+    shutdown_executors()
+    shutdown_pdf_pool()
+    close_connections()
+
+async def collect_upload_garbage():
+    # Released blobs and abandoned chunked uploads, at startup and then periodically
+    while True:
+        try:
+            await run_io(upload_store.collect_garbage)
+        except Exception as e:
+            print(f"Upload GC failed: {str(e)}")
+        await asyncio.sleep(UPLOAD_GC_INTERVAL_SECONDS)
+
+UPLOAD_GC_INTERVAL_SECONDS = float(os.getenv("UPLOAD_GC_INTERVAL_SECONDS", "3600"))
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS configuration
 origins = [
@@ -27,140 +66,492 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Request id for the JSON logs: the caller's X-Request-ID, or a new one
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        elapsed = time.perf_counter() - start
+        # Label by route template, not raw path, so ids don't explode the series count
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        metrics.http_requests.inc(method=request.method, route=route, status=str(status))
+        metrics.http_latency.observe(elapsed, method=request.method, route=route)
+        log_event("http_request", method=request.method, route=route, status=status,
+                  seconds=round(elapsed, 4))
+        request_id_var.reset(token)
+
 # Ensure generated_images directory exists
 generated_images_dir = os.path.join(os.getcwd(), "generated_images")
 os.makedirs(generated_images_dir, exist_ok=True)
 
-# Mount the directory to serve images statically
-app.mount("/images", StaticFiles(directory=generated_images_dir), name="images")
-
 class ChatRequest(BaseModel):
     message: str
     session_id: str
-    image: Optional[str] = None # Base64 string or file path reference
-    context_files: Optional[List[str]] = []
+    image: Optional[str] = None # Base64 string or upload id
+    context_files: Optional[List[str]] = [] # Upload ids from /upload
 
 class SessionRequest(BaseModel):
     title: Optional[str] = "New Chat"
 
+class UploadSessionRequest(BaseModel):
+    filename: str
+    size: int
+    sha256: Optional[str] = None
+
 class LoginRequest(BaseModel):
     username: str
     password: str
 
-from database import init_db, add_message, get_messages, create_session, get_sessions, delete_session, delete_message, get_last_message_id, create_user, get_user_by_username
-from document_processor import extract_text_from_file
-from local_client import generate_response, generate_image
-import hashlib
+from database import count_unowned_sessions, claim_unowned_sessions, clamp_page_size, DEFAULT_MESSAGE_PAGE_SIZE, init_db, add_message, add_chat_turn, update_message_content, close_connections, get_messages, create_session, get_sessions, get_session, delete_session, delete_message, get_last_message_id, search_messages, get_user_uploads, get_upload_session, create_user, get_user_by_username, update_password_hash
+from document_processor import is_supported, shutdown_pdf_pool
+from extraction_cache import get_extracted_text
+from retrieval import build_context, index_document
+from local_client import generate_response, stream_response, select_model, preload_order
+from image_jobs import image_jobs
+from conversation_memory import build_history, refresh_summary
+import response_cache
+import media_store
+from interaction_log import interaction_log
+from vision_input import prepare_image, InvalidImageError
+import upload_store
+from upload_store import UploadError
+from scheduler import scheduler, QueueFullError, QueueTimeoutError
+from auth import LEGACY_SESSIONS_OWNER, current_user, hash_password, verify_password, needs_rehash, dummy_verify, issue_token, revoke_token, bearer_token, check_chat_quota, check_session_quota, QuotaExceededError
 
 # Initialize DB
 init_db()
+unowned_sessions = count_unowned_sessions()
+if unowned_sessions and not LEGACY_SESSIONS_OWNER:
+    print(f"{unowned_sessions} chats from before user accounts have no owner; "
+          f"set LEGACY_SESSIONS_OWNER=<username> to give them to that user at their next login")
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request, exc: QueueFullError):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc), "model": exc.model, "queue_depth": exc.queue_depth},
+        headers={"Retry-After": "5"},
+    )
+
+@app.exception_handler(QueueTimeoutError)
+async def queue_timeout_handler(request, exc: QueueTimeoutError):
+    return JSONResponse(status_code=503, content={"detail": str(exc), "model": exc.model})
+
+@app.exception_handler(UploadError)
+async def upload_error_handler(request, exc: UploadError):
+    content = {"detail": str(exc)}
+    if isinstance(exc, upload_store.UploadOffsetError):
+        content["offset"] = exc.offset
+    return JSONResponse(status_code=exc.status_code, content=content)
+
+@app.exception_handler(QuotaExceededError)
+async def quota_exceeded_handler(request, exc: QuotaExceededError):
+    headers = {"Retry-After": str(exc.retry_after)} if exc.retry_after else None
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers=headers)
 
 @app.post("/register")
 async def register(request: LoginRequest):
-    # Simple hash for demo purposes (production should use bcrypt/argon2)
-    hashed_pw = hashlib.sha256(request.password.encode()).hexdigest()
+    hashed_pw = await run_password_hash(hash_password, request.password)
     user_id = str(uuid.uuid4())
-    success = create_user(user_id, request.username, hashed_pw)
+    success = await run_io(create_user, user_id, request.username, hashed_pw)
     if not success:
         raise HTTPException(status_code=400, detail="Username already exists")
     return {"message": "User created successfully", "username": request.username}
 
 @app.post("/login")
 async def login(request: LoginRequest):
-    user = get_user_by_username(request.username)
+    user = await run_io(get_user_by_username, request.username)
     if not user:
+        # Same cost as a wrong password, so response times don't reveal usernames
+        await run_password_hash(dummy_verify, request.password)
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    hashed_pw = hashlib.sha256(request.password.encode()).hexdigest()
-    if user['password_hash'] != hashed_pw:
+
+    if not await run_password_hash(verify_password, request.password, user['password_hash']):
         raise HTTPException(status_code=401, detail="Invalid credentials")
-        
-    return {"message": "Login successful", "username": user['username'], "user_id": user['id']}
+    if needs_rehash(user['password_hash']):
+        # Upgrade legacy sha256 (or outdated scrypt cost) now that we know the password
+        new_hash = await run_password_hash(hash_password, request.password)
+        await run_io(update_password_hash, user['id'], new_hash)
+
+    if LEGACY_SESSIONS_OWNER and user['username'] == LEGACY_SESSIONS_OWNER:
+        claimed = await run_io(claim_unowned_sessions, user['id'])
+        if claimed:
+            print(f"Gave {claimed} chats from before user accounts to {user['username']}")
+
+    token = await run_io(issue_token, user['id'])
+    return {"message": "Login successful", "username": user['username'], "user_id": user['id'], "token": token}
+
+@app.post("/logout")
+async def logout(authorization: Optional[str] = Header(None)):
+    token = bearer_token(authorization)
+    if token:
+        await run_io(revoke_token, token)
+    return {"message": "Logged out"}
 
 @app.get("/")
 def read_root():
     return {"message": "Chatbot Backend is running!"}
 
+@app.get("/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness():
+    ready, reasons = await run_io(model_manager.readiness)
+    if not ready:
+        return JSONResponse(status_code=503, content={"status": "starting", "reasons": reasons})
+    return {"status": "ready"}
+
+@app.get("/models")
+async def model_status(user_id: str = Depends(current_user)):
+    # Resident models, keep-alive policy and preload progress
+    return await run_io(model_manager.status)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    # Prometheus text format; unauthenticated like /health, scrape it from inside the network
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/queue")
+async def model_queue_stats(user_id: str = Depends(current_user)):
+    # Per-model waiting/running counts from the scheduler
+    return scheduler.stats()
+
+@app.get("/cache/stats")
+async def response_cache_stats(user_id: str = Depends(current_user)):
+    return response_cache.stats()
+
+async def require_session(session_id: str, user_id: str) -> dict:
+    # Someone else's session looks exactly like a missing one
+    session = await run_io(get_session, session_id)
+    if not session or session["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
 @app.post("/sessions")
-async def create_new_session(request: SessionRequest):
+async def create_new_session(request: SessionRequest, user_id: str = Depends(current_user)):
+    await run_io(check_session_quota, user_id)
     session_id = str(uuid.uuid4())
-    create_session(session_id, request.title)
+    await run_io(create_session, session_id, request.title, user_id)
     return {"id": session_id, "title": request.title}
 
 @app.get("/sessions")
-async def get_all_sessions():
-    return get_sessions()
+async def get_all_sessions(before_id: Optional[str] = None, limit: Optional[int] = None,
+                           user_id: str = Depends(current_user)):
+    # Keyset pagination: pass the id of the last session you got as before_id
+    return await run_io(get_sessions, user_id, before_id, clamp_page_size(limit))
 
 @app.delete("/sessions/{session_id}")
-async def remove_session(session_id: str):
-    delete_session(session_id)
+async def remove_session(session_id: str, user_id: str = Depends(current_user)):
+    await require_session(session_id, user_id)
+    await run_io(delete_session, session_id)
     return {"message": "Session deleted"}
 
 @app.get("/sessions/{session_id}/messages")
-async def get_session_messages(session_id: str):
-    return get_messages(session_id)
+async def get_session_messages(session_id: str, before_id: Optional[int] = None, limit: Optional[int] = None,
+                               user_id: str = Depends(current_user)):
+    await require_session(session_id, user_id)
+    # Latest page by default; pass the id of the oldest message you have as before_id for older ones
+    return await run_io(get_messages, session_id, before_id, clamp_page_size(limit, DEFAULT_MESSAGE_PAGE_SIZE))
 
-@app.post("/chat")
-async def chat_endpoint(request: ChatRequest):
-    session_id = request.session_id
-    
-    # 1. Save user message
+@app.get("/search")
+async def search(q: str, session_id: Optional[str] = None, limit: Optional[int] = None, offset: int = 0,
+                 user_id: str = Depends(current_user)):
+    # Ranked hits with snippets, only from the caller's sessions; page with
+    # offset (next_offset is null on the last page)
+    limit = clamp_page_size(limit)
+    offset = max(0, offset)
+    results = await run_io(search_messages, q, user_id, session_id, limit + 1, offset)
+    has_more = len(results) > limit
+    return {
+        "query": q,
+        "results": results[:limit],
+        "next_offset": offset + limit if has_more else None,
+    }
+
+def resolve_attachments(request: ChatRequest, user_id: str):
+    # Attachments are upload ids, and only the caller's own uploads resolve.
+    # They're swapped for the stored files' paths here so the rest of the
+    # pipeline works on paths; request.image may also be base64 data.
+    def resolve(upload_id):
+        path = upload_store.resolve(user_id, upload_id)
+        if not path:
+            raise HTTPException(status_code=403, detail="Attachment not found in your uploads")
+        return path
+
+    request.context_files = [resolve(upload_id) for upload_id in request.context_files or []]
+    if request.image and (upload_store.is_upload_id(request.image) or os.path.exists(request.image)):
+        request.image = resolve(request.image)
+
+async def authorize_chat(request: ChatRequest, user_id: str):
+    await require_session(request.session_id, user_id)
+    await run_io(resolve_attachments, request, user_id)
+    check_chat_quota(user_id)
+
+def user_message_content(request: ChatRequest) -> str:
     user_msg_content = request.message
     if request.image:
         user_msg_content += " [Image Attached]"
     if request.context_files:
         user_msg_content += f" [{len(request.context_files)} Files Attached]"
-        
-    add_message(session_id, "user", user_msg_content, "text")
-
-    # 2. Process context files
-    context_text = ""
-    for file_path in request.context_files:
-        if os.path.exists(file_path):
-            extracted = extract_text_from_file(file_path)
-            context_text += f"\n--- Content of {os.path.basename(file_path)} ---\n{extracted}\n"
+    return user_msg_content
+
+def cache_scope(request: ChatRequest, user_id: str) -> Optional[str]:
+    # Replies built from a user's files are only reused for that user
+    return user_id if request.context_files or request.image else None
+
+def extract_attachments(request: ChatRequest):
+    # Fills the extraction cache, so build_full_prompt only does lookups and
+    # the two show up as separate stages in chat_stage_seconds
+    for path in request.context_files or []:
+        get_extracted_text(path)
+
+def build_full_prompt(request: ChatRequest) -> str:
+    # Small attachments go in whole; large ones contribute only the chunks relevant to the question
+    context_text = build_context(request.message, request.context_files) if request.context_files else ""
     
-    # 3. Construct Prompt
     full_prompt = request.message
     if context_text:
         full_prompt += f"\n\nContext from uploaded files:\n{context_text}"
+    return full_prompt
+
+def is_image_generation_request(message: str) -> bool:
+    return "/image" in message.lower() or "generate image" in message.lower()
+
+def detect_model_type(message: str) -> str:
+    # Determine model type (logic/code/general) based on keywords or default
+    lowered = message.lower()
+    if "code" in lowered or "script" in lowered or "function" in lowered:
+        return "code"
+    if "think" in lowered or "logic" in lowered or "reason" in lowered:
+        return "logic"
+    return "general"
+
+async def resolve_vision_image(request: ChatRequest) -> Optional[str]:
+    # Upload path or base64 data -> downscaled, re-encoded copy for the vision model
+    if not request.image:
+        return None
+    try:
+        with metrics.chat_stage.time(stage="image"):
+            return await run_io(prepare_image, request.image)
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+IMAGE_PENDING_TEXT = "Generating image..."
+
+def image_markdown(image_path: str) -> str:
+    # Convert local path to URL
+    filename = os.path.basename(image_path)
+    image_url = f"http://localhost:8000/images/{filename}"
+    return f"![Generated Image]({image_url})"
+
+def image_job_summary(job: dict) -> dict:
+    summary = {
+        "id": job["id"],
+        "status": job["status"],
+        "status_url": f"/image-jobs/{job['id']}",
+        "created_at": job["created_at"],
+        "finished_at": job["finished_at"],
+    }
+    if job["status"] == "done":
+        summary["response"] = image_markdown(job["path"])
+        summary["thumbnail_url"] = f"/images/{os.path.basename(job['path'])}?variant=thumb"
+    elif job["status"] == "error":
+        summary["response"] = job["error"]
+    return summary
+
+def finish_image_message(msg_id: int, job: dict):
+    # Replace the placeholder bot message once the image job is finished
+    update_message_content(msg_id, image_job_summary(job)["response"])
+
+async def start_image_turn(session_id: str, user_msg_content: str, message: str, user_id: str) -> dict:
+    """Stores the turn with a placeholder reply and queues the generation. Returns the job summary."""
+    _, bot_msg_id = await run_io(add_chat_turn, session_id, user_msg_content, IMAGE_PENDING_TEXT)
+    # Strip command from prompt to get clean description if needed, or pass full prompt
+    job = image_jobs.submit(message, on_done=functools.partial(finish_image_message, bot_msg_id), user_id=user_id)
+    return image_job_summary(job)
+
+@app.post("/chat")
+async def chat_endpoint(request: ChatRequest, background_tasks: BackgroundTasks, user_id: str = Depends(current_user)):
+    await authorize_chat(request, user_id)
+    session_id = request.session_id
+    
+    # 1. User message (stored together with the reply in step 5)
+    user_msg_content = user_message_content(request)
+
+    # Image generation runs as a background job; poll image_job.status_url for the result
+    if is_image_generation_request(request.message):
+        job = await start_image_turn(session_id, user_msg_content, request.message, user_id)
+        return {"response": IMAGE_PENDING_TEXT, "image_job": job}
+
+    # 2. Process context files + 3. Construct Prompt
+    # (each stage is timed into chat_stage_seconds, see /metrics)
+    with metrics.chat_stage.time(stage="extract"):
+        await run_io(extract_attachments, request)
+    with metrics.chat_stage.time(stage="prompt"):
+        full_prompt = await run_io(build_full_prompt, request)
         
     # 4. Generate Response
-    # Check for Image Generation Request
-    if "/image" in request.message.lower() or "generate image" in request.message.lower():
-        # Strip command from prompt to get clean description if needed, or pass full prompt
-        image_path = generate_image(request.message)
-        if "Error" in image_path:
-             bot_response = image_path
-        else:
-             # Convert local path to URL
-             filename = os.path.basename(image_path)
-             image_url = f"http://localhost:8000/images/{filename}"
-             bot_response = f"![Generated Image]({image_url})"
+    image_path = await resolve_vision_image(request)
+    model_type = detect_model_type(request.message)
+    with metrics.chat_stage.time(stage="history"):
+        history = await run_io(build_history, session_id, select_model(image_path, model_type), full_prompt)
+    with metrics.chat_stage.time(stage="model"):
+        bot_response = await run_model_call(generate_response, full_prompt, image_path, model_type, history, session_id,
+                                            cache_scope(request, user_id))
     
-    else:
-        # Handle image path safely (Vision)
-        image_path = None
-        if request.image and os.path.exists(request.image):
-            image_path = request.image
-            
-        # Determine model type (logic/code/general) based on keywords or default
-        model_type = "general"
-        if "code" in request.message.lower() or "script" in request.message.lower() or "function" in request.message.lower():
-            model_type = "code"
-        elif "think" in request.message.lower() or "logic" in request.message.lower() or "reason" in request.message.lower():
-            model_type = "logic"
-            
-        bot_response = generate_response(full_prompt, image_path, model_type)
-    
-    # 5. Save bot response
-    add_message(session_id, "model", bot_response, "text")
+    # 5. Save the whole turn (user message, bot response, title) in one transaction
+    with metrics.chat_stage.time(stage="db_write"):
+        await run_io(add_chat_turn, session_id, user_msg_content, bot_response)
+
+    # Fold turns that no longer fit the context into the rolling summary, after responding
+    background_tasks.add_task(run_model_call, refresh_summary, session_id)
     
     return {"response": bot_response}
 
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest, user_id: str = Depends(current_user)):
+    """
+    Streaming variant of /chat (Server-Sent Events).
+    Emits {"token": ...} events while the model generates, then a final
+    {"done": true, "response": ...} event, or an {"error": ..., "status": ...}
+    event when the request can't get a model slot after the stream started
+    (what /chat answers with 429/503). The user message is stored
+    before generating, the reply once the stream ends, also when it ends
+    early (client gone, model error): whatever was streamed is kept.
+    """
+    await authorize_chat(request, user_id)
+    session_id = request.session_id
+    user_msg_content = user_message_content(request)
+
+    if is_image_generation_request(request.message):
+        # Diffusion has no partial output: hand out the job and let the client poll it
+        job = await start_image_turn(session_id, user_msg_content, request.message, user_id)
+        events = [sse_event({"image_job": job}), sse_event({"done": True, "response": IMAGE_PENDING_TEXT})]
+        return StreamingResponse(iter(events), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
+
+    with metrics.chat_stage.time(stage="extract"):
+        await run_io(extract_attachments, request)
+    with metrics.chat_stage.time(stage="prompt"):
+        full_prompt = await run_io(build_full_prompt, request)
+    image_path = await resolve_vision_image(request)
+    model_type = detect_model_type(request.message)
+    model = select_model(image_path, model_type)
+    # Reject with 429 now; once the stream has started we can't change the status
+    scheduler.ensure_capacity(model)
+    queue_position = scheduler.queue_position(model)
+    with metrics.chat_stage.time(stage="history"):
+        history = await run_io(build_history, session_id, model, full_prompt)
+    scope = cache_scope(request, user_id)
+    # After build_history, which would otherwise count this message twice
+    with metrics.chat_stage.time(stage="db_write"):
+        await run_io(add_message, session_id, "user", user_msg_content)
+
+    def event_stream():
+        parts = []
+        try:
+            if queue_position:
+                yield sse_event({"queue_position": queue_position})
+            chunks = stream_response(full_prompt, image_path, model_type, history, session_id, scope)
+            with metrics.chat_stage.time(stage="model"):
+                for chunk in chunks:
+                    parts.append(chunk)
+                    yield sse_event({"token": chunk})
+        except (QueueFullError, QueueTimeoutError) as e:
+            # The 200 is already out, so the status travels in the event
+            yield sse_event({"error": str(e), "status": 429 if isinstance(e, QueueFullError) else 503})
+            return
+        finally:
+            if parts:
+                with metrics.chat_stage.time(stage="db_write"):
+                    add_message(session_id, "model", "".join(parts))
+        yield sse_event({"done": True, "response": "".join(parts)})
+
+    # Sync generator: Starlette iterates it in its threadpool, so the blocking
+    # Ollama stream never sits on the event loop.
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(run_model_call, refresh_summary, session_id),
+    )
+
+class ImageJobRequest(BaseModel):
+    prompt: str
+
+@app.post("/image-jobs", status_code=202)
+async def create_image_job(request: ImageJobRequest, user_id: str = Depends(current_user)):
+    check_chat_quota(user_id)
+    return image_job_summary(image_jobs.submit(request.prompt, user_id=user_id))
+
+def get_own_image_job(job_id: str, user_id: str) -> dict:
+    job = image_jobs.get(job_id)
+    if not job or job["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Image job not found")
+    return job
+
+@app.get("/image-jobs/{job_id}")
+async def get_image_job(job_id: str, user_id: str = Depends(current_user)):
+    return image_job_summary(get_own_image_job(job_id, user_id))
+
+IMAGE_JOB_POLL_SECONDS = 0.5
+
+@app.get("/image-jobs/{job_id}/events")
+async def image_job_events(job_id: str, user_id: str = Depends(current_user)):
+    """SSE stream of a job's status changes; ends once it is done or failed."""
+    get_own_image_job(job_id, user_id)
+
+    async def event_stream():
+        last_status = None
+        while True:
+            job = image_jobs.get(job_id)
+            if job is None:
+                return
+            if job["status"] != last_status:
+                last_status = job["status"]
+                yield sse_event(image_job_summary(job))
+            if job["status"] in ("done", "error"):
+                return
+            await asyncio.sleep(IMAGE_JOB_POLL_SECONDS)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/images/{filename}")
+async def serve_image(filename: str, request: Request, variant: str = "original"):
+    """
+    Generated images. ?variant=webp|thumb serves the compressed copies once
+    they're built. Content-addressed files are cached as immutable; Range
+    requests are handled by FileResponse. No auth: <img> tags can't send a
+    bearer token, and the names are unguessable content hashes.
+    """
+    path = await run_io(media_store.resolve, filename, variant)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    headers = media_store.cache_headers(filename, path, variant)
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, headers=headers)
+
 @app.post("/undo")
-async def undo_last_message(body: dict = Body(...)):
-    session_id = body.get("session_id")
+async def undo_last_message(body: dict = Body(...), user_id: str = Depends(current_user)):
+    await require_session(body.get("session_id"), user_id)
+    return await run_io(undo_last_turn, body.get("session_id"))
+
+def undo_last_turn(session_id):
     # Delete last bot message (if any) and last user message
     # Ideally should use IDs, but simplified:
     # 1. Get last message. If bot, delete it.
@@ -188,7 +579,8 @@ async def undo_last_message(body: dict = Body(...)):
     # Let's assume the user wants to remove their last mistake.
     # We will find the very last 2 messages (likely User + Bot) and delete them.
     
-    all_msgs = get_messages(session_id)
+    # Only the last turn matters here
+    all_msgs = get_messages(session_id, limit=2)
     if not all_msgs:
         return {"message": "Nothing to undo"}
     
@@ -207,14 +599,68 @@ async def undo_last_message(body: dict = Body(...)):
         
     return {"message": "Undo successful", "deleted_count": len(to_delete)}
 
+async def prepare_upload(upload: dict, user_id: str):
+    # Extract and index now so later chat turns that attach this file only do
+    # lookups (both are cached by content hash, so duplicates are instant)
+    file_path = await run_io(upload_store.resolve, user_id, upload["id"])
+    if is_supported(file_path):
+        await run_io(get_extracted_text, file_path)
+        await run_model_call(index_document, file_path)
+
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    uploads_dir = os.path.join(os.getcwd(), "uploads")
-    os.makedirs(uploads_dir, exist_ok=True)
-    file_path = os.path.join(uploads_dir, file.filename)
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-        
-    return {"filename": file.filename, "path": file_path}
+async def upload_file(request: Request, user_id: str = Depends(current_user)):
+    # The form is parsed here rather than as a File(...) parameter, which FastAPI
+    # would spool to disk before the size and quota could be checked
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit():
+        await run_io(upload_store.check_request_size, user_id, int(content_length))
+    # Stored by content hash; /chat takes the returned id in context_files or image
+    upload = await upload_store.receive_form_file(user_id, request.headers.get("content-type"), request.stream())
+    await prepare_upload(upload, user_id)
+    return upload
+
+@app.get("/uploads")
+async def list_uploads(user_id: str = Depends(current_user)):
+    uploads = await run_io(get_user_uploads, user_id)
+    return [upload_store.summary(upload) for upload in uploads]
+
+@app.delete("/uploads/{upload_id}")
+async def delete_upload_endpoint(upload_id: str, user_id: str = Depends(current_user)):
+    if not await run_io(upload_store.remove, user_id, upload_id):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return {"message": "Upload deleted"}
+
+# Chunked, resumable uploads (see upload_store)
+
+@app.post("/uploads/sessions")
+async def start_upload_session(request: UploadSessionRequest, user_id: str = Depends(current_user)):
+    result = await run_io(upload_store.start_session, user_id, request.filename, request.size, request.sha256)
+    if result["complete"]:
+        await prepare_upload(result["upload"], user_id)
+    return result
+
+async def get_own_upload_session(session_id: str, user_id: str) -> dict:
+    session = await run_io(get_upload_session, session_id)
+    if not session or session["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+@app.get("/uploads/sessions/{session_id}")
+async def get_upload_session_status(session_id: str, user_id: str = Depends(current_user)):
+    return upload_store.session_summary(await get_own_upload_session(session_id, user_id))
+
+@app.put("/uploads/sessions/{session_id}")
+async def upload_chunk(session_id: str, request: Request, upload_offset: int = Header(...),
+                       user_id: str = Depends(current_user)):
+    # Raw bytes starting at Upload-Offset; on 409 resume from the returned offset
+    session = await get_own_upload_session(session_id, user_id)
+    result = await upload_store.receive_chunk(session, upload_offset, request.stream())
+    if result["complete"]:
+        await prepare_upload(result["upload"], user_id)
+    return result
 
+@app.delete("/uploads/sessions/{session_id}")
+async def cancel_upload_session(session_id: str, user_id: str = Depends(current_user)):
+    await get_own_upload_session(session_id, user_id)
+    await run_io(upload_store.cancel_session, session_id)
+    return {"message": "Upload cancelled"}
@@ -0,0 +1,149 @@
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from database import is_image_referenced
+
+# Generated-image storage
+# -----------------------
+# Originals live in generated_images/ under content-addressed names
+# (gen_<sha256 prefix>.png, see image_jobs). For each new original a
+# background pool writes compressed variants next to it:
+#   variants/<name>.webp    full size WebP (much smaller than the PNG)
+#   variants/<name>.thumb.webp    THUMB_SIZE px thumbnail for the chat UI
+# Content-addressed files never change, so they're served with a strong
+# ETag and "immutable" caching. Retention: originals older than
+# MEDIA_MAX_AGE_DAYS are removed, and the directory is kept under
+# MEDIA_MAX_BYTES by deleting the least recently written images first.
+# Images still linked from a stored chat message are never removed, so old
+# chats don't show broken images; they become eligible once the messages
+# (or their session) are deleted. MEDIA_MAX_BYTES therefore only bounds the
+# unreferenced images.
+
+MEDIA_DIR = os.path.join(os.getcwd(), "generated_images")
+VARIANTS_DIR = os.path.join(MEDIA_DIR, "variants")
+VARIANTS = ("webp", "thumb")
+THUMB_SIZE = 384
+WEBP_QUALITY = 80
+THUMB_QUALITY = 70
+MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+MAX_AGE_DAYS = float(os.getenv("MEDIA_MAX_AGE_DAYS", "90"))  # 0 = keep forever
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Legacy timestamp-named files (gen_YYYYmmdd_HHMMSS.png) could in theory be rewritten
+MUTABLE_CACHE_CONTROL = "public, max-age=3600"
+# A variant URL answered with the original because the variant isn't built
+# yet: clients must come back, or they'd keep the PNG under that URL for good
+FALLBACK_CACHE_CONTROL = "no-cache"
+
+CONTENT_ADDRESSED = re.compile(r"^gen_([0-9a-f]{32})\.png$")
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="media")
+
+def variant_path(filename, variant):
+    stem = os.path.splitext(filename)[0]
+    suffix = ".webp" if variant == "webp" else f".{variant}.webp"
+    return os.path.join(VARIANTS_DIR, stem + suffix)
+
+def _save_atomic(image, path, **options):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    image.save(tmp_path, **options)
+    os.replace(tmp_path, path)
+
+def build_variants(original_path):
+    from PIL import Image
+    os.makedirs(VARIANTS_DIR, exist_ok=True)
+    filename = os.path.basename(original_path)
+    with Image.open(original_path) as image:
+        image.load()
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        webp_path = variant_path(filename, "webp")
+        if not os.path.exists(webp_path):
+            _save_atomic(image, webp_path, format="WEBP", quality=WEBP_QUALITY, method=4)
+        thumb_path = variant_path(filename, "thumb")
+        if not os.path.exists(thumb_path):
+            thumb = image.copy()
+            thumb.thumbnail((THUMB_SIZE, THUMB_SIZE))
+            _save_atomic(thumb, thumb_path, format="WEBP", quality=THUMB_QUALITY, method=4)
+
+def _variant_files(filename):
+    return [variant_path(filename, variant) for variant in VARIANTS]
+
+def _delete_image(filename):
+    for path in [os.path.join(MEDIA_DIR, filename)] + _variant_files(filename):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def enforce_retention():
+    """Deletes expired images, then the oldest ones until the directory fits MAX_BYTES."""
+    if not os.path.isdir(MEDIA_DIR):
+        return
+    images = []
+    total = 0
+    for entry in os.scandir(MEDIA_DIR):
+        if not entry.is_file() or entry.name.endswith(".tmp"):
+            continue
+        size = entry.stat().st_size + sum(os.path.getsize(p) for p in _variant_files(entry.name) if os.path.exists(p))
+        images.append((entry.stat().st_mtime, entry.name, size))
+        total += size
+
+    images.sort()
+    now = time.time()
+    for mtime, filename, size in images:
+        expired = MAX_AGE_DAYS > 0 and now - mtime > MAX_AGE_DAYS * 86400
+        if not expired and total <= MAX_BYTES:
+            break
+        if is_image_referenced(filename):
+            continue
+        print(f"--- Evicting generated image {filename} ---")
+        _delete_image(filename)
+        total -= size
+
+def _process_new_image(path):
+    try:
+        build_variants(path)
+        enforce_retention()
+    except Exception as e:
+        print(f"Error processing generated image {path}: {str(e)}")
+
+def schedule_processing(path):
+    """Builds variants and applies retention in the background."""
+    _executor.submit(_process_new_image, path)
+
+def resolve(filename, variant="original"):
+    """
+    Path to serve for an image request, or None. Unknown or not-yet-built
+    variants fall back to the original.
+    """
+    if filename != os.path.basename(filename) or filename.startswith("."):
+        return None
+    original = os.path.join(MEDIA_DIR, filename)
+    if not os.path.isfile(original):
+        return None
+    if variant in VARIANTS:
+        path = variant_path(filename, variant)
+        if os.path.isfile(path):
+            return path
+    return original
+
+def cache_headers(filename, served_path, variant="original"):
+    match = CONTENT_ADDRESSED.match(filename)
+    if variant in VARIANTS and served_path != variant_path(filename, variant):
+        # ETag of the original, so the real variant (different ETag) replaces it once built
+        headers = cache_headers(filename, served_path)
+        headers["Cache-Control"] = FALLBACK_CACHE_CONTROL
+        return headers
+    if match:
+        # The name is the content hash, so the hash (plus variant) is a strong ETag
+        variant = os.path.basename(served_path)[len(filename) - 4:]
+        return {"ETag": f'"{match.group(1)}{variant}"', "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    stat = os.stat(served_path)
+    return {"ETag": f'"{stat.st_size:x}-{int(stat.st_mtime):x}"', "Cache-Control": MUTABLE_CACHE_CONTROL}
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
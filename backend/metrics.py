@@ -0,0 +1,166 @@
+import bisect
+import contextvars
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Metrics and request tracing
+# ---------------------------
+# A small in-process registry rendered in the Prometheus text format at
+# /metrics (counters and histograms with labels, which is all we need, so
+# no prometheus_client dependency). The /chat pipeline records one
+# histogram per stage, so a slow turn can be pinned on extraction, SQLite,
+# the scheduler queue or the model itself:
+#   chat_stage_seconds{stage="extract|prompt|image|history|model|db_write"}
+#   model_queue_wait_seconds / model_ttft_seconds / model_generation_seconds
+#   model_tokens_per_second (from Ollama's eval_count / eval_duration)
+#   document_extraction_seconds / image_generation_seconds
+#
+# Logs: log_event() writes one JSON object per line to stdout, tagged with
+# the current request id (taken from X-Request-ID or generated by the
+# middleware in main, and carried into worker threads by concurrency.py).
+
+# Buckets in seconds: sub-millisecond DB work up to multi-minute generations
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200)
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    le = f'le="{_format_value(float(bound))}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [le])} {cumulative}")
+                inf = _format_labels(self.labels, key, ['le="+Inf"'])
+                lines.append(f"{self.name}_bucket{inf} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(float(series[-2]))}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}")
+        return lines
+
+_registry = []
+
+def counter(name, help_text, labels=()):
+    metric = Counter(name, help_text, labels)
+    _registry.append(metric)
+    return metric
+
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+    metric = Histogram(name, help_text, labels, buckets)
+    _registry.append(metric)
+    return metric
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+http_requests = counter("http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_latency = histogram("http_request_duration_seconds", "HTTP request latency (until the response starts)", ("method", "route"))
+chat_stage = histogram("chat_stage_seconds", "Time spent in each stage of a chat turn", ("stage",))
+queue_wait = histogram("model_queue_wait_seconds", "Time a request waited for a scheduler slot", ("model",))
+ttft = histogram("model_ttft_seconds", "Time from the model call to its first token", ("model",))
+generation = histogram("model_generation_seconds", "Total model call time, including queueing", ("model",))
+token_rate = histogram("model_tokens_per_second", "Decode speed reported by Ollama (eval_count / eval_duration)",
+                       ("model",), TOKEN_RATE_BUCKETS)
+tokens = counter("model_tokens_total", "Tokens processed by Ollama", ("model", "kind"))
+model_errors = counter("model_errors_total", "Failed model calls", ("model",))
+document_extraction = histogram("document_extraction_seconds", "Text extraction time on cache misses", ("format",))
+image_generation = histogram("image_generation_seconds", "Image generation time per job", ("status",))
+
+def record_ollama_usage(model, response):
+    """Token counters and decode speed from the eval stats on a final Ollama response."""
+    eval_count = response.get("eval_count") or 0
+    eval_duration = response.get("eval_duration") or 0
+    prompt_count = response.get("prompt_eval_count") or 0
+    if prompt_count:
+        tokens.inc(prompt_count, model=model, kind="prompt")
+    if eval_count:
+        tokens.inc(eval_count, model=model, kind="completion")
+        if eval_duration:
+            token_rate.observe(eval_count / (eval_duration / 1e9), model=model)
+
+# Structured logs
+
+_logger = logging.getLogger("chatbot")
+if not _logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    _logger.addHandler(_handler)
+    _logger.setLevel(logging.INFO)
+    _logger.propagate = False
+
+def log_event(event, **fields):
+    record = {"ts": round(time.time(), 3), "event": event}
+    request_id = request_id_var.get()
+    if request_id:
+        record["request_id"] = request_id
+    record.update(fields)
+    _logger.info(json.dumps(record, default=str))
@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from ollama_pool import pool
+
+# Model lifecycle: preload, keep-alive and memory budget
+# ------------------------------------------------------
+# Ollama loads a model on first use and unloads it after keep_alive (5m by
+# default), so the first deepseek/qwen3/vision request after a quiet spell
+# pays a multi-second load on top of generation. This module:
+# - preloads the configured models at startup, in priority order, as long as
+#   they fit MODEL_MEMORY_BUDGET_GB
+# - picks keep_alive per request from the model's recent traffic: busy
+#   models stay resident longer, rarely used ones are let go sooner
+# - before a request for a model that isn't resident, unloads idle
+#   least-recently-used models if loading it would exceed the memory budget
+# - reports what's resident for the readiness/model endpoints
+# Calls go through ollama_pool. With several hosts, MODEL_MEMORY_BUDGET_GB is
+# per host, and residency is the union of what the hosts have loaded.
+
+MEMORY_BUDGET_GB = float(os.getenv("MODEL_MEMORY_BUDGET_GB", "12"))
+PRELOAD_ENABLED = os.getenv("PRELOAD_MODELS", "1") == "1"
+RESIDENCY_REFRESH_SECONDS = 10
+
+# Approximate resident size of each model (Q4 weights + KV cache), used
+# until Ollama reports the real size via /api/ps
+DEFAULT_MODEL_SIZE_GB = 5.0
+model_sizes_gb = {
+    "mistral:latest": 4.4,
+    "deepseek-r1:7b": 4.7,
+    "qwen3:8b": 5.2,
+    "qwen2.5vl:7b": 6.0,
+}
+
+# keep_alive tiers by requests seen in the last TRAFFIC_WINDOW_SECONDS
+TRAFFIC_WINDOW_SECONDS = 15 * 60
+BUSY_REQUESTS = 10
+KEEP_ALIVE_BUSY = "60m"
+KEEP_ALIVE_DEFAULT = "15m"
+KEEP_ALIVE_IDLE = "2m"
+
+_lock = threading.Lock()
+_recent_requests = {}   # model -> deque of timestamps
+_in_flight = {}         # model -> running requests
+_resident = {}          # model -> {"size_gb", "expires_at"}
+_resident_checked_at = 0.0
+_ollama_error = None
+_preload_state = {"status": "pending", "loaded": [], "skipped": [], "failed": {}}
+
+def model_size_gb(model):
+    with _lock:
+        info = _resident.get(model)
+    if info and info.get("size_gb"):
+        return info["size_gb"]
+    return model_sizes_gb.get(model, DEFAULT_MODEL_SIZE_GB)
+
+def _recent_count(model, now):
+    timestamps = _recent_requests.get(model)
+    if not timestamps:
+        return 0
+    while timestamps and timestamps[0] < now - TRAFFIC_WINDOW_SECONDS:
+        timestamps.popleft()
+    return len(timestamps)
+
+def keep_alive_for(model):
+    """keep_alive to send with a request, based on the model's recent traffic."""
+    with _lock:
+        count = _recent_count(model, time.time())
+    if count >= BUSY_REQUESTS:
+        return KEEP_ALIVE_BUSY
+    if count <= 1:
+        return KEEP_ALIVE_IDLE
+    return KEEP_ALIVE_DEFAULT
+
+def refresh_residency(force=False):
+    """Re-reads the loaded models from Ollama (/api/ps), at most every few seconds."""
+    global _resident_checked_at, _ollama_error
+    now = time.time()
+    if not force and now - _resident_checked_at < RESIDENCY_REFRESH_SECONDS:
+        return
+    try:
+        response = pool.ps()
+        _ollama_error = None
+    except Exception as e:
+        _ollama_error = str(e)
+        print(f"Could not read loaded models from Ollama: {str(e)}")
+        return
+    resident = {}
+    for entry in response['models']:
+        expires_at = entry['expires_at']
+        resident[entry['model']] = {
+            "size_gb": round((entry['size'] or 0) / 1e9, 2) or None,
+            "expires_at": str(expires_at) if expires_at else None,
+        }
+    with _lock:
+        _resident.clear()
+        _resident.update(resident)
+        _resident_checked_at = now
+
+def unload(model):
+    print(f"--- Unloading {model} to stay within the memory budget ---")
+    pool.unload(model)
+    with _lock:
+        _resident.pop(model, None)
+
+def _make_room_for(model):
+    refresh_residency()
+    with _lock:
+        if model in _resident:
+            return
+        used = sum(info.get("size_gb") or model_sizes_gb.get(name, DEFAULT_MODEL_SIZE_GB)
+                   for name, info in _resident.items())
+        needed = model_sizes_gb.get(model, DEFAULT_MODEL_SIZE_GB)
+        # Idle models first, least recently used first
+        candidates = sorted(
+            (name for name in _resident if not _in_flight.get(name)),
+            key=lambda name: _recent_requests[name][-1] if _recent_requests.get(name) else 0,
+        )
+        to_unload = []
+        for name in candidates:
+            if used + needed <= MEMORY_BUDGET_GB * pool.host_count():
+                break
+            to_unload.append(name)
+            used -= _resident[name].get("size_gb") or model_sizes_gb.get(name, DEFAULT_MODEL_SIZE_GB)
+    for name in to_unload:
+        try:
+            unload(name)
+        except Exception as e:
+            print(f"Error unloading {name}: {str(e)}")
+
+@contextmanager
+def in_use(model):
+    """
+    Wraps one model request: records traffic, frees memory for the model if
+    needed and yields the keep_alive to send with the request.
+    """
+    with _lock:
+        _recent_requests.setdefault(model, deque()).append(time.time())
+        _in_flight[model] = _in_flight.get(model, 0) + 1
+    try:
+        try:
+            _make_room_for(model)
+        except Exception as e:
+            print(f"Error checking model memory budget: {str(e)}")
+        with _lock:
+            # The request is about to load it, so count it against the budget now
+            _resident.setdefault(model, {"size_gb": None, "expires_at": None})
+        yield keep_alive_for(model)
+    finally:
+        with _lock:
+            _in_flight[model] = max(0, _in_flight.get(model, 0) - 1)
+
+def preload(models):
+    """
+    Loads models in priority order until the memory budget is used up.
+    Runs at startup, off the request path.
+    """
+    _preload_state["status"] = "running"
+    used = 0.0
+    for model in dict.fromkeys(models):
+        size = model_sizes_gb.get(model, DEFAULT_MODEL_SIZE_GB)
+        if used + size > MEMORY_BUDGET_GB * pool.host_count():
+            _preload_state["skipped"].append(model)
+            continue
+        try:
+            print(f"--- Preloading {model} ---")
+            # An empty prompt makes Ollama load the model without generating
+            pool.generate(model=model, prompt="", keep_alive=KEEP_ALIVE_DEFAULT)
+            _preload_state["loaded"].append(model)
+            used += size
+        except Exception as e:
+            _preload_state["failed"][model] = str(e)
+    refresh_residency(force=True)
+    _preload_state["status"] = "done"
+
+def readiness():
+    """(ready, reasons): ready once preloading has finished and Ollama answers."""
+    refresh_residency(force=True)
+    reasons = []
+    if PRELOAD_ENABLED and _preload_state["status"] != "done":
+        reasons.append(f"preload {_preload_state['status']}")
+    if _ollama_error:
+        reasons.append(f"ollama unreachable: {_ollama_error}")
+    return not reasons, reasons
+
+def status():
+    refresh_residency()
+    now = time.time()
+    with _lock:
+        traffic = {model: _recent_count(model, now) for model in _recent_requests}
+        resident = {model: dict(info) for model, info in _resident.items()}
+        in_flight = {model: count for model, count in _in_flight.items() if count}
+    return {
+        "memory_budget_gb": MEMORY_BUDGET_GB * pool.host_count(),
+        "backends": pool.status(),
+        "resident": resident,
+        "resident_gb": round(sum(model_size_gb(m) for m in resident), 2),
+        "in_flight": in_flight,
+        "recent_requests": traffic,
+        "keep_alive": {model: keep_alive_for(model) for model in traffic},
+        "preload": {**_preload_state, "loaded": list(_preload_state["loaded"])},
+    }
@@ -0,0 +1,256 @@
+import os
+import threading
+import time
+
+import httpx
+import ollama
+
+import metrics
+
+# Ollama backend pool
+# -------------------
+# Every model call goes through here instead of the module-level ollama.*
+# functions, so models can be served by several Ollama hosts:
+#   OLLAMA_HOSTS=http://gpu1:11434,http://gpu2:11434    hosts serving every model
+#   OLLAMA_MODEL_HOSTS="qwen2.5vl:7b=http://gpu2:11434|http://gpu3:11434"
+#                                                       per-model overrides (; separated)
+# Without either, the single OLLAMA_HOST (default localhost) is used as before.
+#
+# Routing: among the healthy hosts for a model, prefer the ones that already
+# have it resident (a cold load costs seconds) as long as they have fewer
+# than OLLAMA_HOST_PARALLEL requests running, then the one with the fewest
+# requests in flight, then the one with the fewest models resident. Each
+# host keeps one ollama.Client, whose HTTP connections are reused between
+# requests.
+#
+# Health: a background thread asks every host for its loaded models (/api/ps)
+# every OLLAMA_HEALTH_INTERVAL seconds. A host that refuses connections or
+# drops a request is marked down at once and skipped until a probe succeeds.
+#
+# Failover: a request that fails because its host is unreachable, dropped
+# the connection, returned a 5xx or doesn't have the model is retried on the
+# next best host, up to OLLAMA_MAX_ATTEMPTS hosts. Streams fail over only
+# until the first token; after that the partial reply can't be resumed
+# elsewhere and the error is raised to the caller.
+
+DEFAULT_HOST = os.getenv("OLLAMA_HOST", "http://127.0.0.1:11434")
+HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+PROBE_TIMEOUT = float(os.getenv("OLLAMA_PROBE_TIMEOUT", "2"))
+REQUEST_TIMEOUT = float(os.getenv("OLLAMA_REQUEST_TIMEOUT", "600"))
+MAX_ATTEMPTS = int(os.getenv("OLLAMA_MAX_ATTEMPTS", "3"))
+# Requests a host runs at once (Ollama's OLLAMA_NUM_PARALLEL) before a busy
+# model is spread to other hosts despite the load cost there
+HOST_PARALLEL = int(os.getenv("OLLAMA_HOST_PARALLEL", "2"))
+
+backend_requests = metrics.counter("ollama_backend_requests_total", "Model calls per Ollama host and outcome",
+                                   ("host", "outcome"))
+backend_failovers = metrics.counter("ollama_backend_failovers_total", "Calls retried on another host after a failure",
+                                    ("host",))
+
+def _normalize(url):
+    url = url.strip().rstrip("/")
+    if url and "://" not in url:
+        url = "http://" + url
+    return url
+
+def parse_hosts(value):
+    return [_normalize(url) for url in (value or "").split(",") if url.strip()]
+
+def parse_model_hosts(value):
+    """'model=url|url;model=url' -> {model: [urls]}"""
+    mapping = {}
+    for entry in (value or "").split(";"):
+        model, _, urls = entry.partition("=")
+        if model.strip() and urls.strip():
+            mapping[model.strip()] = [_normalize(url) for url in urls.split("|") if url.strip()]
+    return mapping
+
+def _retryable(error):
+    """(retry on another host, host is down) for a failed call."""
+    if isinstance(error, (ConnectionError, httpx.TransportError)):
+        return True, True
+    if isinstance(error, ollama.ResponseError):
+        # 404: this host hasn't pulled the model; 5xx: the host failed the request
+        return error.status_code == 404 or error.status_code >= 500, False
+    return False, False
+
+class OllamaBackend:
+    def __init__(self, url):
+        self.url = url
+        self.client = ollama.Client(host=url, timeout=REQUEST_TIMEOUT)
+        self.probe_client = ollama.Client(host=url, timeout=PROBE_TIMEOUT)
+        self.healthy = True  # optimistic until the first probe or failure says otherwise
+        self.loaded = set()
+        self.in_flight = 0
+        self.last_error = None
+        self.checked_at = None
+
+    def status(self):
+        return {"healthy": self.healthy, "in_flight": self.in_flight, "loaded": sorted(self.loaded),
+                "last_error": self.last_error, "checked_at": self.checked_at}
+
+class OllamaPool:
+    def __init__(self, hosts=None, model_hosts=None, health_interval=HEALTH_INTERVAL, max_attempts=MAX_ATTEMPTS,
+                 host_parallel=HOST_PARALLEL):
+        hosts = hosts or [_normalize(DEFAULT_HOST)]
+        model_hosts = model_hosts or {}
+        self.backends = {}
+        for url in hosts + [url for urls in model_hosts.values() for url in urls]:
+            self.backends.setdefault(url, OllamaBackend(url))
+        self.default_hosts = hosts
+        self.model_hosts = model_hosts
+        self.health_interval = health_interval
+        self.max_attempts = max_attempts
+        self.host_parallel = host_parallel
+        self._lock = threading.Lock()
+        self._probe_thread = None
+
+    def backends_for(self, model):
+        return [self.backends[url] for url in self.model_hosts.get(model, self.default_hosts)]
+
+    def host_count(self, model=None):
+        """Healthy hosts for the model (or in the pool), at least 1."""
+        backends = self.backends_for(model) if model else self.backends.values()
+        return max(1, sum(1 for backend in backends if backend.healthy))
+
+    def _pick(self, model, tried):
+        with self._lock:
+            candidates = [b for b in self.backends_for(model) if b not in tried]
+            if not candidates:
+                return None
+            # Down hosts only as a last resort, in case they came back since the last probe.
+            # Ties go to the host with the fewest models resident, which spreads models across hosts.
+            return min(candidates, key=lambda b: (not b.healthy, b.in_flight >= self.host_parallel,
+                                                  model not in b.loaded, b.in_flight, len(b.loaded)))
+
+    def _start(self, backend):
+        with self._lock:
+            backend.in_flight += 1
+
+    def _finish(self, backend, model, error=None, down=False):
+        with self._lock:
+            backend.in_flight -= 1
+            if error is None:
+                backend.healthy = True
+                if model:
+                    backend.loaded.add(model)
+            elif down:
+                backend.healthy = False
+                backend.last_error = str(error)
+        outcome = "ok" if error is None else ("down" if down else "error")
+        backend_requests.inc(host=backend.url, outcome=outcome)
+
+    def _ensure_probing(self):
+        if self.health_interval <= 0:
+            return
+        with self._lock:
+            if self._probe_thread is None or not self._probe_thread.is_alive():
+                self._probe_thread = threading.Thread(target=self._probe_loop, name="ollama-probe", daemon=True)
+                self._probe_thread.start()
+
+    def _probe_loop(self):
+        while True:
+            self.probe()
+            time.sleep(self.health_interval)
+
+    def probe(self):
+        """Refreshes health and loaded models of every host. Returns {url: /api/ps response or None}."""
+        results = {}
+        for backend in list(self.backends.values()):
+            try:
+                response = backend.probe_client.ps()
+                loaded = {entry['model'] for entry in response['models']}
+                with self._lock:
+                    backend.healthy = True
+                    backend.loaded = loaded
+                    backend.last_error = None
+                results[backend.url] = response
+            except Exception as e:
+                with self._lock:
+                    backend.healthy = False
+                    backend.last_error = str(e)
+                results[backend.url] = None
+            backend.checked_at = time.time()
+        return results
+
+    def call(self, model, method, **kwargs):
+        """Runs client.<method>(model=model, **kwargs) on the best host, failing over on host errors."""
+        self._ensure_probing()
+        tried = []
+        while True:
+            backend = self._pick(model, tried)
+            tried.append(backend)
+            self._start(backend)
+            try:
+                result = getattr(backend.client, method)(model=model, **kwargs)
+            except Exception as e:
+                retry, down = _retryable(e)
+                self._finish(backend, model, e, down)
+                if not retry or len(tried) >= self.max_attempts or self._pick(model, tried) is None:
+                    raise
+                print(f"Ollama host {backend.url} failed ({str(e)}), retrying {model} on another host")
+                backend_failovers.inc(host=backend.url)
+                continue
+            self._finish(backend, model)
+            return result
+
+    def chat(self, model, stream=False, **kwargs):
+        if stream:
+            return self._stream_chat(model, **kwargs)
+        return self.call(model, "chat", **kwargs)
+
+    def _stream_chat(self, model, **kwargs):
+        self._ensure_probing()
+        tried = []
+        while True:
+            backend = self._pick(model, tried)
+            tried.append(backend)
+            self._start(backend)
+            started = False
+            try:
+                for chunk in backend.client.chat(model=model, stream=True, **kwargs):
+                    started = True
+                    yield chunk
+            except GeneratorExit:
+                self._finish(backend, model)
+                raise
+            except Exception as e:
+                retry, down = _retryable(e)
+                self._finish(backend, model, e, down)
+                if started or not retry or len(tried) >= self.max_attempts or self._pick(model, tried) is None:
+                    raise
+                print(f"Ollama host {backend.url} failed ({str(e)}), retrying {model} on another host")
+                backend_failovers.inc(host=backend.url)
+                continue
+            self._finish(backend, model)
+            return
+
+    def generate(self, model, **kwargs):
+        return self.call(model, "generate", **kwargs)
+
+    def embed(self, model, **kwargs):
+        return self.call(model, "embed", **kwargs)
+
+    def ps(self):
+        """Loaded models across all hosts, in the /api/ps shape. Raises if no host answers."""
+        results = self.probe()
+        answered = [response for response in results.values() if response is not None]
+        if not answered:
+            errors = {url: backend.last_error for url, backend in self.backends.items()}
+            raise ConnectionError(f"No Ollama host reachable: {errors}")
+        return {"models": [entry for response in answered for entry in response['models']]}
+
+    def unload(self, model):
+        """Unloads the model on every host that has it resident."""
+        for backend in self.backends_for(model):
+            if model in backend.loaded:
+                backend.client.generate(model=model, prompt="", keep_alive=0)
+                with self._lock:
+                    backend.loaded.discard(model)
+
+    def status(self):
+        with self._lock:
+            return {url: backend.status() for url, backend in self.backends.items()}
+
+# Shared pool used by local_client, model_manager, conversation_memory and retrieval
+pool = OllamaPool(parse_hosts(os.getenv("OLLAMA_HOSTS")), parse_model_hosts(os.getenv("OLLAMA_MODEL_HOSTS")))
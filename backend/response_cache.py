@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from extraction_cache import file_hash
+
+# Response cache in front of generate_response
+# --------------------------------------------
+# Health checks and FAQ-style questions ("Hello, are you working?") keep
+# arriving with identical inputs, and each one costs a full 7B generation on
+# a CPU box. Replies are cached by:
+#   (model, normalized prompt, image content hash, conversation context hash,
+#    scope)
+# so the same question inside a different conversation or about a different
+# image never gets a stale answer. Requests with attachments pass the user
+# id as scope: their prompt carries the user's document text, and the reply
+# must not be served to anyone else.
+#
+# Optional semantic tier (RESPONSE_CACHE_SEMANTIC=1): for stateless requests
+# (no history, no image, no scope) a near-duplicate prompt, by embedding
+# cosine similarity, can also reuse a reply.
+#
+# Entries expire after RESPONSE_CACHE_TTL seconds and the cache holds at most
+# RESPONSE_CACHE_MAX_ENTRIES entries (least recently used evicted first).
+
+ENABLED = os.getenv("RESPONSE_CACHE", "1") == "1"
+TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+# Comma-separated models that must never be served from cache
+DISABLED_MODELS = {m.strip() for m in os.getenv("RESPONSE_CACHE_DISABLED_MODELS", "").split(",") if m.strip()}
+SEMANTIC_ENABLED = os.getenv("RESPONSE_CACHE_SEMANTIC", "0") == "1"
+SEMANTIC_THRESHOLD = float(os.getenv("RESPONSE_CACHE_SEMANTIC_THRESHOLD", "0.95"))
+
+_lock = threading.Lock()
+# key -> {"model", "reply", "expires", "vector"}
+_entries = OrderedDict()
+_stats = {"hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "bypassed": 0}
+_model_stats = {}
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r"\s+", " ", prompt).strip().casefold()
+
+def _context_hash(history) -> str:
+    if not history:
+        return ""
+    return hashlib.sha256(json.dumps(history, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _image_hash(image_path) -> str:
+    if not image_path:
+        return ""
+    try:
+        return file_hash(image_path)
+    except OSError:
+        # Unreadable image: fall back to the reference itself
+        return hashlib.sha256(image_path.encode("utf-8")).hexdigest()
+
+def make_key(model, prompt, image_path=None, history=None, scope=None) -> str:
+    parts = [model, normalize_prompt(prompt), _image_hash(image_path), _context_hash(history), scope or ""]
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+def is_cacheable(model) -> bool:
+    return ENABLED and model not in DISABLED_MODELS
+
+def _count(model, outcome):
+    _stats[outcome] += 1
+    per_model = _model_stats.setdefault(model, {"hits": 0, "semantic_hits": 0, "misses": 0})
+    if outcome in per_model:
+        per_model[outcome] += 1
+
+def _is_semantic_candidate(image_path, history, scope):
+    return SEMANTIC_ENABLED and not image_path and not history and not scope
+
+def _embed(prompt):
+    from retrieval import embed_texts  # imported lazily: only needed for the semantic tier
+    return embed_texts([normalize_prompt(prompt)])[0]
+
+def _evict_expired(now):
+    for key in [key for key, entry in _entries.items() if entry["expires"] <= now]:
+        del _entries[key]
+        _stats["evictions"] += 1
+
+def get(model, prompt, image_path=None, history=None, scope=None):
+    """Returns a cached reply or None."""
+    if not is_cacheable(model):
+        with _lock:
+            _stats["bypassed"] += 1
+        return None
+
+    key = make_key(model, prompt, image_path, history, scope)
+    now = time.time()
+    with _lock:
+        entry = _entries.get(key)
+        if entry and entry["expires"] > now:
+            _entries.move_to_end(key)
+            _count(model, "hits")
+            return entry["reply"]
+        if entry:
+            del _entries[key]
+            _stats["evictions"] += 1
+
+    if _is_semantic_candidate(image_path, history, scope):
+        try:
+            query = _embed(prompt)
+        except Exception:
+            query = None
+        if query is not None:
+            with _lock:
+                best_key, best_score = None, SEMANTIC_THRESHOLD
+                for candidate_key, candidate in _entries.items():
+                    if candidate["model"] != model or candidate["vector"] is None or candidate["expires"] <= now:
+                        continue
+                    score = float(np.dot(candidate["vector"], query))
+                    if score >= best_score:
+                        best_key, best_score = candidate_key, score
+                if best_key:
+                    _entries.move_to_end(best_key)
+                    _count(model, "semantic_hits")
+                    return _entries[best_key]["reply"]
+
+    with _lock:
+        _count(model, "misses")
+    return None
+
+def put(model, prompt, reply, image_path=None, history=None, scope=None):
+    if not is_cacheable(model) or not reply:
+        return
+    vector = None
+    if _is_semantic_candidate(image_path, history, scope):
+        try:
+            vector = _embed(prompt)
+        except Exception:
+            vector = None
+
+    key = make_key(model, prompt, image_path, history, scope)
+    now = time.time()
+    with _lock:
+        _entries[key] = {"model": model, "reply": reply, "expires": now + TTL_SECONDS, "vector": vector}
+        _entries.move_to_end(key)
+        _stats["stores"] += 1
+        if len(_entries) > MAX_ENTRIES:
+            _evict_expired(now)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+            _stats["evictions"] += 1
+
+def stats():
+    with _lock:
+        lookups = _stats["hits"] + _stats["semantic_hits"] + _stats["misses"]
+        hit_rate = (_stats["hits"] + _stats["semantic_hits"]) / lookups if lookups else 0.0
+        return {
+            **_stats,
+            "entries": len(_entries),
+            "hit_rate": round(hit_rate, 4),
+            "models": {model: dict(counts) for model, counts in _model_stats.items()},
+        }
@@ -0,0 +1,259 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from document_processor import EXTRACTOR_VERSION, is_supported
+from extraction_cache import file_hash, get_extracted_text, load_extracted_text
+from ollama_pool import pool
+
+# Retrieval over uploaded documents
+# ---------------------------------
+# Instead of pasting every attached file into the prompt, documents are split
+# into overlapping chunks at upload time and only the top-k chunks relevant to
+# the question go to the model. Small documents are still sent whole, since
+# retrieval can only lose information there.
+#
+# Index layout (one directory per document content hash):
+#   retrieval_index/<sha256>-v<extractor>-i<index>/chunks.json   chunk texts
+#   retrieval_index/<sha256>-v<extractor>-i<index>/vectors.npy   float32, L2-normalized
+# vectors.npy is memory-mapped at query time, so large documents aren't read
+# into RAM just to score a question. If the embedding model isn't available
+# the document is ranked with BM25 instead, from chunks kept in memory only:
+# nothing is written, so the full index is built once embedding works again
+# (retried at most every EMBED_RETRY_SECONDS). At most UNEMBEDDED_MAX_DOCUMENTS
+# of those are kept, least recently used dropped first; a dropped one is
+# chunked again from the extraction cache when asked for. Documents whose
+# text can't be extracted aren't indexed at all.
+
+INDEX_DIR = os.getenv("RETRIEVAL_INDEX_DIR", "retrieval_index")
+EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
+CHUNK_CHARS = 1200
+CHUNK_OVERLAP = 200
+EMBED_BATCH_SIZE = 32
+EMBED_RETRY_SECONDS = 60
+UNEMBEDDED_MAX_DOCUMENTS = 64
+# Bump when indexing changes so existing indexes are rebuilt. 2: extraction
+# errors and BM25-only fallbacks are no longer written to disk.
+INDEX_VERSION = 2
+TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "6"))
+# Below this many characters (all attached files together) the whole text is sent
+WHOLE_TEXT_MAX_CHARS = int(os.getenv("RETRIEVAL_WHOLE_TEXT_MAX_CHARS", "6000"))
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_index_locks = {}  # index path -> [lock, threads holding or waiting for it]
+_unembedded = OrderedDict()  # index path -> (chunks, time embedding failed), served with BM25
+_index_locks_guard = threading.Lock()
+
+def chunk_text(text: str, chunk_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP):
+    """Splits text into ~chunk_chars pieces, preferring paragraph and sentence boundaries."""
+    text = text.strip()
+    if not text:
+        return []
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_chars, len(text))
+        if end < len(text):
+            # Back off to the nearest paragraph / line / sentence break in the second half
+            window = text[start + chunk_chars // 2:end]
+            for separator in ("\n\n", "\n", ". "):
+                cut = window.rfind(separator)
+                if cut != -1:
+                    end = start + chunk_chars // 2 + cut + len(separator)
+                    break
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+def tokenize(text: str):
+    return re.findall(r"\w+", text.lower())
+
+def embed_texts(texts):
+    """Embeds texts with the Ollama embedding model. Returns an (n, dim) normalized float32 array."""
+    vectors = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        response = pool.embed(model=EMBED_MODEL, input=texts[i:i + EMBED_BATCH_SIZE])
+        vectors.extend(response["embeddings"])
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def _index_path(file_path: str) -> str:
+    return os.path.join(INDEX_DIR, f"{file_hash(file_path)}-v{EXTRACTOR_VERSION}-i{INDEX_VERSION}")
+
+@contextmanager
+def _index_lock(path):
+    # One lock per document being indexed, dropped once nobody holds or waits for it
+    with _index_locks_guard:
+        entry = _index_locks.setdefault(path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _index_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _index_locks[path]
+
+def _get_unembedded(index_path):
+    with _index_locks_guard:
+        pending = _unembedded.get(index_path)
+        if pending:
+            _unembedded.move_to_end(index_path)
+        return pending
+
+def _set_unembedded(index_path, chunks):
+    with _index_locks_guard:
+        _unembedded[index_path] = (chunks, time.time())
+        _unembedded.move_to_end(index_path)
+        while len(_unembedded) > UNEMBEDDED_MAX_DOCUMENTS:
+            _unembedded.popitem(last=False)
+
+def _drop_unembedded(index_path):
+    with _index_locks_guard:
+        _unembedded.pop(index_path, None)
+
+def index_document(file_path: str):
+    """
+    Chunks and embeds a document (once per content hash). Returns its index
+    directory, or None if the document's text can't be extracted.
+    """
+    index_path = _index_path(file_path)
+    chunks_file = os.path.join(index_path, "chunks.json")
+    if os.path.exists(chunks_file):
+        return index_path
+
+    with _index_lock(index_path):
+        if os.path.exists(chunks_file):
+            return index_path
+
+        pending = _get_unembedded(index_path)
+        if pending and time.time() - pending[1] < EMBED_RETRY_SECONDS:
+            return index_path
+        if pending:
+            chunks = pending[0]
+        else:
+            try:
+                chunks = chunk_text(load_extracted_text(file_path))
+            except Exception as e:
+                print(f"--- Not indexing {os.path.basename(file_path)}: {str(e)} ---")
+                return None
+
+        if chunks:
+            try:
+                vectors = embed_texts(chunks)
+            except Exception as e:
+                print(f"--- Embedding unavailable ({e}), {os.path.basename(file_path)} will use BM25 for now ---")
+                _set_unembedded(index_path, chunks)
+                return index_path
+            os.makedirs(index_path, exist_ok=True)
+            np.save(os.path.join(index_path, "vectors.npy"), vectors)
+        os.makedirs(index_path, exist_ok=True)
+
+        # chunks.json is written last: its presence marks a complete index
+        tmp_file = chunks_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"source": os.path.basename(file_path), "chunks": chunks}, f)
+        os.replace(tmp_file, chunks_file)
+        _drop_unembedded(index_path)
+    return index_path
+
+def _load_index(index_path, file_path):
+    pending = _get_unembedded(index_path)
+    if pending:
+        return pending[0], None
+    chunks_file = os.path.join(index_path, "chunks.json")
+    if not os.path.exists(chunks_file):
+        # BM25-only chunks dropped from memory since index_document returned
+        return chunk_text(load_extracted_text(file_path)), None
+    with open(chunks_file, encoding="utf-8") as f:
+        chunks = json.load(f)["chunks"]
+    vectors_file = os.path.join(index_path, "vectors.npy")
+    vectors = np.load(vectors_file, mmap_mode="r") if os.path.exists(vectors_file) else None
+    return chunks, vectors
+
+def bm25_scores(query: str, chunks):
+    query_terms = set(tokenize(query))
+    if not query_terms or not chunks:
+        return [0.0] * len(chunks)
+    docs = [Counter(tokenize(chunk)) for chunk in chunks]
+    avg_len = sum(sum(doc.values()) for doc in docs) / len(docs) or 1.0
+    doc_freq = {term: sum(1 for doc in docs if term in doc) for term in query_terms}
+
+    scores = []
+    for doc in docs:
+        doc_len = sum(doc.values())
+        score = 0.0
+        for term in query_terms:
+            tf = doc.get(term, 0)
+            if not tf:
+                continue
+            idf = math.log(1 + (len(docs) - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+            score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * doc_len / avg_len))
+        scores.append(score)
+    return scores
+
+def retrieve(query: str, file_paths, top_k: int = TOP_K):
+    """
+    Returns the top_k most relevant chunks across the given documents as
+    (source_name, chunk_index, text) tuples, in document order.
+    Uses embedding similarity when every document has vectors, BM25 otherwise.
+    """
+    candidates = []  # (file_path, chunk_index, text)
+    vector_blocks = []
+    for file_path in file_paths:
+        index_path = index_document(file_path)
+        if index_path is None:
+            continue
+        chunks, vectors = _load_index(index_path, file_path)
+        for i, chunk in enumerate(chunks):
+            candidates.append((file_path, i, chunk))
+        vector_blocks.append(vectors)
+    if not candidates:
+        return []
+
+    scores = None
+    if all(block is not None for block in vector_blocks):
+        try:
+            query_vector = embed_texts([query])[0]
+            scores = np.concatenate([np.asarray(block) @ query_vector for block in vector_blocks])
+        except Exception as e:
+            print(f"--- Query embedding failed ({e}), falling back to BM25 ---")
+    if scores is None:
+        scores = np.asarray(bm25_scores(query, [text for _, _, text in candidates]))
+
+    best = np.argsort(-scores, kind="stable")[:top_k]
+    # Keep the original reading order so excerpts from one file stay coherent
+    order = {path: n for n, path in enumerate(file_paths)}
+    selected = sorted((candidates[i] for i in best), key=lambda c: (order[c[0]], c[1]))
+    return [(os.path.basename(path), i, text) for path, i, text in selected]
+
+def build_context(query: str, file_paths) -> str:
+    """Context block for the prompt: whole files when they're small, retrieved excerpts otherwise."""
+    file_paths = [path for path in file_paths if os.path.exists(path)]
+    texts = {path: get_extracted_text(path) for path in file_paths}
+
+    if sum(len(text) for text in texts.values()) <= WHOLE_TEXT_MAX_CHARS:
+        return "".join(f"\n--- Content of {os.path.basename(path)} ---\n{text}\n" for path, text in texts.items())
+
+    # Unsupported files only carry a one-line notice, so they aren't worth indexing
+    searchable = [path for path in file_paths if is_supported(path)]
+    context = "".join(f"\n--- Content of {os.path.basename(path)} ---\n{texts[path]}\n"
+                      for path in file_paths if not is_supported(path))
+    return context + "".join(f"\n--- Excerpt {i + 1} of {source} ---\n{text}\n"
+                             for source, i, text in retrieve(query, searchable))
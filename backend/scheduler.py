@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from ollama_pool import pool
+
+# Model-aware admission control for the Ollama router
+# ---------------------------------------------------
+# On one CPU box, Ollama can only keep a model or two in RAM. If deepseek,
+# qwen3, mistral and the vision model are all requested at once, it keeps
+# unloading one to load another and every request pays a multi-second swap.
+#
+# Every model call takes a slot here first:
+# - requests queue per model (FIFO within a model)
+# - at most MAX_ACTIVE_MODELS different models generate at the same time,
+#   each with at most its per-model concurrency cap
+# - the model that is already running keeps getting admitted while it has
+#   queued work (up to MAX_BATCH in a row), so same-model requests run as a
+#   batch instead of alternating models
+# - when a model's queue is full the request is rejected immediately with
+#   QueueFullError (-> HTTP 429) instead of piling up
+# - background work (summary refreshes) only runs on a slot that is free
+#   while nobody is queued, see background_slot; it never waits in or counts
+#   against the queues
+# With several Ollama hosts (see ollama_pool) both limits are per host: they
+# scale with the number of healthy hosts serving the model.
+
+MAX_ACTIVE_MODELS = int(os.getenv("SCHEDULER_MAX_ACTIVE_MODELS", "1"))
+DEFAULT_MODEL_CONCURRENCY = int(os.getenv("SCHEDULER_MODEL_CONCURRENCY", "2"))
+MAX_QUEUE_PER_MODEL = int(os.getenv("SCHEDULER_MAX_QUEUE", "16"))
+MAX_BATCH = int(os.getenv("SCHEDULER_MAX_BATCH", "8"))
+QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", "300"))
+
+# Per-model overrides of DEFAULT_MODEL_CONCURRENCY
+model_concurrency = {
+    "qwen2.5vl:7b": 1,
+}
+
+class QueueFullError(Exception):
+    def __init__(self, model, queue_depth):
+        super().__init__(f"Queue for {model} is full ({queue_depth} waiting)")
+        self.model = model
+        self.queue_depth = queue_depth
+
+class QueueTimeoutError(Exception):
+    def __init__(self, model, waited):
+        super().__init__(f"Timed out after {waited:.0f}s waiting for {model}")
+        self.model = model
+
+class _Ticket:
+    __slots__ = ("model", "enqueued_at")
+
+    def __init__(self, model):
+        self.model = model
+        self.enqueued_at = time.monotonic()
+
+class ModelScheduler:
+    def __init__(self, max_active_models=MAX_ACTIVE_MODELS, max_queue=MAX_QUEUE_PER_MODEL,
+                 max_batch=MAX_BATCH, queue_timeout=QUEUE_TIMEOUT):
+        self.max_active_models = max_active_models
+        self.max_queue = max_queue
+        self.max_batch = max_batch
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._waiting = {}   # model -> deque of tickets
+        self._running = {}   # model -> running count
+        self._current_model = None
+        self._batch_count = 0
+        self._admitted = {}  # model -> total admitted
+        self._rejected = {}  # model -> total rejected
+        self._switches = 0
+
+    def _capacity(self, model):
+        return model_concurrency.get(model, DEFAULT_MODEL_CONCURRENCY) * pool.host_count(model)
+
+    def _admissible(self, model):
+        if self._running.get(model, 0) >= self._capacity(model):
+            return False
+        if self._running.get(model, 0) > 0:
+            return True
+        active = sum(1 for count in self._running.values() if count > 0)
+        return active < self.max_active_models * pool.host_count()
+
+    def _next_model(self):
+        """Which model's head-of-queue request should be admitted next (None if nobody can run)."""
+        candidates = [m for m, queue in self._waiting.items() if queue and self._admissible(m)]
+        if not candidates:
+            return None
+        current = self._current_model
+        if current in candidates and self._batch_count < self.max_batch:
+            return current
+        # Batch exhausted (or current model idle): oldest waiting request wins
+        return min(candidates, key=lambda m: self._waiting[m][0].enqueued_at)
+
+    def ensure_capacity(self, model):
+        """Raises QueueFullError if a new request for this model would be rejected."""
+        with self._cond:
+            depth = len(self._waiting.get(model, ()))
+            if depth >= self.max_queue:
+                self._rejected[model] = self._rejected.get(model, 0) + 1
+                raise QueueFullError(model, depth)
+
+    def acquire(self, model):
+        """Blocks until the request may run. Returns the seconds spent queued."""
+        with self._cond:
+            queue = self._waiting.setdefault(model, deque())
+            if len(queue) >= self.max_queue:
+                self._rejected[model] = self._rejected.get(model, 0) + 1
+                raise QueueFullError(model, len(queue))
+            ticket = _Ticket(model)
+            queue.append(ticket)
+            deadline = ticket.enqueued_at + self.queue_timeout
+            try:
+                while not (queue[0] is ticket and self._next_model() == model):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise QueueTimeoutError(model, self.queue_timeout)
+                    self._cond.wait(remaining)
+            except BaseException:
+                queue.remove(ticket)
+                self._cond.notify_all()
+                raise
+
+            queue.popleft()
+            self._running[model] = self._running.get(model, 0) + 1
+            self._admitted[model] = self._admitted.get(model, 0) + 1
+            if model == self._current_model:
+                self._batch_count += 1
+            else:
+                self._current_model = model
+                self._batch_count = 1
+                self._switches += 1
+            # Others may now be admissible too (e.g. a second slot of the same model)
+            self._cond.notify_all()
+            return time.monotonic() - ticket.enqueued_at
+
+    def try_acquire(self, model):
+        """Takes a slot only if one is free now and no request is waiting for any model. Never queues."""
+        with self._cond:
+            if any(self._waiting.values()) or not self._admissible(model):
+                return False
+            self._running[model] = self._running.get(model, 0) + 1
+            return True
+
+    def release(self, model):
+        with self._cond:
+            self._running[model] -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, model):
+        """Holds a slot for the duration of the block; yields the seconds spent queued."""
+        waited = self.acquire(model)
+        try:
+            yield waited
+        finally:
+            self.release(model)
+
+    @contextmanager
+    def background_slot(self, model):
+        """Like slot, for work that can be skipped: yields whether a slot was free (see try_acquire)."""
+        acquired = self.try_acquire(model)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release(model)
+
+    def queue_position(self, model):
+        with self._cond:
+            return len(self._waiting.get(model, ()))
+
+    def stats(self):
+        with self._cond:
+            models = set(self._waiting) | set(self._running) | set(self._rejected)
+            return {
+                "current_model": self._current_model,
+                "model_switches": self._switches,
+                "models": {
+                    model: {
+                        "waiting": len(self._waiting.get(model, ())),
+                        "running": self._running.get(model, 0),
+                        "capacity": self._capacity(model),
+                        "admitted": self._admitted.get(model, 0),
+                        "rejected": self._rejected.get(model, 0),
+                    }
+                    for model in sorted(models)
+                },
+            }
+
+# Shared instance used by local_client
+scheduler = ModelScheduler()
@@ -1,12 +1,24 @@
 import requests
 import time
+import uuid
 
 BASE_URL = "http://127.0.0.1:8000"
 
+def start_chat():
+    # Every chat call needs a bearer token and a session the user owns
+    username, password = f"test-{uuid.uuid4().hex[:8]}", "test-password"
+    requests.post(f"{BASE_URL}/register", json={"username": username, "password": password})
+    token = requests.post(f"{BASE_URL}/login", json={"username": username, "password": password}).json()["token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    session_id = requests.post(f"{BASE_URL}/sessions", json={"title": "Test"}, headers=headers).json()["id"]
+    return headers, session_id
+
 def test_chat():
     print("Testing Chat Endpoint...")
     try:
-        response = requests.post(f"{BASE_URL}/chat", json={"message": "Hello, are you working?"})
+        headers, session_id = start_chat()
+        response = requests.post(f"{BASE_URL}/chat", json={"message": "Hello, are you working?", "session_id": session_id},
+                                 headers=headers)
         if response.status_code == 200:
             print(f"Chat Response: {response.json()}")
         else:
@@ -18,7 +30,9 @@ def test_image_gen_command():
     print("\nTesting Image Generation Command...")
     # NOTE: This might fail if HF_TOKEN is not set or valid, but we want to see the application logic flow.
     try:
-        response = requests.post(f"{BASE_URL}/chat", json={"message": "Generate image of a red cube"})
+        headers, session_id = start_chat()
+        response = requests.post(f"{BASE_URL}/chat", json={"message": "Generate image of a red cube", "session_id": session_id},
+                                 headers=headers)
         if response.status_code == 200:
             print(f"Image Gen Response: {response.json()}")
         else:
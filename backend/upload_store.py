@@ -0,0 +1,395 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+
+from auth import QuotaExceededError
+from concurrency import run_io
+import document_processor
+from database import (add_upload, get_upload, find_user_upload, get_user_upload_bytes, delete_upload,
+                      get_released_blobs, delete_blob_if_unreferenced, create_upload_session, get_upload_session,
+                      update_upload_session, delete_upload_session, get_stale_upload_sessions)
+
+# Upload storage
+# --------------
+# Files are stored once per distinct content, under the sha256 of their bytes
+# (uploads/blobs/ab/ab12...ef.pdf; the extension is kept because text
+# extraction goes by it). The multipart /upload body is parsed as it
+# arrives and the file part is hashed and written in the same pass. Each
+# /upload creates an upload row with a stable
+# id ("upl_...") pointing at a blob, and /chat takes those ids in
+# context_files and image, never server paths. Identical files therefore
+# cost one copy on disk, and the extraction cache, retrieval index and
+# vision cache (all keyed by content hash) are shared between them.
+#
+# Blobs are reference counted. Deleting the last upload of a blob marks it
+# released; collect_garbage() removes released blobs after
+# UPLOAD_GC_GRACE_SECONDS, along with chunked uploads that have been idle
+# for UPLOAD_PARTIAL_TTL_HOURS.
+#
+# Large files can be sent in chunks over several requests, resuming after a
+# dropped connection:
+#   POST /uploads/sessions {filename, size[, sha256]} -> {id, offset}
+#   PUT /uploads/sessions/{id} with Upload-Offset: <offset> and raw bytes
+#   GET /uploads/sessions/{id} -> current offset, to resume from
+# The upload is finished when the last byte arrives. With sha256 given, a
+# file the user has already uploaded completes at once without any bytes.
+#
+# Limits: UPLOAD_MAX_BYTES per file (MAX_DOCUMENT_BYTES for documents, the
+# most text extraction will read, so nothing is accepted that /chat can't
+# use) and USER_UPLOAD_QUOTA_BYTES in total per user (counted per upload,
+# so duplicates count against the quota even though they share storage).
+# /upload checks its Content-Length against both before reading the body
+# and the bytes received so far on every chunk, so a body without a length
+# (Transfer-Encoding: chunked) is cut off at the limit too.
+
+UPLOAD_DIR = os.path.join(os.getcwd(), "uploads")
+BLOB_DIR = os.path.join(UPLOAD_DIR, "blobs")
+PARTIAL_DIR = os.path.join(UPLOAD_DIR, "partial")
+MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(200 * 1024 * 1024)))
+USER_QUOTA_BYTES = int(os.getenv("USER_UPLOAD_QUOTA_BYTES", str(2 * 1024 * 1024 * 1024)))
+GC_GRACE_SECONDS = float(os.getenv("UPLOAD_GC_GRACE_SECONDS", "3600"))
+PARTIAL_TTL_HOURS = float(os.getenv("UPLOAD_PARTIAL_TTL_HOURS", "24"))
+# Suggested chunk size for clients, and how much of a request body is
+# buffered before it's written out
+CHUNK_SIZE = 8 * 1024 * 1024
+WRITE_BUFFER_BYTES = 1024 * 1024
+# Allowance for the multipart boundaries and part headers around an /upload file
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_ID_PREFIX = "upl_"
+
+EXTENSION = re.compile(r"^\.[a-z0-9]{1,10}$")
+
+class UploadError(ValueError):
+    status_code = 400
+
+class UploadTooLargeError(UploadError):
+    status_code = 413
+
+class UploadOffsetError(UploadError):
+    status_code = 409
+
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+# Blob writes and garbage collection take this lock, so a blob can't be
+# deleted between an upload finding it on disk and taking its reference
+_blob_lock = threading.Lock()
+# sha256 state of chunked uploads, so finishing one doesn't re-read the file
+_hashers = {}  # session id -> (bytes hashed, hashlib object)
+_session_locks = {}
+
+def is_upload_id(value):
+    return isinstance(value, str) and value.startswith(UPLOAD_ID_PREFIX)
+
+def safe_filename(filename):
+    name = os.path.basename((filename or "").replace("\\", "/")).strip()
+    return name or "upload"
+
+def blob_name(content_hash, filename):
+    ext = os.path.splitext(filename)[1].lower()
+    return content_hash + (ext if EXTENSION.match(ext) else "")
+
+def blob_path(name):
+    return os.path.join(BLOB_DIR, name[:2], name)
+
+def _partial_path(session_id):
+    return os.path.join(PARTIAL_DIR, f"{session_id}.part")
+
+def summary(upload):
+    return {"id": upload["id"], "filename": upload["filename"], "size": upload["size"],
+            "sha256": upload["blob"][:64], "created_at": upload.get("created_at")}
+
+def max_file_bytes(filename=None):
+    if filename and document_processor.is_supported(filename):
+        return min(MAX_FILE_BYTES, document_processor.MAX_FILE_BYTES)
+    return MAX_FILE_BYTES
+
+def _too_large(filename):
+    limit = max_file_bytes(filename)
+    if not filename:
+        return UploadTooLargeError(f"File is larger than the {limit // (1024 * 1024)} MB upload limit")
+    return UploadTooLargeError(f"{filename} is larger than the {limit // (1024 * 1024)} MB limit for this file type")
+
+def _over_quota():
+    return QuotaExceededError(f"Upload quota of {USER_QUOTA_BYTES // (1024 * 1024)} MB reached, "
+                              f"delete old uploads first")
+
+def check_quota(user_id, size, filename=None):
+    if size > max_file_bytes(filename):
+        raise _too_large(filename)
+    if get_user_upload_bytes(user_id) + size > USER_QUOTA_BYTES:
+        raise _over_quota()
+
+def check_request_size(user_id, content_length):
+    """
+    Rejects a multipart /upload by its Content-Length before any of the body
+    is read. The filename isn't known yet, so the general per-file limit
+    applies here and the document limit once the file is in.
+    """
+    try:
+        check_quota(user_id, max(0, content_length - MULTIPART_OVERHEAD_BYTES))
+    except (UploadError, QuotaExceededError) as e:
+        raise type(e)(f"{str(e)}. For large files, start a chunked upload with POST /uploads/sessions, "
+                      f"which checks the size before any bytes are sent")
+
+def _finish(user_id, filename, tmp_path, content_hash, size):
+    """Moves a fully received file into blob storage and records the upload."""
+    try:
+        check_quota(user_id, size, filename)
+        name = blob_name(content_hash, filename)
+        upload_id = UPLOAD_ID_PREFIX + uuid.uuid4().hex
+        with _blob_lock:
+            path = blob_path(name)
+            if os.path.exists(path):
+                # Same content is already stored; keep that copy
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            add_upload(upload_id, user_id, filename, name, size)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return summary(get_upload(upload_id))
+
+def _multipart():
+    try:
+        from python_multipart import multipart
+    except ImportError:  # python-multipart before 0.0.13
+        from multipart import multipart
+    return multipart
+
+class _FormFileParser:
+    """python-multipart callbacks that collect the bytes of one file field of a form."""
+
+    def __init__(self, boundary, field):
+        self.field = field.encode("utf-8")
+        self.filename = None  # set once the field's headers are in
+        self.data = bytearray()  # file bytes not yet written out
+        self._in_field = False
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self.parser = _multipart().MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = _multipart().parse_options_header(self._headers.get(b"content-disposition", b""))
+        # Only the first part with this name and a filename is the file
+        if self.filename is None and options.get(b"name") == self.field and b"filename" in options:
+            self.filename = safe_filename(options[b"filename"].decode("utf-8", "replace"))
+            self._in_field = True
+
+    def _on_part_data(self, data, start, end):
+        if self._in_field:
+            self.data.extend(data[start:end])
+
+    def _on_part_end(self):
+        self._in_field = False
+
+def _write_hashed(f, digest, data):
+    digest.update(data)
+    f.write(data)
+
+async def receive_form_file(user_id, content_type, stream, field="file"):
+    """
+    Stores the file in the `field` part of a multipart/form-data body read
+    from stream (an async iterator, the request body). The size limit and
+    the user's quota are checked on every chunk, before it's written, and
+    other form fields are skipped without being kept. Returns the upload
+    summary.
+    """
+    mime, options = _multipart().parse_options_header(content_type or "")
+    boundary = options.get(b"boundary")
+    if mime.lower() != b"multipart/form-data" or not boundary:
+        raise UploadError("Expected a multipart/form-data body")
+
+    form = _FormFileParser(boundary, field)
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    tmp_path = _partial_path(uuid.uuid4().hex)
+    f = await run_io(open, tmp_path, "wb")
+    digest = hashlib.sha256()
+    size = 0
+    used = None
+    try:
+        async for chunk in stream:
+            form.parser.write(chunk)
+            if not form.data:
+                continue
+            if used is None:
+                used = await run_io(get_user_upload_bytes, user_id)
+            size += len(form.data)
+            if size > max_file_bytes(form.filename):
+                raise _too_large(form.filename)
+            if used + size > USER_QUOTA_BYTES:
+                raise _over_quota()
+            await run_io(_write_hashed, f, digest, bytes(form.data))
+            form.data.clear()
+        form.parser.finalize()
+        if form.filename is None:
+            raise UploadError(f"Expected a file in the '{field}' form field")
+    except Exception:
+        await run_io(f.close)
+        os.remove(tmp_path)
+        raise
+    await run_io(f.close)
+    return await run_io(_finish, user_id, form.filename, tmp_path, digest.hexdigest(), size)
+
+def resolve(user_id, upload_id):
+    """Server path of one of the user's uploads, or None."""
+    upload = get_upload(upload_id) if is_upload_id(upload_id) else None
+    if not upload or upload["user_id"] != user_id:
+        return None
+    return blob_path(upload["blob"])
+
+def remove(user_id, upload_id):
+    """Deletes one of the user's uploads. Returns False if there was no such upload."""
+    upload = get_upload(upload_id) if is_upload_id(upload_id) else None
+    if not upload or upload["user_id"] != user_id:
+        return False
+    delete_upload(upload_id, time.time())
+    return True
+
+# Chunked uploads
+
+def session_summary(session):
+    return {"id": session["id"], "filename": session["filename"], "size": session["size"],
+            "offset": session["received"], "chunk_size": CHUNK_SIZE, "complete": False}
+
+def start_session(user_id, filename, size, content_hash=None):
+    filename = safe_filename(filename)
+    if size < 0:
+        raise UploadError("size must not be negative")
+    if content_hash:
+        existing = find_user_upload(user_id, blob_name(content_hash.lower(), filename))
+        if existing:
+            return {"complete": True, "upload": summary(existing)}
+    check_quota(user_id, size, filename)
+    session_id = uuid.uuid4().hex
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    open(_partial_path(session_id), "wb").close()
+    create_upload_session(session_id, user_id, filename, size, time.time())
+    session = get_upload_session(session_id)
+    if size == 0:
+        return {"complete": True, "upload": _finish_session(session)}
+    return session_summary(session)
+
+def _append(session_id, offset, data):
+    with open(_partial_path(session_id), "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+        f.truncate()
+    hashed, digest = _hashers.get(session_id, (0, None))
+    if digest is None and offset == 0:
+        hashed, digest = 0, hashlib.sha256()
+    if digest is not None and hashed == offset:
+        digest.update(data)
+        _hashers[session_id] = (offset + len(data), digest)
+    else:
+        # Restarted server or rewritten range: hash the file once at the end instead
+        _hashers.pop(session_id, None)
+    update_upload_session(session_id, offset + len(data), time.time())
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(WRITE_BUFFER_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _finish_session(session):
+    session_id = session["id"]
+    tmp_path = _partial_path(session_id)
+    hashed, digest = _hashers.pop(session_id, (0, None))
+    content_hash = digest.hexdigest() if digest is not None and hashed == session["size"] else _file_hash(tmp_path)
+    try:
+        return _finish(session["user_id"], session["filename"], tmp_path, content_hash, session["size"])
+    finally:
+        delete_upload_session(session_id)
+
+async def receive_chunk(session, offset, stream):
+    """
+    Appends the bytes from stream (an async iterator, the request body) at
+    offset, which must be where the previous chunk ended. Returns the session
+    summary, or {"complete": True, "upload": ...} once the last byte is in.
+    """
+    session_id = session["id"]
+    lock = _session_locks.setdefault(session_id, asyncio.Lock())
+    async with lock:
+        session = await run_io(get_upload_session, session_id)
+        if session is None:
+            raise UploadError("Upload session has expired")
+        if offset != session["received"]:
+            raise UploadOffsetError(f"Expected offset {session['received']}", session["received"])
+        position = offset
+        buffer = bytearray()
+        async for data in stream:
+            if position + len(buffer) + len(data) > session["size"]:
+                raise UploadError("More data than the declared size")
+            buffer.extend(data)
+            if len(buffer) >= WRITE_BUFFER_BYTES:
+                await run_io(_append, session_id, position, bytes(buffer))
+                position += len(buffer)
+                buffer.clear()
+        if buffer:
+            await run_io(_append, session_id, position, bytes(buffer))
+            position += len(buffer)
+        if position < session["size"]:
+            return session_summary({**session, "received": position})
+        _session_locks.pop(session_id, None)
+        return {"complete": True, "upload": await run_io(_finish_session, {**session, "received": position})}
+
+def cancel_session(session_id):
+    _hashers.pop(session_id, None)
+    _session_locks.pop(session_id, None)
+    delete_upload_session(session_id)
+    try:
+        os.remove(_partial_path(session_id))
+    except FileNotFoundError:
+        pass
+
+# Garbage collection
+
+def collect_garbage(now=None):
+    """Deletes released blobs past the grace period and idle chunked uploads. Returns counts."""
+    now = now or time.time()
+    removed_blobs = 0
+    for name in get_released_blobs(now - GC_GRACE_SECONDS):
+        with _blob_lock:
+            if delete_blob_if_unreferenced(name):
+                try:
+                    os.remove(blob_path(name))
+                except FileNotFoundError:
+                    pass
+                removed_blobs += 1
+    stale_sessions = get_stale_upload_sessions(now - PARTIAL_TTL_HOURS * 3600)
+    for session_id in stale_sessions:
+        cancel_session(session_id)
+    if removed_blobs or stale_sessions:
+        print(f"Upload GC: removed {removed_blobs} blobs and {len(stale_sessions)} abandoned uploads")
+    return {"blobs": removed_blobs, "sessions": len(stale_sessions)}
@@ -0,0 +1,156 @@
+import base64
+import binascii
+import hashlib
+import io
+import os
+import threading
+import uuid
+
+from extraction_cache import file_hash
+
+# Vision input preprocessing
+# --------------------------
+# Images for the vision model arrive as upload paths or as base64 in
+# ChatRequest.image. Sending a 12 MP phone photo as-is means Ollama base64s
+# the whole file and the model resizes it again on every turn, so each image
+# is prepared once:
+# - EXIF orientation applied (phones store portrait shots rotated)
+# - alpha flattened onto white, converted to RGB
+# - downscaled to at most VISION_MAX_PIXELS, with both sides a multiple of
+#   VISION_PATCH_SIZE (qwen2.5vl works on 28 px patches and would resize to
+#   this grid itself)
+# - re-encoded as JPEG at VISION_JPEG_QUALITY
+# Prepared files live in vision_cache/ under the hash of the original bytes
+# plus the settings above, so a second question about the same image (or
+# the same photo uploaded twice) skips all of it. The directory is kept
+# under VISION_CACHE_MAX_BYTES, least recently used first.
+
+CACHE_DIR = os.path.join(os.getcwd(), "vision_cache")
+MAX_PIXELS = int(os.getenv("VISION_MAX_PIXELS", str(1280 * 28 * 28)))
+PATCH_SIZE = int(os.getenv("VISION_PATCH_SIZE", "28"))
+JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+MAX_INPUT_BYTES = int(os.getenv("VISION_MAX_INPUT_BYTES", str(32 * 1024 * 1024)))
+CACHE_MAX_BYTES = int(os.getenv("VISION_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Bump when the preprocessing changes so old cache entries are not reused
+PREP_VERSION = 1
+
+_lock = threading.Lock()
+_cache_bytes = None  # running total of CACHE_DIR, computed on first use
+
+class InvalidImageError(ValueError):
+    pass
+
+def _settings_tag():
+    return f"v{PREP_VERSION}-{MAX_PIXELS}-{PATCH_SIZE}-{JPEG_QUALITY}"
+
+def _cache_path(content_hash):
+    return os.path.join(CACHE_DIR, f"{content_hash[:32]}-{_settings_tag()}.jpg")
+
+def target_size(width, height):
+    """Largest size within MAX_PIXELS that keeps the aspect ratio, snapped to the patch grid."""
+    scale = min(1.0, (MAX_PIXELS / float(width * height)) ** 0.5)
+    new_width = max(PATCH_SIZE, int(width * scale) // PATCH_SIZE * PATCH_SIZE)
+    new_height = max(PATCH_SIZE, int(height * scale) // PATCH_SIZE * PATCH_SIZE)
+    return new_width, new_height
+
+def _prepare(source):
+    """Prepared JPEG bytes for an image file path or file-like object."""
+    from PIL import Image, ImageOps
+    try:
+        with Image.open(source) as image:
+            width, height = image.size
+            new_size = target_size(width, height)
+            # JPEG can decode straight at 1/2, 1/4 or 1/8 scale, far cheaper than a full decode
+            image.draft("RGB", new_size)
+            image = ImageOps.exif_transpose(image)
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+            # exif_transpose may have swapped the sides
+            if image.size != new_size:
+                if (image.width > image.height) != (new_size[0] > new_size[1]):
+                    new_size = new_size[::-1]
+                image = image.resize(new_size, Image.LANCZOS)
+            out = io.BytesIO()
+            image.save(out, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+            return out.getvalue()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImageError(f"Could not read image: {str(e)}")
+
+def decode_base64_image(data):
+    """Bytes of a base64 image, with or without a data: URL prefix."""
+    if data.startswith("data:"):
+        data = data.partition(",")[2]
+    if len(data) * 3 // 4 > MAX_INPUT_BYTES:
+        raise InvalidImageError(f"Image is larger than {MAX_INPUT_BYTES // (1024 * 1024)} MB")
+    try:
+        return base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        raise InvalidImageError("Image is neither an uploaded file nor valid base64 data")
+
+def _store(path, data):
+    global _cache_bytes
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    with _lock:
+        if _cache_bytes is None:
+            _cache_bytes = sum(entry.stat().st_size for entry in os.scandir(CACHE_DIR) if entry.is_file())
+        else:
+            _cache_bytes += len(data)
+        if _cache_bytes > CACHE_MAX_BYTES:
+            _evict()
+
+def _evict():
+    # Called under _lock: drop least recently used files down to 80% of the limit
+    global _cache_bytes
+    entries = sorted((entry for entry in os.scandir(CACHE_DIR) if entry.is_file() and entry.name.endswith(".jpg")),
+                     key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= CACHE_MAX_BYTES * 0.8:
+            break
+        try:
+            size = entry.stat().st_size
+            os.remove(entry.path)
+            total -= size
+        except OSError:
+            pass
+    _cache_bytes = total
+
+def _cached(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        os.utime(path, None)  # mark as recently used for eviction
+    except OSError:
+        pass
+    return path
+
+def prepare_image(image):
+    """
+    Path of the prepared copy of an image for the vision model.
+    image is a file path (from /upload) or base64 data. Raises
+    InvalidImageError for data that isn't a readable image.
+    """
+    if os.path.exists(image):
+        if os.path.getsize(image) > MAX_INPUT_BYTES:
+            raise InvalidImageError(f"Image is larger than {MAX_INPUT_BYTES // (1024 * 1024)} MB")
+        path = _cache_path(file_hash(image))
+        if _cached(path):
+            return path
+        _store(path, _prepare(image))
+        return path
+
+    data = decode_base64_image(image)
+    path = _cache_path(hashlib.sha256(data).hexdigest())
+    if _cached(path):
+        return path
+    _store(path, _prepare(io.BytesIO(data)))
+    return path
@@ -2,11 +2,15 @@ import React, { useState, useEffect } from 'react';
 import Sidebar from './components/Sidebar';
 import ChatInterface from './components/ChatInterface';
 import Login from './components/Login';
-import { getSessions, createSession, deleteSession } from './api';
+import { getSessions, createSession, deleteSession, logout, setAuthToken, onUnauthorized } from './api';
+
+// Sessions come in pages, newest first; older ones load on demand
+const SESSION_PAGE_SIZE = 50;
 
 function App() {
   const [user, setUser] = useState(null);
   const [sessions, setSessions] = useState([]);
+  const [hasMoreSessions, setHasMoreSessions] = useState(false);
   const [currentSessionId, setCurrentSessionId] = useState(null);
   const [refreshTrigger, setRefreshTrigger] = useState(0);
 
@@ -14,8 +18,16 @@ function App() {
     // Check for persisted login
     const savedUser = localStorage.getItem('chat_user');
     if (savedUser) {
-      setUser(JSON.parse(savedUser));
+      const parsed = JSON.parse(savedUser);
+      // Logins saved before tokens existed have to sign in again
+      if (parsed.token) {
+        setAuthToken(parsed.token);
+        setUser(parsed);
+      } else {
+        localStorage.removeItem('chat_user');
+      }
     }
+    onUnauthorized(() => clearLogin());
   }, []);
 
   useEffect(() => {
@@ -25,26 +37,50 @@ function App() {
   }, [user]);
 
   const handleLogin = (userData) => {
+    setAuthToken(userData.token);
     setUser(userData);
     localStorage.setItem('chat_user', JSON.stringify(userData));
   };
 
-  const handleLogout = () => {
+  const clearLogin = () => {
+    setAuthToken(null);
     setUser(null);
     setSessions([]);
+    setHasMoreSessions(false);
     setCurrentSessionId(null);
     localStorage.removeItem('chat_user');
   };
 
+  const handleLogout = async () => {
+    try {
+      await logout();
+    } catch (error) {
+      console.error("Failed to log out", error);
+    }
+    clearLogin();
+  };
+
   const loadSessions = async () => {
     try {
-      const data = await getSessions();
+      const data = await getSessions({ limit: SESSION_PAGE_SIZE });
       setSessions(data);
+      setHasMoreSessions(data.length === SESSION_PAGE_SIZE);
     } catch (error) {
       console.error("Failed to load sessions", error);
     }
   };
 
+  const loadMoreSessions = async () => {
+    if (sessions.length === 0) return;
+    try {
+      const data = await getSessions({ before_id: sessions[sessions.length - 1].id, limit: SESSION_PAGE_SIZE });
+      setSessions(prev => [...prev, ...data.filter(s => !prev.some(p => p.id === s.id))]);
+      setHasMoreSessions(data.length === SESSION_PAGE_SIZE);
+    } catch (error) {
+      console.error("Failed to load older sessions", error);
+    }
+  };
+
   const handleNewChat = async () => {
     try {
       const newSession = await createSession("New Chat");
@@ -87,6 +123,8 @@ function App() {
         onSelectSession={handleSelectSession}
         onNewChat={handleNewChat}
         onDeleteSession={handleDeleteSession}
+        hasMoreSessions={hasMoreSessions}
+        onLoadMoreSessions={loadMoreSessions}
         user={user}
         onLogout={handleLogout}
       />
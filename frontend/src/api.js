@@ -2,13 +2,42 @@ import axios from 'axios';
 
 const API_URL = 'http://localhost:8000';
 
+// Bearer token from /login, sent with every request
+let authToken = null;
+let unauthorizedHandler = null;
+
+export const setAuthToken = (token) => {
+    authToken = token;
+    if (token) {
+        axios.defaults.headers.common['Authorization'] = `Bearer ${token}`;
+    } else {
+        delete axios.defaults.headers.common['Authorization'];
+    }
+};
+
+// Called when the server rejects the token (expired or revoked)
+export const onUnauthorized = (handler) => {
+    unauthorizedHandler = handler;
+};
+
+axios.interceptors.response.use(
+    response => response,
+    error => {
+        if (error.response?.status === 401 && authToken && unauthorizedHandler) {
+            unauthorizedHandler();
+        }
+        return Promise.reject(error);
+    }
+);
+
 export const createSession = async (title = "New Chat") => {
     const response = await axios.post(`${API_URL}/sessions`, { title });
     return response.data;
 };
 
-export const getSessions = async () => {
-    const response = await axios.get(`${API_URL}/sessions`);
+// Keyset pagination: pass { before_id, limit } to page through older entries
+export const getSessions = async (params = {}) => {
+    const response = await axios.get(`${API_URL}/sessions`, { params });
     return response.data;
 };
 
@@ -16,8 +45,14 @@ export const deleteSession = async (sessionId) => {
     await axios.delete(`${API_URL}/sessions/${sessionId}`);
 };
 
-export const getSessionMessages = async (sessionId) => {
-    const response = await axios.get(`${API_URL}/sessions/${sessionId}/messages`);
+export const getSessionMessages = async (sessionId, params = {}) => {
+    const response = await axios.get(`${API_URL}/sessions/${sessionId}/messages`, { params });
+    return response.data;
+};
+
+// Server-side full-text search: { q, session_id, limit, offset }; page with next_offset
+export const searchMessages = async (params) => {
+    const response = await axios.get(`${API_URL}/search`, { params });
     return response.data;
 };
 
@@ -31,45 +66,85 @@ export const login = async (username, password) => {
     return response.data;
 };
 
+export const logout = async () => {
+    await axios.post(`${API_URL}/logout`);
+};
+
 export const register = async (username, password) => {
     const response = await axios.post(`${API_URL}/register`, { username, password });
     return response.data;
 };
 
-export const sendMessage = async (message, image, contextFiles, sessionId) => {
+// Files above this size are sent in chunks that can be resumed after a dropped connection
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+const MAX_CHUNK_RETRIES = 5;
+
+const uploadInChunks = async (file) => {
+    const start = await axios.post(`${API_URL}/uploads/sessions`, { filename: file.name, size: file.size });
+    if (start.data.complete) return start.data.upload;
+
+    const { id, chunk_size: chunkSize } = start.data;
+    let offset = start.data.offset;
+    let retries = 0;
+    while (true) {
+        try {
+            const res = await axios.put(`${API_URL}/uploads/sessions/${id}`, file.slice(offset, offset + chunkSize), {
+                headers: { 'Content-Type': 'application/octet-stream', 'Upload-Offset': String(offset) }
+            });
+            if (res.data.complete) return res.data.upload;
+            offset = res.data.offset;
+            retries = 0;
+        } catch (error) {
+            if (++retries > MAX_CHUNK_RETRIES || (error.response && error.response.status !== 409)) throw error;
+            // Ask the server how much arrived and carry on from there
+            const status = await axios.get(`${API_URL}/uploads/sessions/${id}`);
+            offset = status.data.offset;
+        }
+    }
+};
+
+// Returns the upload id that /chat takes in context_files and image
+const uploadFile = async (file) => {
+    if (file.size > CHUNKED_UPLOAD_THRESHOLD) {
+        return (await uploadInChunks(file)).id;
+    }
+    const formData = new FormData();
+    formData.append('file', file);
+    const res = await axios.post(`${API_URL}/upload`, formData, {
+        headers: { 'Content-Type': 'multipart/form-data' }
+    });
+    return res.data.id;
+};
+
+const uploadAttachments = async (image, contextFiles) => {
     // 1. Upload files first if any
     const uploadedFiles = [];
     if (contextFiles && contextFiles.length > 0) {
         for (const file of contextFiles) {
-            const formData = new FormData();
-            formData.append('file', file);
             try {
-                const res = await axios.post(`${API_URL}/upload`, formData, {
-                    headers: { 'Content-Type': 'multipart/form-data' }
-                });
-                uploadedFiles.push(res.data.path);
+                uploadedFiles.push(await uploadFile(file));
             } catch (error) {
                 console.error("Error uploading file:", error);
             }
         }
     }
 
-    // 2. Upload image if any (as a file, then get path) or handle base64. 
-    // For simplicity, let's treat image as a file upload too if it's a file object
+    // 2. Upload image if any, the same way
     let imagePath = null;
     if (image) {
-        const formData = new FormData();
-        formData.append('file', image);
         try {
-            const res = await axios.post(`${API_URL}/upload`, formData, {
-                headers: { 'Content-Type': 'multipart/form-data' }
-            });
-            imagePath = res.data.path;
+            imagePath = await uploadFile(image);
         } catch (error) {
             console.error("Error uploading image:", error);
         }
     }
 
+    return { uploadedFiles, imagePath };
+};
+
+export const sendMessage = async (message, image, contextFiles, sessionId) => {
+    const { uploadedFiles, imagePath } = await uploadAttachments(image, contextFiles);
+
     // 3. Send simplified JSON to chat endpoint
     const payload = {
         message: message,
@@ -82,3 +157,75 @@ export const sendMessage = async (message, image, contextFiles, sessionId) => {
     return response.data;
 };
 
+// Streaming variant: calls onToken(text) for every chunk the model produces
+// and resolves with the full reply once the server sends the final event.
+export const sendMessageStream = async (message, image, contextFiles, sessionId, onToken) => {
+    const { uploadedFiles, imagePath } = await uploadAttachments(image, contextFiles);
+
+    const payload = {
+        message: message,
+        image: imagePath,
+        context_files: uploadedFiles,
+        session_id: sessionId
+    };
+
+    const response = await fetch(`${API_URL}/chat/stream`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json', 'Authorization': `Bearer ${authToken}` },
+        body: JSON.stringify(payload)
+    });
+    if (response.status === 401 && unauthorizedHandler) {
+        unauthorizedHandler();
+    }
+    if (!response.ok || !response.body) {
+        throw new Error(`Stream request failed: ${response.status}`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let fullResponse = '';
+    let imageJob = null;
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // SSE events are separated by a blank line
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const event of events) {
+            if (!event.startsWith('data: ')) continue;
+            const data = JSON.parse(event.slice(6));
+            if (data.error) {
+                // Server busy (queue full / timed out) after the stream had started
+                const error = new Error(data.error);
+                error.status = data.status;
+                error.detail = data.error;
+                throw error;
+            }
+            if (data.image_job) {
+                imageJob = data.image_job;
+            } else if (data.done) {
+                fullResponse = data.response;
+            } else if (data.token) {
+                fullResponse += data.token;
+                onToken(data.token);
+            }
+        }
+    }
+
+    return { response: fullResponse, imageJob };
+};
+
+// Image generation runs as a background job; poll until it is done or failed
+export const waitForImageJob = async (job, intervalMs = 1000) => {
+    let current = job;
+    while (current.status !== 'done' && current.status !== 'error') {
+        await new Promise(resolve => setTimeout(resolve, intervalMs));
+        const response = await axios.get(`${API_URL}${job.status_url}`);
+        current = response.data;
+    }
+    return current;
+};
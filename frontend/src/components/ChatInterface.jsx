@@ -1,7 +1,22 @@
 import React, { useState, useEffect, useRef } from 'react';
 import ReactMarkdown from 'react-markdown';
 import { Send, Paperclip, Image as ImageIcon, Loader2, Sparkles, Download, Maximize2, X } from 'lucide-react';
-import { sendMessage, getSessionMessages } from '../api';
+import { sendMessageStream, waitForImageJob, getSessionMessages } from '../api';
+
+// History comes in pages of the latest messages; older pages load on demand
+const MESSAGE_PAGE_SIZE = 200;
+
+// Map DB format to UI format
+const toUiMessage = (msg) => ({
+    id: msg.id,
+    role: msg.role === 'model' ? 'bot' : 'user',
+    content: msg.content,
+    timestamp: msg.timestamp
+});
+
+// Generated images have a compressed WebP copy; downloads keep the original PNG
+const compressedImageUrl = (src) =>
+    src && src.includes('/images/') && !src.includes('?') ? `${src}?variant=webp` : src;
 
 const ChatInterface = ({ sessionId, refreshTrigger }) => {
     const [messages, setMessages] = useState([]);
@@ -11,33 +26,49 @@ const ChatInterface = ({ sessionId, refreshTrigger }) => {
     const [selectedDocs, setSelectedDocs] = useState([]);
     const [isImageGenMode, setIsImageGenMode] = useState(false);
     const [viewingImage, setViewingImage] = useState(null);
+    const [oldestMessageId, setOldestMessageId] = useState(null);
+    const [hasOlderMessages, setHasOlderMessages] = useState(false);
 
     const messagesEndRef = useRef(null);
+    const skipScrollRef = useRef(false);
     const fileInputRef = useRef(null);
     const imageInputRef = useRef(null);
 
     const fetchHistory = async () => {
         if (!sessionId) return;
         try {
-            const history = await getSessionMessages(sessionId);
-            // Map DB format to UI format
-            const formatted = history.map(msg => ({
-                id: msg.id,
-                role: msg.role === 'model' ? 'bot' : 'user',
-                content: msg.content,
-                timestamp: msg.timestamp
-            }));
-            setMessages(formatted);
+            const history = await getSessionMessages(sessionId, { limit: MESSAGE_PAGE_SIZE });
+            setMessages(history.map(toUiMessage));
+            setOldestMessageId(history.length ? history[0].id : null);
+            setHasOlderMessages(history.length === MESSAGE_PAGE_SIZE);
         } catch (err) {
             console.error("Failed to load history", err);
         }
     };
 
+    const loadOlderMessages = async () => {
+        if (!sessionId || oldestMessageId === null) return;
+        try {
+            const older = await getSessionMessages(sessionId, { before_id: oldestMessageId, limit: MESSAGE_PAGE_SIZE });
+            // Prepending shouldn't jump the view to the newest message
+            skipScrollRef.current = true;
+            setMessages(prev => [...older.map(toUiMessage), ...prev]);
+            if (older.length) setOldestMessageId(older[0].id);
+            setHasOlderMessages(older.length === MESSAGE_PAGE_SIZE);
+        } catch (err) {
+            console.error("Failed to load older messages", err);
+        }
+    };
+
     useEffect(() => {
         fetchHistory();
     }, [sessionId, refreshTrigger]);
 
     useEffect(() => {
+        if (skipScrollRef.current) {
+            skipScrollRef.current = false;
+            return;
+        }
         messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
     }, [messages]);
 
@@ -60,19 +91,36 @@ const ChatInterface = ({ sessionId, refreshTrigger }) => {
         setInput('');
         setIsLoading(true);
 
+        const botMsgId = Date.now() + 1;
+        let botMsgAdded = false;
+        const appendToBotMsg = (token) => {
+            if (!botMsgAdded) {
+                botMsgAdded = true;
+                setMessages(prev => [...prev, { id: botMsgId, role: 'bot', content: token }]);
+                return;
+            }
+            setMessages(prev => prev.map(m => m.id === botMsgId ? { ...m, content: m.content + token } : m));
+        };
+
         try {
-            const response = await sendMessage(userMsg.content, selectedImage, selectedDocs, sessionId);
+            const response = await sendMessageStream(userMsg.content, selectedImage, selectedDocs, sessionId, appendToBotMsg);
 
-            const botMsg = {
-                id: Date.now() + 1,
-                role: 'bot',
-                content: response.response
-            };
+            // Replace the streamed text with the final stored reply
+            if (botMsgAdded) {
+                setMessages(prev => prev.map(m => m.id === botMsgId ? { ...m, content: response.response } : m));
+            } else {
+                setMessages(prev => [...prev, { id: botMsgId, role: 'bot', content: response.response }]);
+            }
 
-            setMessages(prev => [...prev, botMsg]);
+            // Generated images arrive later: swap the placeholder for the result
+            if (response.imageJob) {
+                waitForImageJob(response.imageJob)
+                    .then(job => setMessages(prev => prev.map(m => m.id === botMsgId ? { ...m, content: job.response } : m)))
+                    .catch(error => console.error("Error waiting for image:", error));
+            }
         } catch (error) {
             console.error("Error sending message:", error);
-            setMessages(prev => [...prev, { id: Date.now(), role: 'bot', content: "Error: Could not get response." }]);
+            setMessages(prev => [...prev, { id: Date.now(), role: 'bot', content: `Error: ${error.detail || "Could not get response."}` }]);
         } finally {
             setIsLoading(false);
             setSelectedImage(null);
@@ -105,6 +153,16 @@ const ChatInterface = ({ sessionId, refreshTrigger }) => {
     return (
         <div className="flex-1 flex flex-col h-full bg-gradient-to-br from-[#000B18] to-[#0d1b2a] relative">
             <div className="flex-1 overflow-y-auto p-4 chat-scroll">
+                {hasOlderMessages && (
+                    <div className="flex justify-center mb-4">
+                        <button
+                            onClick={loadOlderMessages}
+                            className="text-xs text-slate-400 hover:text-white px-3 py-1.5 rounded-lg bg-slate-800/50 border border-slate-700/50 transition-colors"
+                        >
+                            Load older messages
+                        </button>
+                    </div>
+                )}
                 {messages.map((msg) => (
                     <div key={msg.id} className={`flex mb-4 ${msg.role === 'user' ? 'justify-end' : 'justify-start'}`}>
                         <div className={`max-w-[75%] rounded-lg p-3 ${msg.role === 'user'
@@ -117,7 +175,7 @@ const ChatInterface = ({ sessionId, refreshTrigger }) => {
                                         components={{
                                             img: ({ node, ...props }) => (
                                                 <div className="relative group inline-block max-w-full overflow-hidden rounded-lg">
-                                                    <img {...props} className="max-w-full h-auto rounded-lg" />
+                                                    <img {...props} src={compressedImageUrl(props.src)} loading="lazy" className="max-w-full h-auto rounded-lg" />
                                                     <div className="absolute top-2 right-2 flex gap-1 opacity-0 group-hover:opacity-100 transition-opacity bg-black/50 p-1 rounded-lg backdrop-blur-sm">
                                                         <button
                                                             onClick={() => {
@@ -134,7 +192,7 @@ const ChatInterface = ({ sessionId, refreshTrigger }) => {
                                                             <Download className="w-4 h-4" />
                                                         </button>
                                                         <button
-                                                            onClick={() => setViewingImage(props.src)}
+                                                            onClick={() => setViewingImage(compressedImageUrl(props.src))}
                                                             className="p-1.5 text-white hover:bg-white/20 rounded transition-colors"
                                                             title="View Fullscreen"
                                                         >
@@ -2,7 +2,7 @@ import React, { useState } from 'react';
 import { MessageSquare, Plus, Search, Trash2, LogOut, Hexagon } from 'lucide-react';
 import logo from '../assets/logo.jpg';
 
-const Sidebar = ({ sessions, currentSessionId, onSelectSession, onNewChat, onDeleteSession, user, onLogout }) => {
+const Sidebar = ({ sessions, currentSessionId, onSelectSession, onNewChat, onDeleteSession, hasMoreSessions, onLoadMoreSessions, user, onLogout }) => {
     const [searchTerm, setSearchTerm] = useState('');
 
     const filteredSessions = sessions.filter(session =>
@@ -79,6 +79,14 @@ const Sidebar = ({ sessions, currentSessionId, onSelectSession, onNewChat, onDel
                         </button>
                     </div>
                 ))}
+                {hasMoreSessions && (
+                    <button
+                        onClick={onLoadMoreSessions}
+                        className="w-full p-2 mb-2 text-xs text-slate-500 hover:text-slate-300 hover:bg-slate-800/50 rounded-lg transition-colors"
+                    >
+                        Load older chats
+                    </button>
+                )}
             </div>
 
             {/* User Profile / Logout */}